@@ -0,0 +1,81 @@
+"""
+Measures compressed data frames to the extension (compress: "deflate-raw").
+
+Cuts typical terminal output into the frames the daemon sends (64 KiB when
+output streams, a few bytes for keystroke echo) and encodes them the way the
+host does, once as plain base64 messages and once through ExtDeflate. Reports
+the bytes written to the Native Messaging pipe and the host CPU time per MB of
+terminal output for each.
+
+    python native-host/bench/bench_compress.py [level ...]
+"""
+
+import os
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+HERE = Path(__file__).resolve().parent
+sys.path.insert(0, str(HERE.parent))
+
+import run_in_terminal as rit  # noqa: E402
+
+FRAME = 64 * 1024
+
+
+def run(cmd: list[str], limit: int = 8 << 20) -> bytes:
+    out = subprocess.run(cmd, capture_output=True, check=False).stdout[:limit]
+    return out.replace(b"\n", b"\r\n")
+
+
+def build_log() -> bytes:
+    lines = []
+    for i in range(60000):
+        lines.append(
+            b"\x1b[32m[%5d/60000]\x1b[0m Compiling src/module_%d/file_%d.c -> "
+            b"build/obj/module_%d/file_%d.o (-O2 -g -Wall)\r\n" % (i, i % 97, i, i % 97, i)
+        )
+    return b"".join(lines)
+
+
+def workloads() -> list[tuple[str, list[bytes]]]:
+    def frames(data: bytes) -> list[bytes]:
+        return [data[i : i + FRAME] for i in range(0, len(data), FRAME)]
+
+    echo = [b"x", b"\x08\x1b[K", b"ls -la\r\n", b"\x1b[?2004hroot@host:~# "] * 5000
+    return [
+        ("seq", frames(run(["seq", "1", "1000000"]))),
+        ("ls -lR /usr", frames(run(["ls", "-lR", "--color=always", "/usr"]))),
+        ("build log", frames(build_log())),
+        ("random", frames(os.urandom(4 << 20))),
+        ("keystrokes", echo),
+    ]
+
+
+def measure(frames: list[bytes], deflate: "rit.ExtDeflate | None") -> tuple[int, float]:
+    t0 = time.process_time()
+    pipe = 0
+    for f in frames:
+        msg = deflate.message(f) if deflate else rit.ext_data_message(f)
+        pipe += len(rit.encode_ext_message(msg))
+    return pipe, time.process_time() - t0
+
+
+def main() -> None:
+    levels = [int(a) for a in sys.argv[1:]] or [rit.EXT_COMPRESS_LEVEL]
+    for name, frames in workloads():
+        raw = sum(map(len, frames))
+        mb = raw / 1e6
+        pipe, cpu = measure(frames, None)
+        print(f"{name:12} {mb:6.2f} MB in {len(frames)} frames")
+        print(f"  base64       pipe {pipe / raw:5.2f}x  cpu {cpu / mb * 1000:6.2f} ms/MB")
+        for level in levels:
+            pipe, cpu = measure(frames, rit.ExtDeflate(level))
+            print(
+                f"  deflate -{level}   pipe {pipe / raw:5.2f}x  cpu {cpu / mb * 1000:6.2f} ms/MB"
+            )
+
+
+if __name__ == "__main__":
+    main()
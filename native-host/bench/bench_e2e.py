@@ -0,0 +1,322 @@
+"""
+End-to-end benchmark of the native host, driven like the extension drives it.
+
+Starts run_in_terminal.py in host mode and speaks Native Messaging framing
+over its stdin/stdout. Measures, in a throwaway state directory:
+
+  open      time from "open" to the first output and to the first prompt
+  echo      keystroke -> echo round trip (p50/p99)
+  bulk      output throughput of cat, yes and seq through the whole path
+  paste     time until a large tracked paste is acked as written to the PTY
+  reattach  time for a new host to reattach and replay the session
+
+    python native-host/bench/bench_e2e.py [--json] [--compress] [--shell SH]
+                                          [--keys N] [--key-gap-ms MS]
+                                          [--bulk-mb N] [--paste-mb N]
+
+--json prints one JSON object with all results instead of the report, so runs
+can be stored and compared. The host inherits the environment, so e.g.
+RIT_ASYNCIO=1 or RIT_SUPERVISOR=1 select what is measured.
+"""
+
+import argparse
+import base64
+import json
+import os
+import platform
+import queue
+import re
+import statistics
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from pathlib import Path
+from typing import Any, Optional
+
+HOST = Path(__file__).resolve().parent.parent / "run_in_terminal.py"
+PROMPT = re.compile(rb"[#$%>] ?$")
+CSI = re.compile(rb"\x1b\[[0-9;?]*[a-zA-Z]")
+
+
+class FakeExtension:
+    """
+    One host process and its Native Messaging pipes. A reader thread decodes
+    incoming messages (inflating compressed data frames) into a queue.
+    """
+
+    def __init__(self, env: dict, compress: bool):
+        self.compress = compress
+        self.proc = subprocess.Popen(
+            [sys.executable, str(HOST)],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            env=env,
+        )
+        self.messages: "queue.Queue[Optional[dict]]" = queue.Queue()
+        self.pipe_bytes = 0
+        self.resyncs = 0
+        self._inflate = zlib.decompressobj(-zlib.MAX_WBITS)
+        threading.Thread(target=self._reader, daemon=True).start()
+
+    def _reader(self) -> None:
+        out = self.proc.stdout
+        while True:
+            hdr = out.read(4)
+            if len(hdr) < 4:
+                self.messages.put(None)
+                return
+            n = struct.unpack("<I", hdr)[0]
+            self.pipe_bytes += 4 + n
+            msg = json.loads(out.read(n))
+            if msg.get("type") == "data":
+                if "z_b64" in msg:
+                    msg["data"] = self._inflate.decompress(base64.b64decode(msg["z_b64"]))
+                else:
+                    msg["data"] = base64.b64decode(msg.get("data_b64", ""))
+            elif msg.get("type") == "resync":
+                self.resyncs += 1
+            self.messages.put(msg)
+
+    def send(self, obj: dict) -> None:
+        b = json.dumps(obj).encode("utf-8")
+        self.proc.stdin.write(struct.pack("<I", len(b)) + b)
+        self.proc.stdin.flush()
+
+    def open(self, session: str, shell: str, replay: int = 0) -> None:
+        msg = {"type": "open", "session": session, "cols": 120, "rows": 40, "replay": replay}
+        if shell:
+            msg["shell"] = shell
+        if self.compress:
+            msg["compress"] = "deflate-raw"
+        self.send(msg)
+
+    def type(self, text: bytes) -> None:
+        self.send({"type": "stdin", "data_b64": base64.b64encode(text).decode("ascii")})
+
+    def recv(self, timeout: float = 30.0) -> dict:
+        try:
+            msg = self.messages.get(timeout=timeout)
+        except queue.Empty:
+            raise TimeoutError("no message from host") from None
+        if msg is None:
+            raise EOFError("host exited")
+        return msg
+
+    def wait_data(self, done, timeout: float = 60.0) -> tuple[int, bytes]:
+        """
+        Reads data until done(tail) is true for the last 512 bytes of output.
+        Returns the number of bytes read and that tail.
+        """
+        end = time.perf_counter() + timeout
+        n, tail = 0, b""
+        while True:
+            msg = self.recv(max(0.01, end - time.perf_counter()))
+            if msg.get("type") != "data":
+                continue
+            n += len(msg["data"])
+            tail = (tail + msg["data"])[-512:]
+            if done(tail):
+                return n, tail
+
+    def wait_prompt(self, timeout: float = 30.0) -> int:
+        return self.wait_data(lambda t: PROMPT.search(CSI.sub(b"", t)), timeout)[0]
+
+    def wait_marker(self, marker: bytes, timeout: float = 120.0) -> int:
+        """
+        Reads data until marker was printed and the prompt after it shows up.
+        """
+        def done(tail: bytes) -> bool:
+            return marker in tail and bool(
+                PROMPT.search(CSI.sub(b"", tail.rsplit(marker, 1)[1]))
+            )
+
+        return self.wait_data(done, timeout)[0]
+
+    def drain(self, quiet: float = 0.3) -> None:
+        """
+        Discards messages until the host has been quiet for `quiet` seconds.
+        """
+        try:
+            while True:
+                self.recv(quiet)
+        except TimeoutError:
+            pass
+
+    def wait_type(self, t: str, timeout: float = 120.0) -> dict:
+        end = time.perf_counter() + timeout
+        while True:
+            msg = self.recv(max(0.01, end - time.perf_counter()))
+            if msg.get("type") == t:
+                return msg
+
+    def close(self, kill: bool = False) -> None:
+        try:
+            if kill:
+                self.proc.kill()
+            else:
+                self.send({"type": "close"})
+                self.proc.stdin.close()
+            self.proc.wait(5)
+        except Exception:
+            self.proc.kill()
+
+
+def percentile(samples: list[float], p: float) -> float:
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p))]
+
+
+def ms(seconds: float) -> float:
+    return round(seconds * 1000, 3)
+
+
+def bench_open(ext: FakeExtension, shell: str) -> dict:
+    t0 = time.perf_counter()
+    ext.open("e2e", shell, replay=-1)
+    ext.wait_data(lambda t: len(t) > 0)
+    first = time.perf_counter() - t0
+    ext.wait_prompt()
+    return {"first_output_ms": ms(first), "prompt_ms": ms(time.perf_counter() - t0)}
+
+
+def bench_echo(ext: FakeExtension, keys: int, gap: float) -> dict:
+    rtts = []
+    for i in range(keys):
+        time.sleep(gap)
+        key = b"abcdefghijklmnopqrstuvwxyz"[i % 26 : i % 26 + 1]
+        t0 = time.perf_counter()
+        ext.type(key)
+        ext.wait_data(lambda t: key in t, 10)
+        rtts.append(time.perf_counter() - t0)
+        if i % 60 == 59:
+            ext.type(b"\x15")  # kill the line before it wraps
+            ext.drain()
+    ext.type(b"\x15")
+    ext.drain()
+    return {
+        "keys": keys,
+        "gap_ms": ms(gap),
+        "p50_ms": ms(statistics.median(rtts)),
+        "p99_ms": ms(percentile(rtts, 0.99)),
+        "max_ms": ms(max(rtts)),
+    }
+
+
+def bench_bulk(ext: FakeExtension, state: str, mb: int) -> dict:
+    path = Path(state) / "bulk.txt"
+    line = b"%-79s\n" % b"0123456789 the quick brown fox jumps over the lazy dog"
+    path.write_bytes(line * (mb * 1_000_000 // len(line)))
+    results = {}
+    for name, cmd in (
+        ("cat", f"cat {path}"),
+        ("yes", f"yes | head -c {mb * 1_000_000}"),
+        ("seq", f"seq 1 {mb * 1_000_000 // 7}"),
+    ):
+        ext.drain()
+        resyncs, pipe0 = ext.resyncs, ext.pipe_bytes
+        t0 = time.perf_counter()
+        ext.type(f"{cmd}; echo BULK$((40+2))\n".encode())
+        n = ext.wait_marker(b"BULK42\r")
+        dt = time.perf_counter() - t0
+        results[name] = {
+            "bytes": n,
+            "seconds": round(dt, 4),
+            "mb_per_s": round(n / dt / 1e6, 2),
+            "pipe_ratio": round((ext.pipe_bytes - pipe0) / n, 3),
+            "resyncs": ext.resyncs - resyncs,
+        }
+    return results
+
+
+def bench_paste(ext: FakeExtension, mb: int) -> dict:
+    ext.type(b"cat > /dev/null\n")
+    time.sleep(0.3)
+    data = (b"%-99s\n" % b"pasted line") * (mb * 1_000_000 // 100)
+    t0 = time.perf_counter()
+    ext.send({
+        "type": "stdin",
+        "data_b64": base64.b64encode(data).decode("ascii"),
+        "id": "bench-paste",
+        "paste": True,
+    })
+    ack = ext.wait_type("stdin_ack")
+    dt = time.perf_counter() - t0
+    ext.type(b"\x04")
+    ext.drain()
+    return {
+        "bytes": len(data),
+        "seconds": round(dt, 4),
+        "mb_per_s": round(len(data) / dt / 1e6, 2),
+        "acked_bytes": ack.get("bytes"),
+        "error": ack.get("error"),
+    }
+
+
+def bench_reattach(ext: FakeExtension, env: dict, shell: str, compress: bool) -> dict:
+    ext.type(b"echo REATTACH$((6*7))\n")
+    ext.wait_marker(b"REATTACH42\r")
+    ext.close(kill=True)  # like the browser closing the tab's port
+    new = FakeExtension(env, compress)
+    t0 = time.perf_counter()
+    new.open("e2e", shell, replay=-1)
+    new.wait_type("ready")
+    ready = time.perf_counter() - t0
+    n = new.wait_marker(b"REATTACH42\r")
+    replayed = time.perf_counter() - t0
+    new.close()
+    return {"ready_ms": ms(ready), "replayed_ms": ms(replayed), "replay_bytes_seen": n}
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    ap.add_argument("--json", action="store_true", help="print results as JSON")
+    ap.add_argument("--compress", action="store_true", help='open with compress: "deflate-raw"')
+    ap.add_argument("--shell", default="/bin/bash")
+    ap.add_argument("--keys", type=int, default=200)
+    ap.add_argument("--key-gap-ms", type=float, default=20, help="pause between keystrokes")
+    ap.add_argument("--bulk-mb", type=int, default=20)
+    ap.add_argument("--paste-mb", type=int, default=4)
+    args = ap.parse_args()
+
+    results: dict[str, Any] = {
+        "timestamp": time.time(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "compress": args.compress,
+        "env": {k: v for k, v in os.environ.items() if k.startswith("RIT_")},
+    }
+    with tempfile.TemporaryDirectory(prefix="rit-bench-") as state:
+        env = dict(os.environ, XDG_STATE_HOME=state)
+        ext = FakeExtension(env, args.compress)
+        try:
+            results["open"] = bench_open(ext, args.shell)
+            results["echo"] = bench_echo(ext, args.keys, args.key_gap_ms / 1000)
+            results["bulk"] = bench_bulk(ext, state, args.bulk_mb)
+            results["paste"] = bench_paste(ext, args.paste_mb)
+            results["reattach"] = bench_reattach(ext, env, args.shell, args.compress)
+        finally:
+            ext.close(kill=True)
+            subprocess.run(["pkill", "-f", f"{HOST} --supervisor"], check=False)
+            subprocess.run(["pkill", "-f", f"{HOST} --session-daemon"], check=False)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    o, e, p, r = results["open"], results["echo"], results["paste"], results["reattach"]
+    print(f"open      first output {o['first_output_ms']:8.1f} ms  prompt {o['prompt_ms']:8.1f} ms")
+    print(f"echo      p50 {e['p50_ms']:6.2f} ms  p99 {e['p99_ms']:6.2f} ms  ({e['keys']} keys)")
+    for name, b in results["bulk"].items():
+        print(
+            f"bulk {name:4} {b['bytes'] / 1e6:6.1f} MB  {b['mb_per_s']:7.1f} MB/s  "
+            f"pipe {b['pipe_ratio']:.2f}x  resyncs {b['resyncs']}"
+        )
+    print(f"paste     {p['bytes'] / 1e6:6.1f} MB  {p['seconds'] * 1000:8.1f} ms  {p['mb_per_s']:.1f} MB/s")
+    print(f"reattach  ready {r['ready_ms']:8.1f} ms  replayed {r['replayed_ms']:8.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""
+Measures the cold start of host mode, which the browser pays for every port.
+
+Reports the slowest imports of `python -X importtime` for the host module and
+the time from process start to the "pong" of an options page ping, once with
+the file run as a script (compiled on every start) and once through -m the
+way run.sh starts it (cached bytecode).
+
+    python native-host/bench/bench_host_start.py [runs] [top]
+"""
+
+import json
+import os
+import py_compile
+import statistics
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+HOST = Path(__file__).resolve().parent.parent / "run_in_terminal.py"
+
+
+def import_times(env: dict, top: int) -> list[tuple[int, int, str]]:
+    """
+    Returns (self us, cumulative us, module) of the slowest imports.
+    """
+    out = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import run_in_terminal"],
+        cwd=HOST.parent,
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stderr
+    rows = []
+    for line in out.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cum_us, name = line[len("import time:") :].split("|")
+        rows.append((int(self_us), int(cum_us), name.rstrip()))
+    return sorted(rows, key=lambda r: -r[1])[:top]
+
+
+def ping_once(args: list[str], env: dict) -> float:
+    t0 = time.perf_counter()
+    proc = subprocess.Popen(
+        [sys.executable, *args],
+        cwd=HOST.parent,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        env=env,
+    )
+    b = json.dumps({"type": "ping"}).encode("utf-8")
+    proc.stdin.write(struct.pack("<I", len(b)) + b)
+    proc.stdin.flush()
+    n = struct.unpack("<I", proc.stdout.read(4))[0]
+    reply = json.loads(proc.stdout.read(n))
+    dt = time.perf_counter() - t0
+    proc.stdin.close()
+    proc.wait(5)
+    if reply.get("type") != "pong":
+        raise RuntimeError(f"unexpected reply {reply}")
+    return dt
+
+
+def main() -> None:
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    top = int(sys.argv[2]) if len(sys.argv) > 2 else 15
+    py_compile.compile(str(HOST), doraise=True)
+    with tempfile.TemporaryDirectory(prefix="rit-bench-") as state:
+        env = dict(os.environ, XDG_STATE_HOME=state)
+        print(f"{'self ms':>8} {'cum ms':>8}  import")
+        for self_us, cum_us, name in import_times(env, top):
+            print(f"{self_us / 1000:8.1f} {cum_us / 1000:8.1f}  {name}")
+        print()
+        for label, args in (
+            ("script", [str(HOST)]),
+            ("-m (cached)", ["-m", HOST.stem]),
+        ):
+            times = [ping_once(args, env) for _ in range(runs)]
+            print(
+                f"ping {label:12} median {statistics.median(times) * 1000:6.1f} ms  "
+                f"min {min(times) * 1000:6.1f} ms  ({runs} runs)"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+"""
+Measures the headless screen model (RIT_SCREEN_MODEL=1).
+
+Feeds typical terminal workloads through ScreenModel in 64 KiB chunks, the
+size the daemon reads from the PTY, and reports parse throughput plus the time
+and size of the snapshot a reattaching client would receive.
+
+    python native-host/bench/bench_screen.py [cols] [rows]
+"""
+
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+HERE = Path(__file__).resolve().parent
+sys.path.insert(0, str(HERE.parent))
+
+import run_in_terminal as rit  # noqa: E402
+
+CHUNK = 65536
+
+
+def workloads() -> list[tuple[str, bytes]]:
+    seq = subprocess.run(
+        ["seq", "1", "2000000"], capture_output=True, check=True
+    ).stdout.replace(b"\n", b"\r\n")
+    color = (
+        b"\x1b[0m\x1b[01;34mdir\x1b[0m  \x1b[01;32mexec.sh\x1b[0m  plain.txt  "
+        b"\x1b[38;5;208morange\x1b[0m\r\n"
+    ) * 100000
+    tui = (
+        b"\x1b[H"
+        + b"".join(
+            b"\x1b[%d;1H\x1b[7m%-70s\x1b[0m\x1b[K" % (i, b"row %d" % i)
+            for i in range(1, 24)
+        )
+    ) * 3000
+    return [("seq", seq), ("ls --color", color), ("tui redraw", tui)]
+
+
+def main() -> None:
+    cols = int(sys.argv[1]) if len(sys.argv) > 1 else 120
+    rows = int(sys.argv[2]) if len(sys.argv) > 2 else 40
+    for name, data in workloads():
+        model = rit.ScreenModel(cols, rows)
+        t0 = time.perf_counter()
+        for i in range(0, len(data), CHUNK):
+            model.feed(data[i : i + CHUNK])
+        dt = time.perf_counter() - t0
+        t1 = time.perf_counter()
+        snap = model.snapshot()
+        ds = time.perf_counter() - t1
+        print(
+            f"{name:12} {len(data) / 1e6:6.1f} MB  {len(data) / dt / 1e6:6.1f} MB/s  "
+            f"snapshot {ds * 1000:6.2f} ms {len(snap)} bytes"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""
+Measures time to first output and first prompt for new sessions.
+
+Starts the native host the way the browser does, sends an open message for a
+fresh session and times the first data message and the first output that
+ends in a prompt character. Daemon-side timings (spawn -> reachable, start ->
+first PTY output) are written to rit.log by the host and daemon.
+
+    python native-host/bench/bench_startup.py [runs] [shell]
+
+Set RIT_SUPERVISOR=1 to measure sessions opened through the supervisor.
+"""
+
+import base64
+import json
+import os
+import re
+import statistics
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+HOST = Path(__file__).resolve().parent.parent / "run_in_terminal.py"
+PROMPT = re.compile(rb"[#$%>] ?$")
+
+
+def send(proc: subprocess.Popen, obj: dict) -> None:
+    b = json.dumps(obj).encode("utf-8")
+    proc.stdin.write(struct.pack("<I", len(b)) + b)
+    proc.stdin.flush()
+
+
+def recv(proc: subprocess.Popen) -> dict:
+    hdr = proc.stdout.read(4)
+    if len(hdr) < 4:
+        raise EOFError
+    return json.loads(proc.stdout.read(struct.unpack("<I", hdr)[0]))
+
+
+def open_once(session: str, shell: str, env: dict) -> tuple[float, float]:
+    proc = subprocess.Popen(
+        [sys.executable, str(HOST)],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        env=env,
+    )
+    t0 = time.perf_counter()
+    first = None
+    out = b""
+    try:
+        send(proc, {"type": "open", "session": session, "cols": 80, "rows": 24,
+                    "replay": -1, **({"shell": shell} if shell else {})})
+        while True:
+            msg = recv(proc)
+            if msg.get("type") != "data":
+                continue
+            if first is None:
+                first = time.perf_counter() - t0
+            out = (out + base64.b64decode(msg["data_b64"]))[-256:]
+            if PROMPT.search(re.sub(rb"\x1b\[[0-9;?]*[a-zA-Z]", b"", out)):
+                return first, time.perf_counter() - t0
+    finally:
+        send(proc, {"type": "close"})
+        proc.stdin.close()
+        proc.wait(5)
+
+
+def main() -> None:
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    shell = sys.argv[2] if len(sys.argv) > 2 else ""
+    with tempfile.TemporaryDirectory(prefix="rit-bench-") as state:
+        env = dict(os.environ, XDG_STATE_HOME=state)
+        firsts, prompts = [], []
+        for i in range(runs):
+            first, prompt = open_once(f"bench{i}", shell, env)
+            firsts.append(first)
+            prompts.append(prompt)
+            print(f"run {i}: first output {first * 1000:7.1f} ms, prompt {prompt * 1000:7.1f} ms")
+            time.sleep(0.5)
+        print(f"median: first output {statistics.median(firsts) * 1000:.1f} ms, "
+              f"prompt {statistics.median(prompts) * 1000:.1f} ms")
+        log = Path(state) / "run_in_terminal" / "rit.log"
+        for line in log.read_text(encoding="utf-8").splitlines():
+            if " ms " in line and ("reachable" in line or "first output" in line):
+                print("log:", line)
+        subprocess.run(["pkill", "-f", f"{HOST} --supervisor"], check=False)
+
+
+if __name__ == "__main__":
+    main()
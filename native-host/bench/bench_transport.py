@@ -0,0 +1,90 @@
+"""
+Compares the AF_UNIX and TCP session transports.
+
+Spawns one session daemon per transport in a throwaway state directory and
+measures connect latency (try_connect incl. authkey handshake for TCP) and the
+round trip of small ping/pong control frames, which is the per-keystroke cost.
+
+    python native-host/bench/bench_transport.py [connects] [pings]
+"""
+
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+HERE = Path(__file__).resolve().parent
+sys.path.insert(0, str(HERE.parent))
+
+
+def percentiles(samples: list[float]) -> str:
+    samples = sorted(samples)
+    p50 = statistics.median(samples)
+    p99 = samples[min(len(samples) - 1, int(len(samples) * 0.99))]
+    return f"p50={p50 * 1e6:8.1f}us p99={p99 * 1e6:8.1f}us"
+
+
+def run_one(connects: int, pings: int) -> None:
+    """
+    Runs inside a child process whose environment selects the transport.
+    """
+    import run_in_terminal as rit
+
+    name = f"bench-{os.environ['RIT_TRANSPORT']}"
+    conn = rit.ensure_session(name, "/bin/sh", 80, 24)
+    conn.send({"cmd": "attach", "replay": 0, "binary": True})
+    conn.recv_bytes()  # ready
+    info = rit.read_info(name)
+    assert info
+
+    connect_times = []
+    for _ in range(connects):
+        t0 = time.perf_counter()
+        c = rit.try_connect(info)
+        connect_times.append(time.perf_counter() - t0)
+        assert c
+        c.close()
+
+    ping = rit.encode_control({"cmd": "ping"})
+    rtts = []
+    for _ in range(pings):
+        t0 = time.perf_counter()
+        conn.send_bytes(ping)
+        while rit.decode_frame(conn.recv_bytes()).get("type") != "pong":
+            pass
+        rtts.append(time.perf_counter() - t0)
+
+    where = info.path or f"{info.host}:{info.port}"
+    print(f"{os.environ['RIT_TRANSPORT']:>4} ({where})")
+    print(f"  connect    {percentiles(connect_times)}")
+    print(f"  ping rtt   {percentiles(rtts)}")
+    conn.send_bytes(rit.encode_control({"cmd": "close"}))
+    conn.close()
+
+
+def main() -> None:
+    connects = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    pings = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    if os.environ.get("RIT_BENCH_CHILD") == "1":
+        run_one(connects, pings)
+        return
+    with tempfile.TemporaryDirectory(prefix="rit-bench-") as state:
+        for transport in ("tcp", "unix"):
+            env = dict(
+                os.environ,
+                XDG_STATE_HOME=state,
+                RIT_TRANSPORT=transport,
+                RIT_BENCH_CHILD="1",
+            )
+            subprocess.run(
+                [sys.executable, __file__, str(connects), str(pings)],
+                env=env,
+                check=True,
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,5 @@
 #!/usr/bin/env bash
 
 SCRIPT_DIR=$( cd -- "$( dirname -- "${BASH_SOURCE[0]}" )" &> /dev/null && pwd )
-python3.12 $SCRIPT_DIR/run_in_terminal.py
+# -m runs the host from its cached bytecode instead of compiling the script on every start.
+cd -- "$SCRIPT_DIR" && exec python3.12 -m run_in_terminal
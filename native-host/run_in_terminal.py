@@ -1,24 +1,253 @@
 # pyright: reportExplicitAny=false
 # pyright: reportAny=false
 
+import atexit
 import base64
-from datetime import datetime
+from collections import deque
+import functools
 import json
 import os
+import struct
 import sys
 import threading
 import time
-import subprocess
-import secrets
-from dataclasses import dataclass, asdict
-from multiprocessing.connection import Connection, Listener, Client
 from pathlib import Path
-from typing import Literal, Optional, Dict, Any, Set
+from typing import (
+    Literal,
+    NamedTuple,
+    Optional,
+    Dict,
+    Any,
+    Set,
+    List,
+    Callable,
+    Tuple,
+    Deque,
+    Iterator,
+    TYPE_CHECKING,
+)
+
+# Host mode starts for every port the extension opens, so modules only the
+# daemons or later messages need (subprocess, multiprocessing.connection,
+# asyncio, selectors, socket, pickle, zlib, re and the like) are imported
+# where they are used, and regexes are compiled by the objects using them.
+if TYPE_CHECKING:
+    import asyncio
+    import re
+    import socket
+    import subprocess
+    from multiprocessing.connection import Connection, Listener
 
 IS_WIN = sys.platform == "win32"
 ENABLE_LOGGING: Literal["file"] | Literal["print"] | Literal["off"] = "file"
 
 
+def env_int(name: str, default: int) -> int:
+    """
+    Read an integer setting from the environment, falling back to default.
+    """
+    try:
+        return int(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+
+# Log levels; records below LOG_LEVEL (RIT_LOG_LEVEL=debug|info|warning|error)
+# are dropped before any formatting happens.
+DEBUG, INFO, WARNING, ERROR = 10, 20, 30, 40
+LOG_LEVEL_NAMES = {DEBUG: "debug", INFO: "info", WARNING: "warning", ERROR: "error"}
+LOG_LEVEL = {v: k for k, v in LOG_LEVEL_NAMES.items()}.get(
+    os.environ.get("RIT_LOG_LEVEL", "").lower(), INFO
+)
+# rit.log is rotated once it exceeds this size, keeping LOG_BACKUPS old files.
+LOG_MAX_BYTES = env_int("RIT_LOG_MAX_BYTES", 4 * 1024 * 1024)
+LOG_BACKUPS = 2
+# The writer thread waits this long after the first queued record to batch more.
+LOG_BATCH_DELAY = 0.05
+# At debug level only every LOG_SAMPLE-th terminal payload is logged, cut to
+# LOG_PAYLOAD_MAX characters.
+LOG_SAMPLE = max(1, env_int("RIT_LOG_SAMPLE", 16))
+LOG_PAYLOAD_MAX = 200
+# Control messages to and from the extension are logged with only these fields
+# at info level; search pages, lists and stats can run to hundreds of KB.
+LOG_MESSAGE_FIELDS = ("type", "ch", "session", "id", "cmd", "code", "error", "message")
+# Bytes of PTY output each session keeps for replay on attach.
+SCROLLBACK_BYTES = env_int("RIT_SCROLLBACK_BYTES", 1 << 20)
+# Back the scrollback with an mmap'd file under workers_dir() instead of the heap.
+SCROLLBACK_MMAP = os.environ.get("RIT_SCROLLBACK_MMAP") == "1"
+# Keep a headless VT screen model per session, so attaching clients can get
+# the current screen instead of a raw replay (attach option "screen").
+SCREEN_MODEL = os.environ.get("RIT_SCREEN_MODEL") == "1"
+# Lines scrolled off the top that the screen model keeps.
+SCREEN_HISTORY_LINES = env_int("RIT_SCREEN_HISTORY_LINES", 1000)
+# Renditions the model keeps ids for before it renumbers the ones still in use
+# and drops the rest. Its cache of parsed SGR sequences is cleared at this size.
+SCREEN_ATTRS_MAX = 4096
+# The model is fed off the output path: at most SCREEN_FEED_BYTES per event
+# loop turn, SCREEN_FEED_DELAY seconds after output. If more than
+# SCREEN_PENDING_MAX bytes are waiting, the oldest are dropped and the model
+# restarts from what is left.
+SCREEN_FEED_BYTES = 16 * 1024
+SCREEN_FEED_DELAY = 0.02
+SCREEN_PENDING_MAX = 2 * 1024 * 1024
+# Output each session keeps for the "search" command, with escape sequences
+# stripped; 0 turns search off. A full history drops its oldest quarter.
+SEARCH_HISTORY_BYTES = env_int("RIT_SEARCH_HISTORY_BYTES", 16 << 20)
+# Bytes between the (offset, line) checkpoints of the history's line index.
+SEARCH_INDEX_STRIDE = 64 * 1024
+# A search scans about this much history per event loop turn, so searching a
+# long history does not hold up the session's output.
+SEARCH_SLICE_BYTES = 1 << 20
+# Hits a search returns unless it asks for fewer, and the most it may ask for.
+SEARCH_MAX_HITS = 1000
+SEARCH_HITS_LIMIT = 10000
+# A "search" event carries at most this many hits or bytes of line text.
+SEARCH_PAGE_HITS = 50
+SEARCH_PAGE_BYTES = 256 * 1024
+# Longer lines are cut to this many bytes around the hit; at most
+# SEARCH_CONTEXT_MAX lines of context are returned before and after a hit.
+SEARCH_LINE_MAX = 512
+SEARCH_CONTEXT_MAX = 10
+# Fields of an extension "search" message passed on to the session.
+SEARCH_OPTIONS = ("id", "query", "regex", "ignore_case", "context", "max_hits", "from_line")
+# Shells the "exec" command can wrap commands for.
+EXEC_SHELLS = ("sh", "bash", "zsh", "dash", "ksh", "mksh", "ash")
+# Output an exec.done event carries at most when capture is asked for.
+EXEC_CAPTURE_MAX = 256 * 1024
+# Seconds the shell gets to parse an exec command (sh -n) before it is queued.
+EXEC_CHECK_TIMEOUT = 2
+# Fields of an extension "exec" message passed on to the session.
+EXEC_OPTIONS = ("id", "commands", "stop_on_error", "capture", "cancel")
+# Size of the data frames used to stream scrollback to an attaching client.
+REPLAY_FRAME_BYTES = 256 * 1024
+# Native Messaging caps host -> extension messages at 1 MB.
+NATIVE_MESSAGE_MAX = 1024 * 1024
+# Largest raw data chunk that still fits one Native Messaging message once
+# base64 encoded and wrapped in its JSON envelope.
+MAX_DATA_FRAME = (NATIVE_MESSAGE_MAX - 1024) // 4 * 3
+# PTY output is coalesced into one data frame for up to COALESCE_DELAY seconds
+# or COALESCE_MAX_BYTES bytes, whichever comes first.
+COALESCE_DELAY = env_int("RIT_COALESCE_DELAY_MS", 4) / 1000
+COALESCE_MAX_BYTES = min(env_int("RIT_COALESCE_MAX_BYTES", 64 * 1024), MAX_DATA_FRAME)
+# Chunks up to this size arriving while nothing is pending (keystroke echoes,
+# prompts) are sent immediately instead of waiting for the coalescing window.
+COALESCE_ECHO_BYTES = 256
+# Data frames to the extension are raw deflate compressed, one stream per host
+# connection, if it asks for it in "open". Frames smaller than
+# EXT_COMPRESS_MIN_BYTES (keystroke echo) are sent as they are.
+# RIT_EXT_COMPRESS=0 turns compression off.
+EXT_COMPRESS = os.environ.get("RIT_EXT_COMPRESS") != "0"
+EXT_COMPRESS_LEVEL = env_int("RIT_EXT_COMPRESS_LEVEL", 1)
+EXT_COMPRESS_MIN_BYTES = env_int("RIT_EXT_COMPRESS_MIN_BYTES", 512)
+# The host sends a keystroke after a quiet period right away and batches the
+# ones that follow for up to INPUT_COALESCE_DELAY seconds. Resizes are held
+# for RESIZE_DEBOUNCE seconds and a burst of them collapses to the last size.
+INPUT_COALESCE_DELAY = env_int("RIT_INPUT_COALESCE_MS", 5) / 1000
+INPUT_COALESCE_MAX_BYTES = 16 * 1024
+RESIZE_DEBOUNCE = env_int("RIT_RESIZE_DEBOUNCE_MS", 50) / 1000
+# Seconds a connecting client may take to complete the authkey handshake.
+# The handshake runs on a thread of its own, never on a daemon's event loop.
+HANDSHAKE_TIMEOUT = 2
+# Bytes read from a client per readable event; a daemon buffers partial frames
+# and serves a client's messages only once they have fully arrived.
+CLIENT_READ_CHUNK = 256 * 1024
+# Client input is queued per session and written to the PTY in chunks of at
+# most INPUT_CHUNK bytes, as fast as the shell reads them. Input with an id
+# gets a progress event every INPUT_PROGRESS_BYTES and an ack when written.
+INPUT_CHUNK = 64 * 1024
+INPUT_PROGRESS_BYTES = 256 * 1024
+INPUT_QUEUE_MAX = env_int("RIT_INPUT_QUEUE_MAX", 64 << 20)
+# Bracketed paste (DEC mode 2004) markers, used to wrap pastes while the
+# application has the mode enabled.
+PASTE_MODE_ON = b"\x1b[?2004h"
+PASTE_MODE_OFF = b"\x1b[?2004l"
+PASTE_START = b"\x1b[200~"
+PASTE_END = b"\x1b[201~"
+# Select the asyncio implementation of daemon and host (POSIX only). Also set by --asyncio.
+USE_ASYNCIO = os.environ.get("RIT_ASYNCIO") == "1" and not IS_WIN
+# Each client has its own output queue. Once more than CLIENT_COALESCE_BYTES
+# are queued, new data frames are merged into the last queued one; a client
+# more than CLIENT_QUEUE_MAX behind is sent a resync event and dropped.
+CLIENT_COALESCE_BYTES = 256 * 1024
+CLIENT_QUEUE_MAX = max(env_int("RIT_CLIENT_QUEUE_MAX", 8 << 20), 2 * SCROLLBACK_BYTES)
+# Seconds a dropped client gets to receive its resync event.
+RESYNC_GRACE = 1.0
+# Bytes an asyncio client's transport may buffer before its queue stops feeding it.
+ASYNC_WRITE_BUFFER = 64 * 1024
+# Binary wire format between daemon and clients: one type byte, then the payload.
+# Clients opt in with "binary" in their attach message; others keep pickled dicts.
+FRAME_DATA = 0x44  # "D": raw PTY output, daemon -> client
+FRAME_STDIN = 0x49  # "I": raw terminal input, client -> daemon
+FRAME_CONTROL = 0x43  # "C": JSON encoded command or event, both directions
+# Serve sessions on AF_UNIX sockets in a 0700 directory instead of authkey
+# protected TCP (every POSIX platform has AF_UNIX). RIT_TRANSPORT=tcp forces
+# the TCP listener.
+USE_UNIX_SOCKETS = not IS_WIN and os.environ.get("RIT_TRANSPORT", "unix") != "tcp"
+# sun_path is 108 bytes on Linux and 104 on macOS; longer paths fall back to TCP.
+UNIX_PATH_MAX = 100
+# Run all sessions in one long-lived supervisor daemon (POSIX only) instead of
+# one interpreter per session.
+USE_SUPERVISOR = os.environ.get("RIT_SUPERVISOR") == "1" and not IS_WIN
+# WorkerInfo name of the supervisor; the dot keeps it apart from session names.
+SUPERVISOR_NAME = ".supervisor"
+# Seconds a supervisor without sessions stays around before it exits.
+SUPERVISOR_IDLE_EXIT = env_int("RIT_SUPERVISOR_IDLE_S", 300)
+# Pre-spawned shells the supervisor keeps ready per shell, and how many seconds
+# an unused one may idle before it is evicted.
+POOL_SIZE = env_int("RIT_POOL_SIZE", 1)
+POOL_TTL = env_int("RIT_POOL_TTL_S", 600)
+# Shells kept ready besides the default one, as a comma separated list of paths.
+POOL_SHELLS = [s for s in os.environ.get("RIT_POOL_SHELLS", "").split(",") if s]
+# A shell taken from the pool is replaced once the session that took it has
+# printed something and then been quiet for POOL_REFILL_IDLE seconds, or after
+# POOL_REFILL_MAX seconds, so the spawn does not compete with a starting shell.
+POOL_REFILL_IDLE = 1.0
+POOL_REFILL_MAX = 30.0
+# Output a pooled shell may produce (its prompt) before it is handed out.
+POOL_OUTPUT_MAX = 64 * 1024
+# Seconds list waits for each session to answer its info probe.
+PROBE_TIMEOUT = 1.0
+# How long a new client may take to send its attach options before it is
+# treated as a legacy client that attaches without replay.
+ATTACH_WAIT = 0.2
+# Seconds between the stats snapshots each session writes to stats_dir(); 0 is off.
+STATS_INTERVAL = env_int("RIT_STATS_INTERVAL_S", 0)
+# Profile daemons from the start: comma separated "cpu" (cProfile of the
+# serving thread), "sample" (stack samples of all threads every
+# PROFILE_SAMPLE_INTERVAL seconds) and "mem" (tracemalloc). Profiles can also
+# be started with the "profile" command; they are written to profiles_dir()
+# on SIGUSR1, on "profile" dump and stop, and when the daemon exits.
+PROFILE_MODES = [m for m in os.environ.get("RIT_PROFILE", "").split(",") if m]
+PROFILE_SAMPLE_INTERVAL = env_int("RIT_PROFILE_SAMPLE_MS", 5) / 1000
+# Frames kept per allocation in "mem" mode. Deeper tracebacks make dumps slower.
+PROFILE_MEM_FRAMES = env_int("RIT_PROFILE_MEM_FRAMES", 1)
+# Record each session to an asciicast v2 file in recordings_dir(): output,
+# resizes and, unless RIT_RECORD_INPUT=0, what was typed into the shell.
+RECORD = os.environ.get("RIT_RECORD") == "1"
+RECORD_INPUT = os.environ.get("RIT_RECORD_INPUT", "1") != "0"
+# Bytes a recording may have queued for its writer thread. Output beyond that
+# is not recorded; a marker event in the file says how much is missing.
+RECORD_QUEUE_MAX = env_int("RIT_RECORD_QUEUE_KB", 8192) * 1024
+RECORD_BATCH_DELAY = 0.05
+# A recording's index gets an entry at least every RECORD_INDEX_BYTES of file
+# and every RECORD_INDEX_SECONDS of session time.
+RECORD_INDEX_BYTES = 256 * 1024
+RECORD_INDEX_SECONDS = 10.0
+# Session governor (POSIX), run by each session every GOVERNOR_INTERVAL seconds:
+# a session with no clients and no output or input for HIBERNATE_IDLE seconds
+# hibernates (see SessionServer.hibernate), stopping its shell with SIGSTOP
+# if RIT_HIBERNATE_STOP=1, and a session whose daemon and shell take more than
+# RSS_MAX bytes of memory closes once no client is attached. Before a new
+# session starts, the supervisor or the host spawning its daemon closes the
+# least recently active sessions without clients beyond MAX_SESSIONS - 1.
+# All policies are off by default; 0 turns one off.
+GOVERNOR_INTERVAL = max(1, env_int("RIT_GOVERNOR_INTERVAL_S", 30))
+HIBERNATE_IDLE = env_int("RIT_HIBERNATE_IDLE_S", 0)
+HIBERNATE_STOP = os.environ.get("RIT_HIBERNATE_STOP") == "1"
+MAX_SESSIONS = env_int("RIT_MAX_SESSIONS", 0)
+RSS_MAX = env_int("RIT_RSS_MAX_MB", 0) * 1024 * 1024
+
+
 def home_dir() -> str:
     """
     Return users home dir.
@@ -32,9 +261,11 @@ def home_dir() -> str:
     return os.path.expanduser("~") or os.getcwd()
 
 
+@functools.cache
 def base_dir() -> Path:
     """
     Return base dir where data is stored.
+    Like the other directories it is created and resolved once per process.
     """
     if IS_WIN:
         tmp = os.path.join(
@@ -60,6 +291,7 @@ def base_dir() -> Path:
     return p
 
 
+@functools.cache
 def workers_dir() -> Path:
     """
     Return path to all workers.
@@ -76,6 +308,79 @@ def worker_path(name: str) -> Path:
     return workers_dir() / f"{name}.json"
 
 
+def scrollback_path(name: str) -> Path:
+    """
+    Returns path to the mmap backing file of a named session's scrollback.
+    """
+    return workers_dir() / f"{name}.scrollback"
+
+
+def spill_path(name: str) -> Path:
+    """
+    Returns path to the buffers a hibernated session wrote out.
+    """
+    return hibernate_dir() / f"{name}.spill"
+
+
+@functools.cache
+def stats_dir() -> Path:
+    """
+    Return path to the periodic stats snapshots of the sessions.
+    """
+    p = base_dir() / "stats"
+    p.mkdir(parents=True, exist_ok=True)
+    return p
+
+
+@functools.cache
+def profiles_dir() -> Path:
+    """
+    Return path to the profiles dumped by daemons.
+    """
+    p = base_dir() / "profiles"
+    p.mkdir(parents=True, exist_ok=True)
+    return p
+
+
+@functools.cache
+def recordings_dir() -> Path:
+    """
+    Return path to the session recordings.
+    """
+    p = base_dir() / "recordings"
+    p.mkdir(parents=True, exist_ok=True)
+    return p
+
+
+@functools.cache
+def hibernate_dir() -> Path:
+    """
+    Return path to the buffers of hibernated sessions.
+    """
+    p = base_dir() / "hibernated"
+    p.mkdir(parents=True, exist_ok=True)
+    return p
+
+
+@functools.cache
+def sockets_dir() -> Path:
+    """
+    Return path to the session sockets. Only the user may enter it, which is
+    what authenticates clients on AF_UNIX sockets.
+    """
+    p = base_dir() / "sockets"
+    p.mkdir(mode=0o700, parents=True, exist_ok=True)
+    os.chmod(p, 0o700)
+    return p
+
+
+def socket_path(name: str) -> Path:
+    """
+    Returns path to the AF_UNIX socket of a named session.
+    """
+    return sockets_dir() / f"{name}.sock"
+
+
 def log_path() -> Path:
     """
     Return path to log file
@@ -83,21 +388,452 @@ def log_path() -> Path:
     return base_dir() / "rit.log"
 
 
-def log(l: str) -> None:
+class LogWriter:
+    """
+    Background writer behind log(). Records are queued with their timestamp and
+    formatted on the writer thread, which holds one open handle to rit.log,
+    writes in batches and rotates the file by size.
+    Several processes append to the same file; a writer that finds the file
+    rotated by another process reopens it.
+    """
+
+    def __init__(self):
+        self._reset()
+
+    def _reset(self) -> None:
+        self._cond = threading.Condition()
+        self._io_lock = threading.Lock()
+        self._queue: List[Tuple[float, int, str]] = []
+        self._thread: Optional[threading.Thread] = None
+        self._stopping = False
+        self._file: Optional[Any] = None
+        self._path: Optional[Path] = None
+
+    def put(self, level: int, line: str) -> None:
+        with self._cond:
+            self._queue.append((time.time(), level, line))
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="run_in_terminal_log_writer", daemon=True
+                )
+                self._thread.start()
+            if len(self._queue) == 1:
+                self._cond.notify()
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while not self._queue and not self._stopping:
+                    self._cond.wait()
+                if self._stopping:
+                    return
+                # Batching window; only stop() wakes us early.
+                self._cond.wait(LOG_BATCH_DELAY)
+            self.flush()
+
+    def flush(self) -> None:
+        """
+        Writes out everything queued so far on the calling thread.
+        """
+        with self._io_lock:
+            with self._cond:
+                batch, self._queue = self._queue, []
+            if not batch:
+                return
+            text = "".join(
+                f"<{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(t))}> "
+                + ("" if level == INFO else f"[{LOG_LEVEL_NAMES.get(level)}] ")
+                + f"{line}\n"
+                for t, level, line in batch
+            )
+            try:
+                f = self._open()
+                f.write(text)
+                f.flush()
+                if f.tell() > LOG_MAX_BYTES:
+                    self._rotate()
+            except OSError:
+                self._close()
+
+    def _open(self) -> Any:
+        if self._file is not None and self._path is not None:
+            try:
+                if os.stat(self._path).st_ino == os.fstat(self._file.fileno()).st_ino:
+                    return self._file
+            except OSError:
+                pass
+            self._close()
+        self._path = log_path()
+        self._file = open(self._path, "a", encoding="utf-8")
+        return self._file
+
+    def _rotate(self) -> None:
+        self._close()
+        p = log_path()
+        for i in range(LOG_BACKUPS, 0, -1):
+            src = p if i == 1 else p.with_name(f"{p.name}.{i - 1}")
+            try:
+                os.replace(src, p.with_name(f"{p.name}.{i}"))
+            except OSError:
+                pass
+
+    def _close(self) -> None:
+        if self._file is not None:
+            try:
+                self._file.close()
+            except OSError:
+                pass
+        self._file = None
+
+    def before_fork(self) -> None:
+        """
+        Stops the writer thread and drains the queue, so the process forks with
+        no writer thread and a daemonizing parent leaving through os._exit loses
+        nothing. The thread is restarted by the next put().
+        """
+        with self._cond:
+            thread, self._stopping = self._thread, True
+            self._cond.notify_all()
+        if thread:
+            thread.join()
+        self.flush()
+        with self._cond:
+            self._thread, self._stopping = None, False
+
+    def after_fork(self) -> None:
+        """
+        Starts over in the child with fresh locks and its own file handle.
+        """
+        self._close()
+        self._reset()
+
+
+_log_writer = LogWriter()
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(
+        before=_log_writer.before_fork, after_in_child=_log_writer.after_fork
+    )
+atexit.register(_log_writer.flush)
+
+
+def log(l: str, level: int = INFO) -> None:
     """
     Log any string to central log file.
     """
-    t_fmt = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    if level < LOG_LEVEL:
+        return
     if ENABLE_LOGGING == "print":
+        t_fmt = time.strftime("%Y-%m-%d %H:%M:%S")
         print(f"<{t_fmt}> {l}")
     elif ENABLE_LOGGING == "file":
-        with open(log_path(), "a+", encoding="utf-8") as f:
-            f.write(f"<{t_fmt}> {l}\n")
-            f.flush()
+        _log_writer.put(level, l)
+
+
+_payload_seq = 0
+
+
+def log_payload(prefix: str, payload: Any) -> None:
+    """
+    Logs a sample of data path traffic at debug level: every LOG_SAMPLE-th
+    payload, cut to LOG_PAYLOAD_MAX characters.
+    Callers check LOG_LEVEL <= DEBUG first so the default level costs nothing.
+    """
+    global _payload_seq
+    _payload_seq += 1
+    if _payload_seq % LOG_SAMPLE:
+        return
+    if isinstance(payload, dict) and "data_b64" in payload:
+        b64 = str(payload["data_b64"])
+        head = base64.b64decode(b64[: LOG_PAYLOAD_MAX // 3 * 4])
+        text = f"{payload.get('type')} {len(b64) // 4 * 3}B {head!r}"
+    else:
+        text = repr(payload)
+    if len(text) > LOG_PAYLOAD_MAX:
+        text = text[:LOG_PAYLOAD_MAX] + "..."
+    log(f"{prefix} #{_payload_seq}: {text}", DEBUG)
+
+
+def log_message(prefix: str, msg: Optional[Dict[str, Any]]) -> None:
+    """
+    Logs a control message to or from the extension: its LOG_MESSAGE_FIELDS at
+    info level, or all of it cut to LOG_PAYLOAD_MAX characters at debug level.
+    """
+    if LOG_LEVEL > INFO:
+        return
+    if LOG_LEVEL <= DEBUG:
+        text = repr(msg)
+        if len(text) > LOG_PAYLOAD_MAX:
+            text = text[:LOG_PAYLOAD_MAX] + "..."
+        log(f"{prefix}: {text}", DEBUG)
+    elif msg is None:
+        log(f"{prefix}: None")
+    else:
+        log(f"{prefix}: { {k: msg[k] for k in LOG_MESSAGE_FIELDS if k in msg} }")
+
+
+class Stats:
+    """
+    Counters and timers of a session daemon or a host, reported by the "stats"
+    command. Updated without a lock from the data path: an increment racing
+    one from another thread may get lost, which is fine for what they are for.
+    Rates in snapshot() are per second since the previous snapshot.
+    """
+
+    counters: Dict[str, int]
+    # name -> [count, total seconds, max seconds]
+    timers: Dict[str, List[float]]
+
+    def __init__(self):
+        self.counters = {}
+        self.timers = {}
+        self._started = time.monotonic()
+        self._last: Tuple[float, Dict[str, int]] = (self._started, {})
+
+    def add(self, name: str, n: int = 1) -> None:
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def timed(self, name: str, seconds: float) -> None:
+        t = self.timers.get(name)
+        if t is None:
+            t = self.timers[name] = [0, 0.0, 0.0]
+        t[0] += 1
+        t[1] += seconds
+        if seconds > t[2]:
+            t[2] = seconds
+
+    def snapshot(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        counters = dict(self.counters)
+        since, last = self._last
+        self._last = (now, counters)
+        dt = max(now - since, 1e-6)
+        return {
+            "uptime": round(now - self._started, 3),
+            "interval": round(dt, 3),
+            "counters": counters,
+            "rates": {k: round((v - last.get(k, 0)) / dt, 1) for k, v in counters.items()},
+            "timers": {
+                k: {
+                    "count": int(c),
+                    "total_ms": round(total * 1000, 3),
+                    "avg_ms": round(total * 1000 / c, 4) if c else 0.0,
+                    "max_ms": round(peak * 1000, 3),
+                }
+                for k, (c, total, peak) in list(self.timers.items())
+            },
+        }
+
+
+def average(total: int, count: int) -> int:
+    return total // count if count else 0
+
+
+# Stats of this host process: extension pipe and daemon connection.
+host_stats = Stats()
+
+
+def host_stats_snapshot() -> Dict[str, Any]:
+    snap = host_stats.snapshot()
+    c = snap["counters"]
+    snap["avg_ext_message_bytes"] = average(c.get("ext_bytes_out", 0), c.get("ext_messages_out", 0))
+    snap["avg_daemon_frame_bytes"] = average(c.get("daemon_bytes_in", 0), c.get("daemon_frames_in", 0))
+    return snap
+
+
+class Profiler:
+    """
+    On-demand profiling of a daemon process, i.e. of all sessions of a supervisor.
+    cpu: cProfile of the serving thread, dumped as .pstats plus a text summary
+    sample: a thread sampling the stacks of all threads, dumped as collapsed
+    stacks (.folded) for flame graph tools
+    mem: tracemalloc, dumped as a .tracemalloc snapshot plus a text summary of
+    the top allocation sites and their growth since profiling started
+    Before Python 3.12 cProfile only sees the thread that enabled it, so start(),
+    stop() and dump() run on the serving loop; SIGUSR1 is forwarded there by attach().
+    The threaded Windows server has no such loop; use "sample" there.
+    """
+
+    MODES = ("cpu", "sample", "mem")
+
+    name: str = "daemon"
+
+    def __init__(self):
+        self._cpu: Any = None
+        self._samples: Optional[Dict[str, int]] = None
+        self._sampler_stop: Optional[threading.Event] = None
+        self._mem_base: Any = None
+        self._attached = False
+
+    @property
+    def running(self) -> List[str]:
+        return [
+            mode
+            for mode, on in zip(
+                self.MODES, (self._cpu, self._samples is not None, self._mem_base)
+            )
+            if on
+        ]
+
+    def attach(self, name: str, call_soon_threadsafe: Callable[[Callable[[], None]], None]) -> None:
+        """
+        Called by a serving loop as it starts. The first call per process
+        names the dump files, routes SIGUSR1 to dump() and starts RIT_PROFILE.
+        """
+        if self._attached:
+            return
+        self._attached = True
+        self.name = name
+        import signal
+
+        if hasattr(signal, "SIGUSR1"):
+            try:
+                signal.signal(
+                    signal.SIGUSR1, lambda *_: call_soon_threadsafe(self._dump_quietly)
+                )
+            except ValueError:
+                log("Profiler: not on the main thread, SIGUSR1 not handled", WARNING)
+        if PROFILE_MODES:
+            try:
+                self.start(PROFILE_MODES)
+            except ValueError as e:
+                log(f"Profiler: RIT_PROFILE ignored ({e})", WARNING)
+
+    def start(self, modes: List[str]) -> None:
+        unknown = set(modes) - set(self.MODES)
+        if unknown:
+            raise ValueError(f"unknown profile modes {sorted(unknown)}")
+        if "cpu" in modes and not self._cpu:
+            import cProfile
+
+            self._cpu = cProfile.Profile()
+            self._cpu.enable()
+        if "sample" in modes and self._samples is None:
+            self._samples = {}
+            self._sampler_stop = threading.Event()
+            threading.Thread(
+                target=self._sample_loop,
+                args=(self._sampler_stop, self._samples),
+                name="run_in_terminal_profile_sampler",
+                daemon=True,
+            ).start()
+        if "mem" in modes and not self._mem_base:
+            import tracemalloc
+
+            tracemalloc.start(PROFILE_MEM_FRAMES)
+            self._mem_base = tracemalloc.take_snapshot()
+        log(f"Profiler: running {self.running}")
+
+    def stop(self, modes: Optional[List[str]] = None) -> List[str]:
+        """
+        Dumps, then stops the given modes (all by default). Returns the files written.
+        """
+        files = self.dump()
+        modes = modes or list(self.MODES)
+        if "cpu" in modes and self._cpu:
+            self._cpu.disable()
+            self._cpu = None
+        if "sample" in modes and self._sampler_stop:
+            self._sampler_stop.set()
+            self._sampler_stop = None
+            self._samples = None
+        if "mem" in modes and self._mem_base:
+            import tracemalloc
+
+            tracemalloc.stop()
+            self._mem_base = None
+        log(f"Profiler: running {self.running}")
+        return files
+
+    def dump(self) -> List[str]:
+        """
+        Writes what the running modes collected so far to profiles_dir().
+        Profiling continues. Returns the files written.
+        """
+        stem = str(profiles_dir() / f"{self.name}-{os.getpid()}-{time.strftime('%Y%m%d-%H%M%S')}")
+        files = []
+        if self._cpu:
+            import io
+            import pstats
+
+            self._cpu.dump_stats(stem + ".pstats")
+            out = io.StringIO()
+            pstats.Stats(self._cpu, stream=out).sort_stats("cumulative").print_stats(60)
+            self._cpu.enable()  # dump_stats() disables it
+            Path(stem + "-cpu.txt").write_text(out.getvalue(), encoding="utf-8")
+            files += [stem + ".pstats", stem + "-cpu.txt"]
+        if self._samples is not None:
+            lines = [f"{stack} {n}" for stack, n in list(self._samples.items())]
+            Path(stem + ".folded").write_text("\n".join(lines) + "\n", encoding="utf-8")
+            files.append(stem + ".folded")
+        if self._mem_base:
+            import tracemalloc
+
+            snap = tracemalloc.take_snapshot()
+            snap.dump(stem + ".tracemalloc")
+            current, peak = tracemalloc.get_traced_memory()
+            lines = [f"traced {current} bytes, peak {peak} bytes", "", "top allocation sites:"]
+            lines += [str(st) for st in snap.statistics("lineno")[:30]]
+            lines += ["", "growth since start:"]
+            lines += [str(st) for st in snap.compare_to(self._mem_base, "lineno")[:30]]
+            Path(stem + "-mem.txt").write_text("\n".join(lines) + "\n", encoding="utf-8")
+            files += [stem + ".tracemalloc", stem + "-mem.txt"]
+        if files:
+            log(f"Profiler: wrote {files}")
+        return files
 
+    def _dump_quietly(self) -> None:
+        try:
+            self.dump()
+        except Exception as e:
+            log(f"Profiler: dump failed ({e})", ERROR)
+
+    def _sample_loop(self, stop: threading.Event, samples: Dict[str, int]) -> None:
+        me = threading.get_ident()
+        labels: Dict[Any, str] = {}
+        while not stop.wait(PROFILE_SAMPLE_INTERVAL):
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    label = labels.get(code)
+                    if label is None:
+                        label = labels[code] = (
+                            f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+                        )
+                    stack.append(label)
+                    frame = frame.f_back
+                key = ";".join(reversed(stack))
+                samples[key] = samples.get(key, 0) + 1
+
+
+profiler = Profiler()
+
+
+def profile_reply(msg: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Executes a "profile" command: action start, stop, dump or status (the
+    default). start defaults to the RIT_PROFILE modes or ["cpu"], stop to all.
+    """
+    action = msg.get("action") or "status"
+    modes = list(msg.get("modes") or [])
+    files: List[str] = []
+    try:
+        if action == "start":
+            profiler.start(modes or PROFILE_MODES or ["cpu"])
+        elif action == "stop":
+            files = profiler.stop(modes or None)
+        elif action == "dump":
+            files = profiler.dump()
+        elif action != "status":
+            raise ValueError(f"unknown action {action}")
+    except Exception as e:
+        return {"type": "profile", "error": str(e), "running": profiler.running}
+    return {"type": "profile", "running": profiler.running, "files": files}
 
-@dataclass
-class WorkerInfo:
+
+class WorkerInfo(NamedTuple):
     """
     Serializable coordinates for a live session daemon.
     name: unique session name
@@ -106,6 +842,7 @@ class WorkerInfo:
     port: listening port number
     authkey_b64: urlsafe base64 of the authentication key used by multiprocessing.connection
     started_at: unix timestamp when the daemon published itself
+    path: AF_UNIX socket of the daemon; when set, host, port and authkey are unused
     """
 
     name: str
@@ -114,12 +851,13 @@ class WorkerInfo:
     port: int
     authkey_b64: str
     started_at: float
+    path: Optional[str] = None
 
 
 def write_info(info: WorkerInfo) -> None:
     p = worker_path(info.name)
     tmp = p.with_suffix(".tmp")
-    data = json.dumps(asdict(info), separators=(",", ":"), ensure_ascii=True).encode(
+    data = json.dumps(info._asdict(), separators=(",", ":"), ensure_ascii=True).encode(
         "utf-8"
     )
     with open(tmp, "wb") as f:
@@ -129,6 +867,39 @@ def write_info(info: WorkerInfo) -> None:
     os.replace(tmp, p)
 
 
+def write_stats(name: str, stats: Dict[str, Any]) -> None:
+    """
+    Atomically replaces the stats snapshot file of a named session.
+    """
+    p = stats_dir() / f"{name}.json"
+    tmp = p.with_suffix(".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(stats, f, separators=(",", ":"))
+    os.replace(tmp, p)
+
+
+def remove_stats(name: str) -> None:
+    try:
+        (stats_dir() / f"{name}.json").unlink()
+    except OSError:
+        pass
+
+
+def info_from_dict(obj: Dict[str, Any]) -> WorkerInfo:
+    """
+    Builds WorkerInfo from its JSON form, tolerating files from older versions.
+    """
+    return WorkerInfo(
+        name=obj["name"],
+        pid=int(obj["pid"]),
+        host=str(obj["host"]),
+        port=int(obj["port"]),
+        authkey_b64=str(obj["authkey_b64"]),
+        started_at=float(obj["started_at"]),
+        path=obj.get("path"),
+    )
+
+
 def read_info(name: str) -> Optional[WorkerInfo]:
     """
     Read info file, if it exists.
@@ -137,17 +908,11 @@ def read_info(name: str) -> Optional[WorkerInfo]:
     p = worker_path(name)
     try:
         with open(p, "rb") as f:
-            obj = json.loads(f.read().decode("utf-8"))
-            return WorkerInfo(
-                name=obj["name"],
-                pid=int(obj["pid"]),
-                host=str(obj["host"]),
-                port=int(obj["port"]),
-                authkey_b64=str(obj["authkey_b64"]),
-                started_at=float(obj["started_at"]),
-            )
+            return info_from_dict(json.loads(f.read().decode("utf-8")))
+    except FileNotFoundError:
+        return None
     except Exception as e:
-        log(f"Failed reading info file for {name}. ({e})")
+        log(f"Failed reading info file for {name}. ({e})", WARNING)
         return None
 
 
@@ -160,142 +925,770 @@ def remove_info(name: str) -> None:
     try:
         p.unlink()
     except Exception as e:
-        log(f"Failed removing info file for {name}. ({e})")
+        log(f"Failed removing info file for {name}. ({e})", WARNING)
 
 
-def decode_authkey(b64: str) -> bytes:
-    return base64.urlsafe_b64decode(b64.encode("ascii"))
+def process_start_time(pid: int) -> Optional[float]:
+    """
+    Returns the unix time pid started at, where the platform tells (Linux /proc).
+    """
+    try:
+        with open(f"/proc/{pid}/stat", "rb") as f:
+            stat = f.read()
+        # comm may contain spaces and parentheses; fields resume after the last ")".
+        ticks = int(stat.rsplit(b")", 1)[1].split()[19])
+        with open("/proc/stat", "rb") as f:
+            for line in f:
+                if line.startswith(b"btime "):
+                    return int(line.split()[1]) + ticks / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
 
 
-def try_connect(info: WorkerInfo) -> Optional[Connection]:
+def process_rss(pid: int) -> Optional[int]:
     """
-    Tries to connect to given daemon worker.
-    Returns a Client connection, if successful
+    Returns the resident memory of pid in bytes, where the platform tells (Linux /proc).
     """
     try:
-        conn = Client((info.host, info.port), authkey=decode_authkey(info.authkey_b64))
-        return conn
-    except Exception as e:
-        log(f"Failed to connect to {info.name} on {info.host}:{info.port} ({e})")
+        with open(f"/proc/{pid}/statm", "rb") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
 
 
-def spawn_detached_daemon(
-    name: str, shell: Optional[str], cols: int, rows: int
-) -> None:
+def release_memory() -> None:
     """
-    Spawns a detached child process => Runs this with `--ssesion-daemon`
+    Collects garbage and hands free heap memory back to the OS, which glibc
+    only does on its own for large blocks.
     """
-    exe = sys.executable
-    this = str(Path(__file__).resolve())
-    shell_arg = shell if shell else "_"
-    args = [
-        exe,
-        this,
-        "--session-daemon",
-        name,
-        shell_arg,
-        str(cols),
-        str(rows),
-    ]
-    if IS_WIN:
-        CREATE_NEW_PROCESS_GROUP = 0x00000200
-        DETACHED_PROCESS = 0x00000008
-        creationflags = CREATE_NEW_PROCESS_GROUP | DETACHED_PROCESS
-        subprocess.Popen(args, creationflags=creationflags, close_fds=True)
-    else:
-        subprocess.Popen(args, close_fds=True)
+    import gc
 
+    gc.collect()
+    if sys.platform.startswith("linux"):
+        try:
+            import ctypes
 
-def ensure_session(
-    name: str, shell: Optional[str], cols: int, rows: int, timeout: float = 5.0
-) -> Connection:
+            ctypes.CDLL(None).malloc_trim(0)
+        except (OSError, AttributeError):
+            pass
+
+
+def info_alive(info: WorkerInfo) -> bool:
     """
-    Connects to a session, if it exists.
-    Will create one and then connect otherwise.
+    Cheap liveness check for a published daemon, without connecting to it.
+    False if its pid is gone or has been reused by a process started later.
     """
-    info = read_info(name)
-    if info:
-        conn = try_connect(info)
-        if conn:
-            return conn
-    spawn_detached_daemon(name, shell, cols, rows)
-    # wait for session to self-publish
-    deadline = time.time() + timeout
-    while time.time() < deadline:
-        info = read_info(name)
-        if info:
-            conn = try_connect(info)
-            if conn:
-                log(f"Session for {name} created and reachable.")
-                return conn
-        time.sleep(timeout / 100)
+    if IS_WIN:
+        # os.kill would terminate the process on Windows; let connecting decide.
+        return True
+    try:
+        os.kill(info.pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    start = process_start_time(info.pid)
+    # A daemon starts before it publishes; btime and tick rounding add some slack.
+    return start is None or start <= info.started_at + 1.0
 
-    log(f"Session for {name} was not reachable after {timeout}s. Abort!")
-    raise RuntimeError(f"Session for {name} was not reachable after {timeout}s. Abort!")
+
+def gc_info(info: WorkerInfo) -> None:
+    """
+    Removes everything a dead daemon left behind: its info file, its own socket
+    and its scrollback file.
+    """
+    log(f"Collecting stale session {info.name} (pid {info.pid})")
+    remove_info(info.name)
+    stale = [scrollback_path(info.name)]
+    if info.path and Path(info.path) == socket_path(info.name):
+        stale.append(Path(info.path))
+    for p in stale:
+        try:
+            p.unlink()
+        except OSError:
+            pass
 
 
-def read_from_ext() -> Optional[Dict[str, Any]]:
+def read_live_info(name: str) -> Optional[WorkerInfo]:
     """
-    Reads one Native Messaging JSON message from stdin. Returns None on EOF.
+    read_info() for daemons that are still running; stale entries are collected.
     """
-    hdr = sys.stdin.buffer.read(4)
-    if not hdr:
-        return None
-    n = int.from_bytes(hdr, "little")
-    data = sys.stdin.buffer.read(n)
-    try:
-        return json.loads(data.decode("utf-8"))
-    except Exception:
-        log(f"Received invalid json from native host: \n{data}")
+    info = read_info(name)
+    if info and not info_alive(info):
+        gc_info(info)
         return None
+    return info
 
 
-def send_to_ext(obj: Dict[str, Any]) -> None:
+def registered_sessions() -> List[WorkerInfo]:
     """
-    Sends one Native Messaging JSON message to stdout.
+    Returns the info of every running session, collecting stale entries.
     """
-    if obj.__contains__("data_b64"):
-        log(f"NAT: {base64.b64decode(obj["data_b64"])}")
-    else:
-        log(f"NAT: {obj}")
-    b = json.dumps(obj, separators=(",", ":"), ensure_ascii=True).encode("utf-8")
-    sys.stdout.buffer.write(len(b).to_bytes(4, "little"))
-    sys.stdout.buffer.write(b)
-    sys.stdout.buffer.flush()
+    infos = []
+    for p in sorted(workers_dir().glob("*.json")):
+        if p.name.startswith("."):
+            continue
+        info = read_live_info(p.stem)
+        if info:
+            infos.append(info)
+    return infos
 
 
-def forward_chunk_to_ext(b64_bs: bytes) -> None:
+def probe_session(info: WorkerInfo) -> Optional[Dict[str, Any]]:
     """
-    Forwards an already encoded data chunk to the extsnsion as a base64 JSON message.
+    Asks a session for its info event. Returns None if it does not answer
+    within PROBE_TIMEOUT.
     """
-    send_to_ext({"type": "data", "data_b64": b64_bs})
+    return query_session(info, {"cmd": "info"}, "info")
 
 
-def send_chunk_to_ext(bs: bytes) -> None:
+def query_session(
+    info: WorkerInfo,
+    query: Dict[str, Any],
+    reply_type: str,
+    timeout: float = PROBE_TIMEOUT,
+) -> Optional[Dict[str, Any]]:
     """
-    Sends a terminal data chunk to the extension as a base64 JSON message.
+    Sends one command to a session and returns its reply event of reply_type,
+    or None if it does not answer within timeout.
     """
-    send_to_ext({"type": "data", "data_b64": base64.b64encode(bs).decode("ascii")})
+    conn = try_connect(info)
+    if not conn:
+        return None
+    try:
+        # A probe never makes a supervisor create the session.
+        conn.send({"cmd": "attach", "session": info.name, "binary": True, "probe": True})
+        if not conn.poll(timeout):
+            return None
+        ready = conn.recv_bytes()
+        if is_binary_frame(ready):
+            conn.send_bytes(encode_control(query))
+        else:
+            conn.send(query)
+        deadline = time.monotonic() + timeout
+        while conn.poll(max(0.0, deadline - time.monotonic())):
+            msg = decode_frame(conn.recv_bytes())
+            if isinstance(msg, dict) and msg.get("type") == reply_type:
+                return msg
+        return None
+    except Exception as e:
+        log(f"Probing session {info.name} failed ({e})", WARNING)
+        return None
+    finally:
+        conn.close()
 
 
-class DaemonClient:
+def probe_sessions() -> List[Tuple[WorkerInfo, Dict[str, Any]]]:
     """
-    Host-side bridge to a persistent session daemon.
+    Probes all registered sessions in parallel. Returns the info and answer
+    of each one that answers.
     """
+    from concurrent.futures import ThreadPoolExecutor
 
-    session_name: str
-    conn: Optional[Connection] = None
-    _reader_thread: Optional[threading.Thread] = None
-    _close_event: threading.Event = threading.Event()
+    infos = registered_sessions()
+    if not infos:
+        return []
+    with ThreadPoolExecutor(max_workers=min(16, len(infos))) as pool:
+        answers = list(pool.map(probe_session, infos))
+    return [(info, answer) for info, answer in zip(infos, answers) if answer is not None]
 
-    def __init__(self, session_name: str):
-        self.session_name = session_name
 
-    def connect_or_spawn(self, shell: Optional[str], cols: int, rows: int) -> None:
-        """
-        Connect to an existing session or spawn and connect
+def list_sessions() -> List[Dict[str, Any]]:
+    """
+    Probes all registered sessions in parallel and summarizes the ones that answer.
+    """
+    sessions = []
+    for info, answer in probe_sessions():
+        sessions.append(
+            {
+                "name": info.name,
+                "pid": info.pid,
+                "uptime": answer.get("uptime"),
+                "clients": answer.get("clients"),
+                "shell": answer.get("shell"),
+                "idle": answer.get("idle"),
+                "hibernated": answer.get("hibernated", False),
+            }
+        )
+    return sessions
+
+
+def make_room_for_session() -> None:
+    """
+    Closes the least recently active sessions without clients until one more
+    fits under MAX_SESSIONS. The host calls this before it spawns a session
+    daemon; the supervisor checks its own sessions instead.
+    """
+    sessions = probe_sessions()
+    excess = len(sessions) + 1 - MAX_SESSIONS
+    if excess <= 0:
+        return
+    idle = [(info, answer) for info, answer in sessions if not answer.get("clients")]
+    idle.sort(key=lambda s: -(s[1].get("idle") or 0.0))
+    limit = f"RIT_MAX_SESSIONS={MAX_SESSIONS}"
+    reason = f"least recently active of {len(sessions)} sessions, {limit}"
+    for info, _ in idle[:excess]:
+        query_session(info, {"cmd": "reap", "reason": reason}, "reaped")
+    if len(idle) < excess:
+        log(f"{len(sessions) - len(idle)} sessions with clients exceed {limit}", WARNING)
+
+
+def decode_authkey(b64: str) -> bytes:
+    return base64.urlsafe_b64decode(b64.encode("ascii"))
+
+
+def try_connect(info: WorkerInfo) -> Optional["Connection"]:
+    """
+    Tries to connect to given daemon worker.
+    Returns a Client connection, if successful
+    """
+    from multiprocessing.connection import Client
+
+    try:
+        if info.path:
+            # Access to sockets_dir() is the authentication; no challenge round trips.
+            return Client(info.path, family="AF_UNIX")
+        conn = Client((info.host, info.port), authkey=decode_authkey(info.authkey_b64))
+        return conn
+    except Exception as e:
+        where = info.path or f"{info.host}:{info.port}"
+        log(f"Failed to connect to {info.name} on {where} ({e})", WARNING)
+
+
+# Runs this file as __main__ from its cached bytecode instead of compiling the
+# whole script on every spawn. The path stays on the command line as argv[0]
+# and replaces the -c entry of sys.path, as if the file was run directly.
+SPAWN_LAUNCHER = (
+    "import os, runpy, sys; del sys.argv[0]; sys.path[0] = os.path.dirname(sys.argv[0]); "
+    "runpy.run_module({!r}, run_name='__main__', alter_sys=True)"
+)
+
+
+def spawn_detached(args: List[str]) -> Optional[int]:
+    """
+    Spawns a detached child process running this file with the given arguments.
+    On POSIX returns the read end of a pipe the daemon writes its WorkerInfo to
+    as soon as it is reachable (see notify_ready), else None.
+    """
+    import subprocess
+
+    exe = sys.executable
+    this = Path(__file__).resolve()
+    args = [exe, "-c", SPAWN_LAUNCHER.format(this.stem), str(this), *args]
+    if IS_WIN:
+        CREATE_NEW_PROCESS_GROUP = 0x00000200
+        DETACHED_PROCESS = 0x00000008
+        creationflags = CREATE_NEW_PROCESS_GROUP | DETACHED_PROCESS
+        subprocess.Popen(args, creationflags=creationflags, close_fds=True)
+        return None
+    r, w = os.pipe()
+    env = dict(os.environ, RIT_READY_FD=str(w), RIT_SPAWNED_AT=repr(time.time()))
+    try:
+        subprocess.Popen(args, close_fds=True, pass_fds=(w,), env=env)
+    except Exception:
+        os.close(r)
+        raise
+    finally:
+        os.close(w)
+    return r
+
+
+def spawn_detached_daemon(
+    name: str, shell: Optional[str], cols: int, rows: int
+) -> Optional[int]:
+    """
+    Spawns a detached child process => Runs this with `--ssesion-daemon`
+    """
+    shell_arg = shell if shell else "_"
+    return spawn_detached(["--session-daemon", name, shell_arg, str(cols), str(rows)])
+
+
+def wait_ready(fd: int, timeout: float) -> Optional[WorkerInfo]:
+    """
+    Waits on a ready pipe from spawn_detached() for the daemon's WorkerInfo.
+    Returns None if the daemon exits or times out without reporting. Closes fd.
+    """
+    import select
+
+    deadline = time.monotonic() + timeout
+    buf = b""
+    try:
+        while not buf.endswith(b"\n"):
+            left = deadline - time.monotonic()
+            if left <= 0 or not select.select([fd], [], [], left)[0]:
+                return None
+            chunk = os.read(fd, 4096)
+            if not chunk:
+                return None
+            buf += chunk
+        return info_from_dict(json.loads(buf.decode("utf-8")))
+    except (OSError, ValueError, KeyError) as e:
+        log(f"Invalid ready notification ({e})", WARNING)
+        return None
+    finally:
+        os.close(fd)
+
+
+_ready_fd: Optional[int] = None
+_spawned_at: Optional[float] = None
+
+
+def take_ready_fd() -> None:
+    """
+    Claims the ready pipe passed by spawn_detached(), so it is neither
+    inherited by shells nor visible in their environment.
+    """
+    global _ready_fd, _spawned_at
+    fd = os.environ.pop("RIT_READY_FD", None)
+    spawned_at = os.environ.pop("RIT_SPAWNED_AT", None)
+    if fd is not None and fd.isdigit():
+        _ready_fd = int(fd)
+        os.set_inheritable(_ready_fd, False)
+    try:
+        _spawned_at = float(spawned_at) if spawned_at else None
+    except ValueError:
+        pass
+
+
+def notify_ready(info: WorkerInfo) -> None:
+    """
+    Reports info on the ready pipe, if this daemon was given one, and logs how
+    long the daemon took to become reachable since it was spawned.
+    """
+    global _ready_fd
+    if _ready_fd is None:
+        return
+    fd, _ready_fd = _ready_fd, None
+    try:
+        os.write(fd, json.dumps(info._asdict()).encode("utf-8") + b"\n")
+    except OSError as e:
+        log(f"Failed to notify spawner of {info.name} ({e})", WARNING)
+    finally:
+        os.close(fd)
+    if _spawned_at is not None:
+        ms = (time.time() - _spawned_at) * 1000
+        log(f"Daemon {info.name} reachable {ms:.1f} ms after spawn")
+
+
+def connect_or_spawn_daemon(
+    name: str, spawn: Callable[[], Optional[int]], timeout: float
+) -> "Connection":
+    """
+    Connects to the daemon published as name, calling spawn() to start it first
+    if it is not reachable.
+    """
+    info = read_live_info(name)
+    if info:
+        conn = try_connect(info)
+        if conn:
+            return conn
+    t0 = time.perf_counter()
+    ready_fd = spawn()
+    if ready_fd is not None:
+        info = wait_ready(ready_fd, timeout)
+        conn = try_connect(info) if info else None
+        if conn:
+            ms = (time.perf_counter() - t0) * 1000
+            log(f"Daemon for {name} created and reachable after {ms:.1f} ms.")
+            return conn
+    # No ready notification (Windows, or another daemon won a race): wait for
+    # the daemon to self-publish
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        info = read_info(name)
+        if info:
+            conn = try_connect(info)
+            if conn:
+                log(f"Daemon for {name} created and reachable.")
+                return conn
+        time.sleep(timeout / 100)
+
+    log(f"Session for {name} was not reachable after {timeout}s. Abort!", ERROR)
+    raise RuntimeError(f"Session for {name} was not reachable after {timeout}s. Abort!")
+
+
+def ensure_session(
+    name: str, shell: Optional[str], cols: int, rows: int, timeout: float = 5.0
+) -> "Connection":
+    """
+    Connects to a session, if it exists.
+    Will create one and then connect otherwise.
+    In supervisor mode new sessions are created by the supervisor when the
+    attach message names them, so only the supervisor itself may need spawning.
+    """
+    if USE_SUPERVISOR:
+        info = read_live_info(name)
+        conn = try_connect(info) if info else None
+        if conn:
+            return conn
+        return connect_or_spawn_daemon(
+            SUPERVISOR_NAME, lambda: spawn_detached(["--supervisor"]), timeout
+        )
+
+    def spawn() -> Optional[int]:
+        if MAX_SESSIONS:
+            make_room_for_session()
+        return spawn_detached_daemon(name, shell, cols, rows)
+
+    return connect_or_spawn_daemon(name, spawn, timeout)
+
+
+def attach_message(
+    session: str,
+    shell: Optional[str],
+    cols: int,
+    rows: int,
+    replay: int,
+    screen: bool = False,
+) -> Dict[str, Any]:
+    """
+    Builds the first message a host sends after connecting. Session daemons
+    only use replay, screen and binary; a supervisor also routes by session and
+    creates the session from shell, cols and rows if it does not exist yet.
+    screen: prefer a snapshot of the session's screen model over replay
+    """
+    msg = {
+        "cmd": "attach",
+        "session": session,
+        "shell": shell,
+        "cols": int(cols),
+        "rows": int(rows),
+        "replay": int(replay),
+        "binary": True,
+    }
+    if screen:
+        msg["screen"] = True
+    return msg
+
+
+_stdout_lock = threading.Lock()
+
+
+def read_from_ext() -> Optional[Dict[str, Any]]:
+    """
+    Reads one Native Messaging JSON message from stdin. Returns None on EOF.
+    """
+    hdr = sys.stdin.buffer.read(4)
+    if not hdr:
+        return None
+    n = int.from_bytes(hdr, "little")
+    host_stats.add("ext_messages_in")
+    host_stats.add("ext_bytes_in", 4 + n)
+    return decode_ext_message(sys.stdin.buffer.read(n))
+
+
+def read_stdin_exact(n: int) -> bytes:
+    """
+    Reads n bytes from fd 0 without buffering ahead, so the asyncio host can
+    take over the pipe afterwards. Returns b"" on EOF.
+    """
+    buf = b""
+    while len(buf) < n:
+        chunk = os.read(0, n - len(buf))
+        if not chunk:
+            return b""
+        buf += chunk
+    return buf
+
+
+def answer_pings() -> Optional[Dict[str, Any]]:
+    """
+    Cold path of host mode: answers "ping" before anything else is set up, so a
+    ping from the options page costs a process start and no session machinery.
+    Returns the first message that is not a ping, or None on EOF.
+    """
+    while True:
+        hdr = read_stdin_exact(4)
+        if not hdr:
+            return None
+        data = read_stdin_exact(int.from_bytes(hdr, "little"))
+        host_stats.add("ext_messages_in")
+        host_stats.add("ext_bytes_in", 4 + len(data))
+        msg = decode_ext_message(data)
+        if not msg or msg.get("type") != "ping":
+            return msg
+        log_message("EXT", msg)
+        send_to_ext({"type": "pong"})
+
+
+def decode_ext_message(data: bytes) -> Optional[Dict[str, Any]]:
+    """
+    Parses the JSON body of one Native Messaging message. Returns None if invalid.
+    """
+    try:
+        return json.loads(data.decode("utf-8"))
+    except Exception:
+        log(f"Received invalid json from native host: \n{data}", WARNING)
+        return None
+
+
+def encode_ext_message(obj: Dict[str, Any]) -> bytes:
+    """
+    Logs and encodes one Native Messaging JSON message including its length prefix.
+    """
+    if "data_b64" in obj or "z_b64" in obj:
+        if LOG_LEVEL <= DEBUG:
+            log_payload("NAT", obj)
+    else:
+        log_message("NAT", obj)
+    t0 = time.perf_counter()
+    b = json.dumps(obj, separators=(",", ":"), ensure_ascii=True).encode("utf-8")
+    host_stats.timed("ext_encode", time.perf_counter() - t0)
+    host_stats.add("ext_messages_out")
+    host_stats.add("ext_bytes_out", 4 + len(b))
+    return len(b).to_bytes(4, "little") + b
+
+
+def send_to_ext(obj: Dict[str, Any]) -> None:
+    """
+    Sends one Native Messaging JSON message to stdout.
+    """
+    b = encode_ext_message(obj)
+    # The daemon reader thread and the main loop both write; frames must not interleave.
+    with _stdout_lock:
+        sys.stdout.buffer.write(b)
+        sys.stdout.buffer.flush()
+
+
+def on_channel(msg: Dict[str, Any], channel: Any) -> Dict[str, Any]:
+    """
+    Tags a message for the extension with the channel it belongs to. One host
+    can serve many sessions, one per channel; messages from the extension
+    name theirs in "ch", and messages without one use the None channel.
+    """
+    if channel is not None:
+        msg["ch"] = channel
+    return msg
+
+
+def daemon_command(cmd: str, msg: Dict[str, Any], fields: Tuple[str, ...]) -> Dict[str, Any]:
+    """
+    Turns an extension message into a daemon command with the given fields of it.
+    """
+    return {"cmd": cmd, **{k: msg[k] for k in fields if k in msg}}
+
+
+def send_chunk_to_ext(
+    bs: bytes, deflate: Optional["ExtDeflate"] = None, channel: Any = None
+) -> None:
+    """
+    Sends a terminal data chunk to the extension as a base64 JSON message.
+    deflate: compress it with this channel's deflate stream
+    """
+    if not deflate:
+        send_to_ext(on_channel(ext_data_message(bs), channel))
+        return
+    # Frames must reach the extension in the order they went through the stream.
+    with _stdout_lock:
+        sys.stdout.buffer.write(encode_ext_message(on_channel(deflate.message(bs), channel)))
+        sys.stdout.buffer.flush()
+
+
+def ext_data_message(bs: bytes) -> Dict[str, Any]:
+    """
+    Wraps raw terminal output for the extension. Base64 is only ever applied here,
+    at the Native Messaging edge; the daemon sends raw bytes in binary frames.
+    """
+    t0 = time.perf_counter()
+    b64 = base64.b64encode(bs).decode("ascii")
+    host_stats.timed("data_encode", time.perf_counter() - t0)
+    return {"type": "data", "data_b64": b64}
+
+
+class ExtDeflate:
+    """
+    Raw deflate stream for the data frames sent on one extension channel,
+    negotiated with compress: "deflate-raw" in "open". Every frame ends with a
+    sync flush, so the extension can inflate it as soon as it arrives, while the
+    32 KiB window carries over from frame to frame. Frames below min_bytes are
+    sent uncompressed and never enter the stream, and so are the next
+    SKIP_FRAMES frames after one that did not compress (binary or already
+    compressed output).
+    """
+
+    MODE = "deflate-raw"
+    SKIP_FRAMES = 16
+
+    min_bytes: int
+    _skip: int = 0
+
+    def __init__(
+        self, level: int = EXT_COMPRESS_LEVEL, min_bytes: int = EXT_COMPRESS_MIN_BYTES
+    ):
+        import zlib
+
+        self.min_bytes = min_bytes
+        self._z = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        self._sync_flush = zlib.Z_SYNC_FLUSH
+
+    @classmethod
+    def negotiate(cls, msg: Dict[str, Any]) -> Optional["ExtDeflate"]:
+        """
+        The deflate stream for an "open" message that asks for one, else None.
+        """
+        if EXT_COMPRESS and msg.get("compress") == cls.MODE:
+            return cls()
+        return None
+
+    def message(self, bs: bytes) -> Dict[str, Any]:
+        """
+        The data message for bs: {"type": "data", "z_b64": ..., "n": len(bs)}
+        when compressed, a plain ext_data_message otherwise.
+        """
+        if len(bs) < self.min_bytes:
+            return ext_data_message(bs)
+        if self._skip:
+            self._skip -= 1
+            return ext_data_message(bs)
+        t0 = time.perf_counter()
+        z = self._z.compress(bs) + self._z.flush(self._sync_flush)
+        b64 = base64.b64encode(z).decode("ascii")
+        host_stats.timed("data_encode", time.perf_counter() - t0)
+        host_stats.add("deflate_bytes_in", len(bs))
+        host_stats.add("deflate_bytes_out", len(z))
+        if len(z) > len(bs) * 0.9:
+            self._skip = self.SKIP_FRAMES
+        return {"type": "data", "z_b64": b64, "n": len(bs)}
+
+
+def log_first_output(session: str, opened_at: float) -> None:
+    """
+    Logs the time from an open request to the first output forwarded for it,
+    which is what a user perceives as time to first prompt.
+    """
+    ms = (time.perf_counter() - opened_at) * 1000
+    log(f"Session {session} first output {ms:.1f} ms after open")
+
+
+class InputCoalescer:
+    """
+    Batches keystrokes and resizes from the extension before they go to the daemon.
+    A keystroke arriving after `delay` seconds without input passes straight through,
+    keystrokes following it are held until `delay` after the first held one or
+    until `max_bytes` are pending. Resizes are held for `resize_delay` seconds and
+    only the last size of a burst is sent, so a window drag causes a few SIGWINCH
+    redraws instead of dozens.
+    """
+
+    delay: float
+    resize_delay: float
+    max_bytes: int
+
+    def __init__(
+        self,
+        delay: float = INPUT_COALESCE_DELAY,
+        resize_delay: float = RESIZE_DEBOUNCE,
+        max_bytes: int = INPUT_COALESCE_MAX_BYTES,
+    ):
+        self.delay = delay
+        self.resize_delay = resize_delay
+        self.max_bytes = max_bytes
+        self._stdin = bytearray()
+        self._stdin_due: Optional[float] = None
+        self._last_stdin = float("-inf")
+        self._size: Optional[Tuple[int, int]] = None
+        self._size_due: Optional[float] = None
+
+    def push_stdin(self, data: bytes, now: float) -> bool:
+        """
+        Adds keystrokes. Returns True if pending input is due right away.
+        """
+        idle = not self._stdin and now - self._last_stdin >= self.delay
+        self._stdin += data
+        if idle or len(self._stdin) >= self.max_bytes:
+            self._stdin_due = now
+        elif self._stdin_due is None:
+            self._stdin_due = now + self.delay
+        return now >= self._stdin_due
+
+    def push_resize(self, cols: int, rows: int, now: float) -> bool:
+        """
+        Adds a resize. Returns True if it is due right away.
+        """
+        self._size = (cols, rows)
+        if self._size_due is None:
+            self._size_due = now + self.resize_delay
+        return now >= self._size_due
+
+    def timeout(self, now: float) -> Optional[float]:
+        """
+        Seconds until pending input is due, or None if nothing is pending.
+        """
+        dues = [d for d in (self._stdin_due, self._size_due) if d is not None]
+        return max(0.0, min(dues) - now) if dues else None
+
+    def take(
+        self, now: float, force: bool = False
+    ) -> Tuple[Optional[Tuple[int, int]], bytes]:
+        """
+        Removes and returns the resize and keystrokes that are due, or all of
+        them with force.
+        """
+        size, data = None, b""
+        if self._size_due is not None and (force or now >= self._size_due):
+            size, self._size, self._size_due = self._size, None, None
+        if self._stdin_due is not None and (force or now >= self._stdin_due):
+            data = bytes(self._stdin)
+            self._stdin.clear()
+            self._stdin_due = None
+            self._last_stdin = now
+        return size, data
+
+
+class DaemonClient:
+    """
+    Host-side bridge to a persistent session daemon.
+    After a resync event (the daemon dropped us for falling behind) it
+    reattaches and receives the whole scrollback again.
+    Keystrokes and resizes go through an InputCoalescer, flushed by a thread
+    of its own when their batching window ends.
+    Everything it sends to the extension is tagged with its channel.
+    The extension's messages reach it through CHANNEL_COMMANDS; those that
+    arrive while open() is still connecting are held until it is done.
+    """
+
+    session_name: str
+    conn: Optional["Connection"] = None
+    binary: bool = False
+    deflate: Optional[ExtDeflate] = None
+    channel: Any = None
+    _opened_at: float = 0.0
+    _resync: bool = False
+    # Commands held while connecting, None once connected.
+    _held: Optional[List[Tuple[Callable[..., None], Dict[str, Any]]]] = None
+    _shell: Optional[str] = None
+    _size: Tuple[int, int] = (80, 24)
+    _reader_thread: Optional[threading.Thread] = None
+    _flush_thread: Optional[threading.Thread] = None
+    _close_event: threading.Event
+
+    def __init__(
+        self, session_name: str, deflate: Optional[ExtDeflate] = None, channel: Any = None
+    ):
+        self.session_name = session_name
+        self.deflate = deflate
+        self.channel = channel
+        self._close_event = threading.Event()
+        self._input = InputCoalescer()
+        # Guards the connection's send side and the coalescer.
+        self._send_cond = threading.Condition()
+
+    def connect_or_spawn(
+        self,
+        shell: Optional[str],
+        cols: int,
+        rows: int,
+        replay: int = 0,
+        screen: bool = False,
+    ) -> None:
+        """
+        Connect to an existing session or spawn and connect.
+        replay: bytes of scrollback to receive before live data (-1 for all of it)
+        screen: receive a snapshot of the screen instead, if the session keeps a screen model
         """
-        self.conn = ensure_session(self.session_name, shell, cols, rows)
+        self._shell, self._size = shell, (cols, rows)
+        self._attach(replay, screen)
         self._reader_thread = threading.Thread(
             target=self._reader_loop,
             name=f"run_in_terminal_daemon_client_{self.session_name}",
@@ -303,477 +1696,4501 @@ class DaemonClient:
         )
         self._reader_thread.start()
 
-    def _reader_loop(self) -> None:
+    def open(
+        self,
+        shell: Optional[str],
+        cols: int,
+        rows: int,
+        replay: int = 0,
+        screen: bool = False,
+    ) -> None:
+        """
+        Runs connect_or_spawn() on a thread of its own, so the host keeps
+        serving its other channels while a session starts.
+        """
+        self._held = []
+        threading.Thread(
+            target=self._open,
+            args=(shell, cols, rows, replay, screen),
+            name=f"run_in_terminal_open_{self.session_name}",
+            daemon=True,
+        ).start()
+
+    def _open(self, *args: Any) -> None:
+        try:
+            self.connect_or_spawn(*args)
+        except Exception as e:
+            log(f"DaemonClient {self.session_name} failed to open ({e})", WARNING)
+            send_to_ext(on_channel({"type": "error", "message": str(e)}, self.channel))
+        self._release_held()
+
+    def run_command(self, command: Callable[..., None], msg: Dict[str, Any]) -> None:
+        """
+        Runs a CHANNEL_COMMANDS command, or holds it while still connecting.
+        """
+        with self._send_cond:
+            if self._held is not None:
+                self._held.append((command, msg))
+                return
+        command(self, msg)
+
+    def _release_held(self) -> None:
+        """
+        Runs the commands held while connecting, in order.
+        """
+        with self._send_cond:
+            held, self._held = self._held or [], None
+            if self._close_event.is_set():
+                # Detached while connecting, the channel has moved on.
+                held = []
+            for command, msg in held:
+                try:
+                    command(self, msg)
+                except Exception as e:
+                    error = {"type": "error", "message": str(e)}
+                    send_to_ext(on_channel(error, self.channel))
+
+    def _attach(self, replay: int, screen: bool = False) -> None:
+        self._opened_at = time.perf_counter()
+        self.binary = False
+        cols, rows = self._size
+        self.conn = ensure_session(self.session_name, self._shell, cols, rows)
+        # Pickled so daemons that predate binary frames still understand it.
+        self.conn.send(
+            attach_message(self.session_name, self._shell, cols, rows, replay, screen)
+        )
+
+    def _reader_loop(self) -> None:
+        """
+        Receives events from the daemon and forwards them to the extension.
+        """
+        self._resync = False
+        try:
+            log(f"Reader thread {self.session_name} started")
+            while not self._close_event.is_set() and self.conn:
+                try:
+                    msg = self._on_event(self.conn.recv_bytes())
+                    if msg is None:
+                        continue
+                    if msg.get("type") == "data" and "data" in msg:
+                        send_chunk_to_ext(msg["data"], self.deflate, self.channel)
+                    else:
+                        send_to_ext(on_channel(msg, self.channel))
+
+                except (EOFError, OSError):
+                    if not self._resync or self._close_event.is_set():
+                        break
+                    log(f"Reader thread {self.session_name} resyncing", WARNING)
+                    self._resync = False
+                    try:
+                        with self._send_cond:
+                            self.conn.close()
+                            self._attach(-1, screen=True)
+                    except Exception as e:
+                        log(f"Reader thread {self.session_name} resync failed ({e})", ERROR)
+                        send_to_ext(
+                            on_channel(
+                                {"type": "error", "message": f"resync failed: {e}"}, self.channel
+                            )
+                        )
+                        break
+                except Exception as e:
+                    # close() pulls the connection out from under a blocked recv()
+                    if not self._close_event.is_set():
+                        log(f"Reader thread {self.session_name} failed ({e})", WARNING)
+                    break
+        finally:
+            try:
+                log(f"Reader thread {self.session_name} terminated")
+                if self.conn:
+                    self.conn.close()
+            except Exception:
+                pass
+
+    def _on_event(self, buf: bytes) -> Optional[Dict[str, Any]]:
+        """
+        Decodes a frame from the daemon and keeps the books on it: wire format,
+        stats, first output and resyncs. Returns the event to forward, if any.
+        """
+        host_stats.add("daemon_frames_in")
+        host_stats.add("daemon_bytes_in", len(buf))
+        if not self.binary and is_binary_frame(buf):
+            self.binary = True
+        msg = decode_frame(buf)
+        if not isinstance(msg, dict):
+            return None
+        t = msg.get("type")
+        if t == "stats":
+            msg["host"] = host_stats_snapshot()
+        if t == "ready" and msg.get("pooled"):
+            # Its prompt is a replay; there is no start-up to time.
+            self._opened_at = 0.0
+        if t == "data" and self._opened_at:
+            log_first_output(self.session_name, self._opened_at)
+            self._opened_at = 0.0
+        if t == "resync":
+            self._resync = True
+            host_stats.add("resyncs")
+        return msg
+
+    def _send(self, msg: Dict[str, Any]) -> None:
+        """
+        Sends a command in the wire format the daemon answered with.
+        """
+        import pickle
+
+        with self._send_cond:
+            self._write(encode_control(msg) if self.binary else pickle.dumps(msg))
+
+    def _write(self, buf: bytes) -> None:
+        if self.conn:
+            self.conn.send_bytes(buf)
+
+    def stdin(
+        self, data: bytes, input_id: Optional[str] = None, paste: bool = False
+    ) -> None:
+        """
+        Send stdin data to the daemon
+        input_id: have the daemon report progress and delivery of data
+        paste: have the daemon wrap data in bracketed paste markers
+        """
+        with self._send_cond:
+            if input_id is None and not paste:
+                if self._input.push_stdin(data, time.monotonic()):
+                    self._flush_input()
+                else:
+                    self._wake_flusher()
+                return
+            # Keeps keystrokes typed before the paste ahead of it.
+            self._flush_input(force=True)
+            self._send(stdin_message(data, input_id, paste))
+
+    def _send_stdin(self, data: bytes) -> None:
+        host_stats.add("stdin_frames_out")
+        host_stats.add("stdin_bytes_out", len(data))
+        if self.binary:
+            self._write(encode_stdin(data))
+        else:
+            self._send(stdin_message(data))
+
+    def resize(self, cols: int, rows: int) -> None:
+        """
+        Request a terminal resize in the daemon.
+        """
+        with self._send_cond:
+            self._size = (int(cols), int(rows))
+            if self._input.push_resize(*self._size, time.monotonic()):
+                self._flush_input()
+            else:
+                self._wake_flusher()
+
+    def _flush_input(self, force: bool = False) -> None:
+        """
+        Sends the batched resize and keystrokes that are due.
+        """
+        with self._send_cond:
+            size, data = self._input.take(time.monotonic(), force)
+            if size:
+                self._send({"cmd": "resize", "cols": size[0], "rows": size[1]})
+            if data:
+                self._send_stdin(data)
+
+    def _wake_flusher(self) -> None:
+        if self._flush_thread is None:
+            self._flush_thread = threading.Thread(
+                target=self._flush_loop,
+                name=f"run_in_terminal_input_flush_{self.session_name}",
+                daemon=True,
+            )
+            self._flush_thread.start()
+        self._send_cond.notify()
+
+    def _flush_loop(self) -> None:
+        """
+        Flushes batched input when its window ends.
+        """
+        with self._send_cond:
+            while not self._close_event.is_set():
+                timeout = self._input.timeout(time.monotonic())
+                if timeout is None or timeout > 0:
+                    self._send_cond.wait(timeout)
+                    continue
+                try:
+                    self._flush_input()
+                except Exception as e:
+                    log(f"Flushing input for {self.session_name} failed ({e})", WARNING)
+
+    def ping(self) -> None:
+        """
+        Pings the daemon
+        """
+        self._send({"cmd": "ping"})
+
+    def snapshot(self) -> None:
+        """
+        Asks the daemon for a snapshot of its screen model.
+        """
+        self._send({"cmd": "snapshot"})
+
+    def search(self, options: Dict[str, Any]) -> None:
+        """
+        Starts a search of the daemon's output history.
+        """
+        self._send(daemon_command("search", options, SEARCH_OPTIONS))
+
+    def exec(self, options: Dict[str, Any]) -> None:
+        """
+        Queues commands to run in the daemon's shell.
+        """
+        self._send(daemon_command("exec", options, EXEC_OPTIONS))
+
+    def stats(self) -> None:
+        """
+        Asks the daemon for its stats; the reply gets the host's stats added.
+        """
+        self._send({"cmd": "stats"})
+
+    def profile(self, action: str, modes: Optional[List[str]] = None) -> None:
+        """
+        Starts, stops, dumps or reports the daemon's profiler.
+        """
+        self._send({"cmd": "profile", "action": action, "modes": modes})
+
+    def close(self) -> None:
+        """
+        Closes the session and the connection to it; once connected, if open()
+        is still connecting.
+        """
+        with self._send_cond:
+            if self._held is not None:
+                self._held.append((lambda client, _msg: client.close(), {}))
+                return
+            try:
+                self._flush_input(force=True)
+                self._send({"cmd": "close"})
+            except Exception:
+                pass
+        # Closing the session ends the reader.
+        self._disconnect(wake_reader=False)
+
+    def detach(self) -> None:
+        """
+        Stops forwarding the session and closes the connection to it, leaving
+        the session running.
+        """
+        self._disconnect(wake_reader=True)
+
+    def _disconnect(self, wake_reader: bool) -> None:
+        with self._send_cond:
+            self._close_event.set()
+            self._send_cond.notify()
+        log(f"DaemonClient {self.session_name} closed")
+        try:
+            if self.conn and wake_reader:
+                import socket
+
+                # Closing the fd alone would not wake the reader blocked on it.
+                with socket.socket(fileno=os.dup(self.conn.fileno())) as sock:
+                    sock.shutdown(socket.SHUT_RDWR)
+            if self.conn:
+                self.conn.close()
+        except Exception:
+            pass
+
+
+def _before_open(what: str) -> Callable[[], Dict[str, Any]]:
+    return lambda: {"type": "error", "message": f"{what} before open"}
+
+
+def _ext_stdin(client: DaemonClient, msg: Dict[str, Any]) -> None:
+    data = base64.b64decode(msg.get("data_b64", ""))
+    client.stdin(data, msg.get("id"), bool(msg.get("paste")))
+
+
+def _ext_resize(client: DaemonClient, msg: Dict[str, Any]) -> None:
+    cols, rows = client._size
+    client.resize(msg.get("cols", cols), msg.get("rows", rows))
+
+
+# The extension messages handled by a channel's DaemonClient or AsyncDaemonClient,
+# with the reply the extension gets while the channel has no session open.
+CHANNEL_COMMANDS: Dict[
+    str,
+    Tuple[
+        Callable[[DaemonClient, Dict[str, Any]], None],
+        Optional[Callable[[], Dict[str, Any]]],
+    ],
+] = {
+    "stdin": (_ext_stdin, _before_open("stdin")),
+    "resize": (_ext_resize, None),
+    "ping": (lambda client, _msg: client.ping(), lambda: {"type": "pong"}),
+    "snapshot": (lambda client, _msg: client.snapshot(), _before_open("snapshot")),
+    "search": (lambda client, msg: client.search(msg), _before_open("search")),
+    "exec": (lambda client, msg: client.exec(msg), _before_open("exec")),
+    "stats": (
+        lambda client, _msg: client.stats(),
+        lambda: {"type": "stats", "host": host_stats_snapshot()},
+    ),
+    "profile": (
+        lambda client, msg: client.profile(msg.get("action") or "status", msg.get("modes")),
+        _before_open("profile"),
+    ),
+}
+
+
+def channel_message(
+    client: Optional[DaemonClient], msg: Dict[str, Any]
+) -> Optional[Dict[str, Any]]:
+    """
+    Hands an extension message to its channel's client by CHANNEL_COMMANDS,
+    for host_main and host_main_async alike. Returns the reply for the
+    extension, if any.
+    """
+    handler = CHANNEL_COMMANDS.get(msg.get("type", ""))
+    if handler is None:
+        return {"type": "error", "message": "unknown"}
+    command, reply = handler
+    if client:
+        client.run_command(command, msg)
+        return None
+    return reply() if reply else None
+
+
+class PTYShell:
+    shell: Optional[str]
+    cols: int
+    rows: int
+    proc: Optional["subprocess.Popen[bytes]"] = None
+    master_fd: Optional[int] = None
+    slave_fd: Optional[int] = None
+    _close_event: threading.Event
+
+    def __init__(self, shell: Optional[str] = None, cols: int = 80, rows: int = 24):
+        self.shell = shell
+        self.cols = cols
+        self.rows = rows
+        self._close_event = threading.Event()
+
+    def spawn(self) -> str:
+        """
+        Spawns the shell at user home dir.
+        Returns platform identifier.
+        """
+
+        try:
+            os.chdir(home_dir())
+        except Exception:
+            pass
+
+        if not self.shell:
+            if IS_WIN:
+                self.shell = (
+                    os.environ.get("COMSPEC")
+                    or r"C:\Windows\System32\WindowsPowerShell\v1.0\powershell.exe"
+                )
+            else:
+                self.shell = os.environ.get("SHELL") or "/bin/bash"
+
+        if IS_WIN:
+            try:
+                import pywinpty
+
+                self.winpty = pywinpty.PTY(cols=self.cols, rows=self.rows)
+                self.winproc = pywinpty.Process(self.winpty, self.shell)
+                return "win-pty"
+            except Exception:
+                import subprocess
+
+                self.proc = subprocess.Popen(
+                    [self.shell],
+                    stdin=subprocess.PIPE,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.STDOUT,
+                    cwd=home_dir(),
+                )
+                return "win-pipe"
+
+        import pty, fcntl, termios, struct as st
+        import subprocess
+
+        self.master_fd, self.slave_fd = pty.openpty()
+        fcntl.ioctl(
+            self.master_fd,
+            termios.TIOCSWINSZ,
+            st.pack("HHHH", self.rows, self.cols, 0, 0),
+        )
+        
+        def preexec():
+            if self.slave_fd is None:
+                log("Got no slave fd from openpty().", WARNING)
+                return
+            os.setsid()
+            fcntl.ioctl(self.slave_fd, termios.TIOCSCTTY, 0)
+
+        env = os.environ.copy()
+        env.setdefault("TERM", "xterm-256color")
+        env.setdefault("COLORTERM", "truecolor")
+
+        self.proc = subprocess.Popen(
+            [self.shell, "-l"],
+            stdin=self.slave_fd,
+            stdout=self.slave_fd,
+            stderr=self.slave_fd,
+            preexec_fn=preexec,
+            cwd=home_dir(),
+            env=env,
+        )
+        os.close(self.slave_fd)
+        return "posix-pty"
+
+    def read_chunk(self, n: int = 8192) -> bytes:
+        """
+        Read up to n bytes from the terminal. Returns b"" once the terminal is gone.
+        Raises BlockingIOError if the master fd is non-blocking and nothing is available.
+        """
+        if IS_WIN:
+            if self.winpty:
+                s = self.winpty.read(n)
+                return (s or "").encode("utf-8", "ignore")
+            if self.proc and self.proc.stdout:
+                return self.proc.stdout.read(n) or b""
+            return b""
+
+        try:
+            return os.read(self.master_fd, n) if self.master_fd else b""
+        except BlockingIOError:
+            raise
+        except Exception:
+            return b""
+
+    def write(self, data: bytes) -> None:
+        """
+        Write bytes to terminal
+        """
+        if IS_WIN:
+            if self.winpty:
+                self.winpty.write(data.decode("utf-8", "ignore"))
+                return
+            if self.proc and self.proc.stdin:
+                self.proc.stdin.write(data)
+                self.proc.stdin.flush()
+                return
+        if self.master_fd:
+            os.write(self.master_fd, data)
+
+    def write_some(self, data: memoryview) -> int:
+        """
+        Writes as much of data as the terminal takes without blocking.
+        Returns the number of bytes written, 0 if the terminal is full.
+        Windows writes block, and all of data is written.
+        """
+        if IS_WIN or not self.master_fd:
+            self.write(bytes(data))
+            return len(data)
+        try:
+            return os.write(self.master_fd, data)
+        except BlockingIOError:
+            return 0
+
+    def resize(self, cols: int, rows: int) -> None:
+        """
+        Resize the terminal window
+        """
+        self.cols = cols
+        self.rows = rows
+
+        if IS_WIN and self.winpty:
+            self.winpty.set_size(self.cols, self.rows)
+            return
+        if self.master_fd:
+            import fcntl, termios, struct as st
+
+            fcntl.ioctl(
+                self.master_fd,
+                termios.TIOCSWINSZ,
+                st.pack("HHHH", self.rows, self.cols, 0, 0),
+            )
+
+    def poll_exit_code(self) -> Optional[int]:
+        """
+        Returns process exit code if exited, otherwise None
+        """
+        if IS_WIN and self.winpty:
+            return None
+        if self.proc:
+            return self.proc.poll()
+        return None
+
+    def close(self, wait: float = 2.0) -> None:
+        """
+        Terminates the child process and closes file descriptors.
+        wait: seconds to give the shell before it is killed; with 0 the shell is
+        only signalled and the caller must reap it (see Supervisor._reap).
+        """
+        if self._close_event.is_set():
+            return
+        self._close_event.set()
+        try:
+            if IS_WIN:
+                try:
+                    if self.winproc:
+                        self.winproc.kill()
+                except Exception:
+                    pass
+                try:
+                    if self.proc:
+                        self.proc.terminate()
+                except Exception:
+                    pass
+                try:
+                    if self.winpty:
+                        self.winpty.close()
+                except Exception:
+                    pass
+            else:
+                import signal
+
+                if self.proc:
+                    try:
+                        os.killpg(self.proc.pid, signal.SIGTERM)
+                    except Exception:
+                        try:
+                            self.proc.terminate()
+                        except Exception:
+                            pass
+                    deadline = time.time() + wait
+                    while time.time() < deadline and self.proc.poll() is None:
+                        time.sleep(0.05)
+                    if wait > 0 and self.proc.poll() is None:
+                        try:
+                            os.killpg(self.proc.pid, signal.SIGKILL)
+                        except Exception:
+                            pass
+                if self.master_fd:
+                    try:
+                        os.close(self.master_fd)
+                    except Exception:
+                        pass
+        except Exception:
+            pass
+
+
+class ScrollbackRing:
+    """
+    Fixed-size ring of the most recent PTY output of a session.
+    Memory stays flat at `capacity` bytes no matter how much output passes through.
+    With a path the ring lives in an mmap'd file instead of the daemon heap.
+    total: number of bytes ever appended
+    """
+
+    capacity: int
+    total: int = 0
+    path: Optional[Path] = None
+    # Output before this offset is gone even if the ring has room for it, see restore().
+    _start: int = 0
+
+    def __init__(self, capacity: int, path: Optional[Path] = None):
+        self.capacity = max(1, capacity)
+        self.path = path
+        self._file = None
+        if path:
+            import mmap
+
+            self._file = open(path, "w+b")
+            self._file.truncate(self.capacity)
+            self._buf = mmap.mmap(self._file.fileno(), self.capacity)
+        else:
+            self._buf = bytearray(self.capacity)
+
+    def __len__(self) -> int:
+        return min(self.total - self._start, self.capacity)
+
+    def append(self, bs: bytes) -> None:
+        """
+        Appends bytes, overwriting the oldest ones once the ring is full.
+        """
+        n = len(bs)
+        if not n:
+            return
+        data = bs[-self.capacity :] if n > self.capacity else bs
+        start = (self.total + n - len(data)) % self.capacity
+        first = min(len(data), self.capacity - start)
+        self._buf[start : start + first] = data[:first]
+        if first < len(data):
+            self._buf[: len(data) - first] = data[first:]
+        self.total += n
+
+    def tail(self, n: int) -> bytes:
+        """
+        Returns the last n bytes held by the ring. A negative n returns everything.
+        """
+        size = len(self)
+        n = size if n < 0 else min(n, size)
+        if not n:
+            return b""
+        start = (self.total - n) % self.capacity
+        end = start + n
+        if end <= self.capacity:
+            return bytes(self._buf[start:end])
+        return bytes(self._buf[start:]) + bytes(self._buf[: end - self.capacity])
+
+    def release(self) -> None:
+        """
+        Frees the memory of a ring on the heap; save tail(-1) first to restore()
+        it later. A ring in a file is left alone.
+        """
+        if not self._file:
+            self._buf = bytearray()
+
+    def restore(self, data: bytes, total: int) -> None:
+        """
+        Refills a released ring with its tail(-1) and total from before release().
+        With less data than that, the ring holds only data until more output comes.
+        """
+        self._buf = bytearray(self.capacity)
+        self.total = self._start = total - len(data)
+        self.append(data)
+
+    def close(self) -> None:
+        """
+        Releases the ring and removes its backing file, if any.
+        """
+        if self._file:
+            try:
+                self._buf.close()
+                self._file.close()
+            except Exception:
+                pass
+            self._file = None
+        if self.path:
+            try:
+                self.path.unlink()
+            except Exception:
+                pass
+
+
+class OutputCoalescer:
+    """
+    Batches PTY output into fewer, larger data frames within a small latency budget.
+    A small chunk arriving while nothing is pending (typically an echoed keystroke)
+    passes straight through. Anything else is held until `delay` seconds after the
+    first pending byte or until `max_bytes` have accumulated, whichever comes first.
+    """
+
+    delay: float
+    max_bytes: int
+    echo_bytes: int
+
+    def __init__(
+        self,
+        delay: float = COALESCE_DELAY,
+        max_bytes: int = COALESCE_MAX_BYTES,
+        echo_bytes: int = COALESCE_ECHO_BYTES,
+    ):
+        self.delay = delay
+        self.max_bytes = max(1, max_bytes)
+        self.echo_bytes = echo_bytes
+        self._pending = bytearray()
+        self._deadline: Optional[float] = None
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def push(self, chunk: bytes, now: float) -> List[bytes]:
+        """
+        Adds output and returns the frames that are due right away.
+        """
+        if not self._pending and len(chunk) <= self.echo_bytes:
+            return [chunk]
+        if not self._pending:
+            self._deadline = now + self.delay
+        self._pending += chunk
+        frames = []
+        while len(self._pending) >= self.max_bytes:
+            frames.append(bytes(self._pending[: self.max_bytes]))
+            del self._pending[: self.max_bytes]
+        if not self._pending:
+            self._deadline = None
+        elif self._deadline is not None and now >= self._deadline:
+            frames.append(self.take())
+        return frames
+
+    def timeout(self, now: float) -> Optional[float]:
+        """
+        Seconds until pending output is due, or None if nothing is pending.
+        """
+        if self._deadline is None:
+            return None
+        return max(0.0, self._deadline - now)
+
+    def take(self) -> bytes:
+        """
+        Removes and returns everything pending.
+        """
+        out = bytes(self._pending)
+        self._pending.clear()
+        self._deadline = None
+        return out
+
+
+# Escape sequences dropped from the search history: CSI, OSC to BEL or ST,
+# DCS and the other string sequences to ST, and the two-byte escapes.
+_SEARCH_ESCAPE = (
+    rb"\x1b(?:\[[0-?]*[ -/]*[@-~]"
+    rb"|\][^\x07\x1b]*(?:\x07|\x1b\\)"
+    rb"|[PX^_][^\x1b]*\x1b\\"
+    rb"|[ -/]*[0-~])"
+)
+# Then C0 controls other than tab and newline, DEL and stray ESCs.
+_SEARCH_CONTROLS = bytes(range(0x09)) + bytes(range(0x0B, 0x20)) + b"\x7f"
+# An escape sequence cut off by the end of a chunk, kept for the next one
+# unless it is longer than SEARCH_CARRY_MAX.
+_SEARCH_PARTIAL = (
+    rb"\x1b(?:\[[0-?]*[ -/]*|\][^\x07\x1b]*\x1b?|[PX^_][^\x1b]*\x1b?|[ -/]*)"
+)
+SEARCH_CARRY_MAX = 4096
+
+
+class SearchHistory:
+    """
+    Output of a session for the "search" command, with escape sequences and
+    control characters other than tab and newline stripped. The text is one
+    bytearray, so a search runs over it without copying. Offsets and line
+    numbers count from the start of the session; once the text outgrows
+    `capacity` its oldest quarter is dropped, cut at a line break.
+    The line index is sparse: an (offset, line) checkpoint every
+    SEARCH_INDEX_STRIDE bytes, added as output comes in, so the line of an
+    offset is found by counting the newlines after the checkpoint before it.
+    """
+
+    capacity: int
+    # Offset and line of the first byte still kept.
+    base: int = 0
+    base_line: int = 0
+    # Newlines so far, which is also the line output goes to now.
+    lines: int = 0
+
+    def __init__(self, capacity: int):
+        import re
+
+        self.capacity = max(SEARCH_INDEX_STRIDE, capacity)
+        self.buf = bytearray()
+        self._escape = re.compile(_SEARCH_ESCAPE)
+        self._partial = re.compile(_SEARCH_PARTIAL)
+        self._carry = b""
+        self._offsets: List[int] = [0]
+        self._lines: List[int] = [0]
+
+    @property
+    def end(self) -> int:
+        return self.base + len(self.buf)
+
+    def append(self, data: bytes) -> None:
+        """
+        Strips and appends PTY output, extending the line index.
+        """
+        if self._carry:
+            data, self._carry = self._carry + data, b""
+        i = data.rfind(b"\x1b", max(0, len(data) - SEARCH_CARRY_MAX))
+        if i >= 0 and self._partial.fullmatch(data, i):
+            data, self._carry = data[:i], data[i:]
+        if b"\x1b" in data:
+            data = self._escape.sub(b"", data)
+        text = data.translate(None, _SEARCH_CONTROLS)
+        if text:
+            self._add(text)
+
+    def _add(self, text: bytes) -> None:
+        start = self.end
+        self.buf += text
+        checkpoint = self._offsets[-1] + SEARCH_INDEX_STRIDE
+        while checkpoint <= self.end:
+            self._offsets.append(checkpoint)
+            self._lines.append(self.lines + text.count(b"\n", 0, checkpoint - start))
+            checkpoint += SEARCH_INDEX_STRIDE
+        self.lines += text.count(b"\n")
+        while len(self.buf) > self.capacity:
+            self._trim()
+
+    def saved(self) -> Tuple[Dict[str, int], List[bytes]]:
+        """
+        What restore() needs: a small header and the buffers to write after it.
+        """
+        header = {
+            "base": self.base,
+            "base_line": self.base_line,
+            "text": len(self.buf),
+            "carry": len(self._carry),
+        }
+        return header, [self.buf, self._carry]
+
+    @classmethod
+    def restore(cls, capacity: int, header: Dict[str, int], data: bytes) -> "SearchHistory":
+        """
+        Rebuilds a history, line index included, from what saved() returned.
+        """
+        n = header["text"]
+        if len(data) != n + header["carry"]:
+            raise ValueError("search history cut short")
+        history = cls(capacity)
+        history.base = history._offsets[0] = header["base"]
+        history.base_line = history.lines = history._lines[0] = header["base_line"]
+        history._add(data[:n])
+        history._carry = data[n:]
+        return history
+
+    def _trim(self) -> None:
+        import bisect
+
+        cut = self.buf.find(b"\n", len(self.buf) // 4) + 1 or len(self.buf) // 4
+        base = self.base + cut
+        base_line = self.line_at(base)
+        del self.buf[:cut]
+        i = bisect.bisect_right(self._offsets, base)
+        self._offsets[:i] = [base]
+        self._lines[:i] = [base_line]
+        self.base, self.base_line = base, base_line
+
+    def line_at(self, offset: int) -> int:
+        """
+        Returns the line holding the byte at offset.
+        """
+        import bisect
+
+        i = bisect.bisect_right(self._offsets, offset) - 1
+        return self._lines[i] + self.buf.count(
+            b"\n", self._offsets[i] - self.base, offset - self.base
+        )
+
+    def line_offset(self, line: int) -> int:
+        """
+        Returns the offset a line starts at, clamped to the history kept.
+        """
+        import bisect
+
+        if line <= self.base_line:
+            return self.base
+        if line > self.lines:
+            return self.end
+        # The last checkpoint inside an earlier line.
+        i = bisect.bisect_left(self._lines, line) - 1
+        pos = self._offsets[i] - self.base
+        for _ in range(line - self._lines[i]):
+            pos = self.buf.find(b"\n", pos) + 1
+        return self.base + pos
+
+
+class ExecStep:
+    """
+    One command of an "exec" batch. It is typed into the shell wrapped in
+    printf calls that print an OSC 133 C mark before it runs and a D mark
+    with its exit status after, both tagged with a random token so marks of
+    other commands or programs are not mistaken for its own.
+    start: output offset right after its C mark, once it started
+    """
+
+    start: Optional[int] = None
+    started_at: float = 0.0
+
+    def __init__(
+        self,
+        client: "SessionClient",
+        batch_id: Any,
+        index: int,
+        command: str,
+        stop_on_error: bool,
+        capture: bool,
+    ):
+        self.client = client
+        self.batch_id = batch_id
+        self.index = index
+        self.command = command
+        self.stop_on_error = stop_on_error
+        self.capture = capture
+        self.token = os.urandom(8).hex()
+
+    def wrapped(self) -> bytes:
+        """
+        The command between its marks, in POSIX shell syntax. The braces run
+        it in the shell itself, so cd and variables stay in effect, and the
+        line break before the closing one lets it end in a comment.
+        """
+        return (
+            f"printf '\\033]133;C;rit={self.token}\\007'; {{ {self.command}\n}}; "
+            f"printf '\\033]133;D;%s;rit={self.token}\\007' \"$?\""
+        ).encode("utf-8")
+
+    def syntax_error(self, shell: str) -> Optional[str]:
+        """
+        Has shell parse wrapped() without running it (-n). A command left open
+        by a quote, here-document or trailing backslash swallows the closing
+        brace and the D mark, so it would never report done.
+        Returns the shell's complaint, or None if the command parses.
+        """
+        import subprocess
+
+        try:
+            proc = subprocess.run(
+                [shell, "-n"],
+                input=self.wrapped(),
+                capture_output=True,
+                timeout=EXEC_CHECK_TIMEOUT,
+            )
+        except (OSError, subprocess.SubprocessError) as e:
+            return f"could not check the command ({e})"
+        if proc.returncode:
+            return proc.stderr.decode("utf-8", "replace").strip() or "syntax error"
+        return None
+
+    def event(self, kind: str, **fields: Any) -> Dict[str, Any]:
+        return {"type": f"exec.{kind}", "id": self.batch_id, "index": self.index, **fields}
+
+
+class HistorySearch:
+    """
+    One "search" command running over a SearchHistory. Each step() scans
+    about SEARCH_SLICE_BYTES, ending at a line break, and adds the hits to
+    pages of at most SEARCH_PAGE_HITS hits or SEARCH_PAGE_BYTES of text,
+    which take_pages() hands out. Output that arrives after the search
+    started is not searched.
+    A hit has the line number, the line's text cut to SEARCH_LINE_MAX bytes
+    around the hit, the hit's [start, end) in that text, its column in the
+    whole line and, if asked for, the lines before and after it.
+    """
+
+    def __init__(
+        self,
+        client: "SessionClient",
+        search_id: Any,
+        pattern: "re.Pattern[bytes]",
+        context: int,
+        max_hits: int,
+        pos: int,
+        end: int,
+    ):
+        self.client = client
+        self.id = search_id
+        self.pattern = pattern
+        self.context = context
+        self.max_hits = max_hits
+        self.pos = pos
+        self.end = end
+        self.hits = 0
+        self.done = False
+        self.truncated = False
+        # Set when output was dropped from the history before it was searched.
+        self.skipped = False
+        self._page: List[Dict[str, Any]] = []
+        self._page_bytes = 0
+        self._pages: List[List[Dict[str, Any]]] = []
+
+    def step(self, history: SearchHistory) -> None:
+        if self.pos < history.base:
+            self.pos = history.base
+            self.skipped = True
+        buf, base = history.buf, history.base
+        stop = min(self.end, self.pos + SEARCH_SLICE_BYTES)
+        if stop < self.end:
+            nl = buf.find(b"\n", stop - base, self.end - base)
+            stop = self.end if nl < 0 else base + nl + 1
+        line, line_pos = -1, 0
+        for m in self.pattern.finditer(buf, self.pos - base, stop - base):
+            if line < 0:
+                line = history.line_at(base + m.start())
+            else:
+                line += buf.count(b"\n", line_pos, m.start())
+            line_pos = m.start()
+            self._add(self._hit(buf, m, line))
+            if self.hits >= self.max_hits:
+                self.truncated = self.done = True
+                return
+        self.pos = stop
+        self.done = stop >= self.end
+
+    def _hit(self, buf: bytearray, m: "re.Match[bytes]", line: int) -> Dict[str, Any]:
+        start = buf.rfind(b"\n", 0, m.start()) + 1
+        end = buf.find(b"\n", m.start())
+        if end < 0:
+            end = len(buf)
+        lo = start
+        if end - start > SEARCH_LINE_MAX:
+            lo = max(start, min(m.start() - SEARCH_LINE_MAX // 4, end - SEARCH_LINE_MAX))
+        hi = min(end, lo + SEARCH_LINE_MAX)
+        head = len(buf[lo : m.start()].decode("utf-8", "replace"))
+        matched = len(buf[m.start() : min(m.end(), hi)].decode("utf-8", "replace"))
+        hit: Dict[str, Any] = {
+            "line": line,
+            "col": len(buf[start : m.start()].decode("utf-8", "replace")),
+            "text": buf[lo:hi].decode("utf-8", "replace"),
+            "span": [head, head + matched],
+        }
+        if self.context:
+            before: List[str] = []
+            pos = start
+            while pos > 0 and len(before) < self.context:
+                prev = buf.rfind(b"\n", 0, pos - 1) + 1
+                before.append(self._line(buf, prev, pos - 1))
+                pos = prev
+            after: List[str] = []
+            pos = end
+            while pos + 1 < len(buf) and len(after) < self.context:
+                nxt = buf.find(b"\n", pos + 1)
+                if nxt < 0:
+                    nxt = len(buf)
+                after.append(self._line(buf, pos + 1, nxt))
+                pos = nxt
+            hit["before"] = before[::-1]
+            hit["after"] = after
+        return hit
+
+    @staticmethod
+    def _line(buf: bytearray, start: int, end: int) -> str:
+        return buf[start : min(end, start + SEARCH_LINE_MAX)].decode("utf-8", "replace")
+
+    def _add(self, hit: Dict[str, Any]) -> None:
+        self.hits += 1
+        self._page.append(hit)
+        self._page_bytes += len(hit["text"]) + sum(
+            len(s) for s in hit.get("before", []) + hit.get("after", [])
+        )
+        if len(self._page) >= SEARCH_PAGE_HITS or self._page_bytes >= SEARCH_PAGE_BYTES:
+            self._pages.append(self._page)
+            self._page, self._page_bytes = [], 0
+
+    def take_pages(self) -> List[List[Dict[str, Any]]]:
+        """
+        Returns the full pages so far and, once the search is done, the last one.
+        """
+        pages, self._pages = self._pages, []
+        if self.done:
+            pages.append(self._page)
+            self._page, self._page_bytes = [], 0
+        return pages
+
+
+# The marks ExecStep puts around a command.
+_EXEC_MARK = rb"\x1b\]133;([CD])(?:;(\d+))?;rit=([0-9a-f]+)\x07"
+# Output kept from the end of a chunk to find marks split between chunks.
+EXEC_MARK_TAIL = 64
+
+
+# Tokens of the VT stream that the screen model acts on. Text between tokens is printed.
+# ESC [ and ESC ] are excluded from the two-byte escapes so an incomplete CSI or OSC
+# at the end of a chunk does not match at all and waits for the next chunk.
+# A line break followed by plain ASCII lines is taken as one block. The lookahead
+# lets the regex engine skip over text quickly.
+_VT_TOKEN = (
+    "(?=[\x00-\x1f\x7f])(?:\x1b\\[([0-?]*)[ -/]*([@-~])"
+    "|\x1b\\]([^\x07\x1b]*)(?:\x07|\x1b\\\\)"
+    "|\x1b([()*+])(.)"
+    "|\x1b[ -/]*([0-Z\\\\^-~])"
+    "|(\r\n(?:[ -~]*\r\n)+)"
+    "|([\x00-\x1a\x1c-\x1f\x7f]))"
+)
+# DEC special graphics, selected with ESC ( 0 for line drawing.
+_DEC_GRAPHICS = str.maketrans(
+    "`abcdefghijklmnopqrstuvwxyz{|}~",
+    "◆▒␉␌␍␊°±␤␋┘┐┌└┼⎺⎻─⎼⎽├┤┴┬│≤≥π≠£·",
+)
+
+
+class ScreenModel:
+    """
+    Headless VT screen: the grid of characters and attributes a terminal
+    would show after all output so far, plus a bounded history of lines
+    scrolled off the top. snapshot() renders it as one escape sequence
+    stream that reproduces the screen in a fresh terminal.
+    Rows are lists of cell strings with a parallel list of attribute ids.
+    Runs of text go in with slice assignment, and control sequences are
+    found with one regex pass, so ordinary output costs a few list
+    operations per run and not per character.
+    Covers what shells and full screen programs commonly use: cursor
+    movement, erase, insert and delete, scroll regions, SGR, the alternate
+    screen, DEC line drawing and the modes that affect rendering.
+    """
+
+    cols: int
+    rows: int
+    history_lines: int
+    title: str = ""
+
+    def __init__(self, cols: int, rows: int, history_lines: int = SCREEN_HISTORY_LINES):
+        import codecs
+        import re
+
+        self.cols = max(1, cols)
+        self.rows = max(1, rows)
+        self.history_lines = history_lines
+        self._token = re.compile(_VT_TOKEN, re.DOTALL)
+        self._decoder = codecs.getincrementaldecoder("utf-8")("replace")
+        self._tail = ""
+        # SGR strings by attribute id, id 0 is the default rendition.
+        self._attr_ids: Dict[str, int] = {"": 0}
+        self._attr_sgr: List[str] = [""]
+        # The parsed SGR state of each attribute id, and (attr, SGR params) -> attr.
+        self._attr_state: List[Dict[str, str]] = [{}]
+        self._sgr_cache: Dict[Tuple[int, str], Tuple[int, int]] = {}
+        self._attr_limit = SCREEN_ATTRS_MAX
+        self.reset()
+
+    def reset(self) -> None:
+        """
+        Full reset (RIS): clears screen, history, modes and attributes.
+        """
+        # Rows as (cells, attrs), or (text, attr) for lines printed in one rendition.
+        self.history: Deque[Tuple[Any, Any]] = deque(maxlen=self.history_lines)
+        self._lines, self._attrs = self._blank_grid()
+        self._alt: Optional[Tuple[List[List[str]], List[List[int]], Tuple[int, int]]] = None
+        self.x = self.y = 0
+        self._wrap_pending = False
+        self._top, self._bottom = 0, self.rows - 1
+        self._saved = (0, 0, 0)
+        self._attr = self._erase_attr = 0
+        self._g0_graphics = False
+        self.autowrap = True
+        self.cursor_visible = True
+        self.app_cursor = False
+        self.bracketed_paste = False
+
+    def _blank_grid(self) -> Tuple[List[List[str]], List[List[int]]]:
+        return (
+            [[" "] * self.cols for _ in range(self.rows)],
+            [[0] * self.cols for _ in range(self.rows)],
+        )
+
+    def feed(self, data: bytes) -> None:
+        """
+        Advances the screen by a chunk of PTY output.
+        """
+        text = self._tail + self._decoder.decode(data)
+        self._tail = ""
+        pos = 0
+        print_, sgr_cache = self._print, self._sgr_cache
+        for m in self._token.finditer(text):
+            start = m.start()
+            if start > pos:
+                print_(text[pos:start])
+            pos = m.end()
+            kind = m.lastindex
+            if kind == 2:
+                params, final = m.group(1, 2)
+                if final == "m":
+                    # Most SGR sequences repeat, skip the parse for those.
+                    cached = sgr_cache.get((self._attr, params))
+                    if cached:
+                        self._attr, self._erase_attr = cached
+                        continue
+                self._csi(params, final)
+            elif kind == 8:
+                self._control(m.group(8))
+            elif kind == 7:
+                self._print_lines(m.group(7).split("\r\n")[:-1])
+            elif kind == 6:
+                self._esc(m.group(6))
+            elif kind == 3:
+                self._osc(m.group(3))
+            elif m.group(4) == "(":
+                self._g0_graphics = m.group(5) == "0"
+        if pos < len(text):
+            rest = text[pos:]
+            esc = rest.rfind("\x1b")
+            if esc >= 0 and len(rest) - esc < 4096:
+                # An escape sequence split across chunks.
+                self._tail = rest[esc:]
+                rest = rest[:esc]
+            if rest:
+                self._print(rest)
+
+    def _print(self, run: str) -> None:
+        if "\x1b" in run:
+            run = run.replace("\x1b", "")
+        if self._g0_graphics:
+            run = run.translate(_DEC_GRAPHICS)
+        cells: Any = run if run.isascii() else self._cells(run)
+        cols = self.cols
+        attr = self._attr
+        while cells:
+            if self._wrap_pending:
+                self._wrap_pending = False
+                if self.autowrap:
+                    self.x = 0
+                    self._linefeed()
+            x = self.x
+            n = min(len(cells), cols - x)
+            self._lines[self.y][x : x + n] = cells[:n]
+            self._attrs[self.y][x : x + n] = [attr] * n
+            cells = cells[n:]
+            if x + n < cols:
+                self.x = x + n
+            elif self.autowrap:
+                self.x = cols - 1
+                self._wrap_pending = True
+            else:
+                # Without autowrap the rest overwrites the last column.
+                self.x = cols - 1
+                if cells:
+                    self._lines[self.y][cols - 1] = cells[-1]
+                    self._attrs[self.y][cols - 1] = attr
+                    cells = ""
+
+    def _print_lines(self, lines: List[str]) -> None:
+        """
+        Prints lines, each followed by CR LF. Once the cursor sits at the start
+        of the bottom line, all further lines just scroll, and only the ones
+        that end up on screen or in history are built.
+        """
+        i = 0
+        n = len(lines)
+        while i < n and (
+            self.x or self._wrap_pending or self.y != self._bottom or self._g0_graphics
+        ):
+            if lines[i]:
+                self._print(lines[i])
+            self._control("\r")
+            self._linefeed()
+            i += 1
+        cols = self.cols
+        if i == n or max(map(len, lines[i:])) > cols:
+            for line in lines[i:]:
+                if line:
+                    self._print(line)
+                self._control("\r")
+                self._linefeed()
+            return
+        top, bottom = self._top, self._bottom
+        attr, blank = self._attr, self._erase_attr
+        keep = top == 0 and self._alt is None
+        first = lines[i]
+        self._lines[bottom][: len(first)] = first
+        self._attrs[bottom][: len(first)] = [attr] * len(first)
+        region = bottom - top + 1
+        # Lines before these scroll out of history before the block ends.
+        rest = lines[i + 1 :][-(region + (self.history_lines if keep else 0)) :]
+        # The region scrolls by len(rest) + 1 rows, the last one blank.
+        old = list(zip(self._lines[top : bottom + 1], self._attrs[top : bottom + 1]))
+        cut = max(0, len(rest) + 1 - region)
+        if keep:
+            self.history.extend(old[: len(rest) + 1])
+            # Lines that only pass through the screen go to history as (text, attr).
+            self.history.extend([(line, attr) for line in rest[:cut]])
+        rows = old[len(rest) + 1 :]
+        rows += [
+            (list(line) + [" "] * (cols - len(line)), [attr] * len(line) + [blank] * (cols - len(line)))
+            for line in rest[cut:]
+        ]
+        rows.append(([" "] * cols, [blank] * cols))
+        self._lines[top : bottom + 1] = [line for line, _ in rows]
+        self._attrs[top : bottom + 1] = [attrs for _, attrs in rows]
+
+    def _cells(self, run: str) -> List[str]:
+        """
+        Splits non-ASCII text into cells: wide characters take two cells
+        (the second one empty), combining marks join the cell before them.
+        """
+        import unicodedata
+
+        cells: List[str] = []
+        for ch in run:
+            if unicodedata.combining(ch):
+                if cells:
+                    cells[-1] += ch
+                elif self.x or self._wrap_pending:
+                    self._lines[self.y][self.x if self._wrap_pending else self.x - 1] += ch
+                continue
+            cells.append(ch)
+            if ch > "\u10ff" and unicodedata.east_asian_width(ch) in "WF":
+                cells.append("")
+        return cells
+
+    def _control(self, ch: str) -> None:
+        if ch == "\r":
+            self.x = 0
+            self._wrap_pending = False
+        elif ch in "\n\x0b\x0c":
+            self._linefeed()
+        elif ch == "\x08":
+            if self.x:
+                self.x -= 1
+            self._wrap_pending = False
+        elif ch == "\t":
+            self.x = min(self.cols - 1, (self.x // 8 + 1) * 8)
+        elif ch == "\x0e":
+            self._g0_graphics = True
+        elif ch == "\x0f":
+            self._g0_graphics = False
+
+    def _linefeed(self) -> None:
+        self._wrap_pending = False
+        if self.y == self._bottom:
+            self._scroll_up(1)
+        elif self.y < self.rows - 1:
+            self.y += 1
+
+    def _reverse_index(self) -> None:
+        if self.y == self._top:
+            self._scroll_down(1)
+        elif self.y:
+            self.y -= 1
+
+    def _blank_row(self) -> Tuple[List[str], List[int]]:
+        return [" "] * self.cols, [self._erase_attr] * self.cols
+
+    def _scroll_up(self, n: int, top: Optional[int] = None) -> None:
+        top = self._top if top is None else top
+        bottom = self._bottom
+        n = min(n, bottom - top + 1)
+        keep = top == 0 and self._alt is None
+        for _ in range(n):
+            line, attrs = self._lines.pop(top), self._attrs.pop(top)
+            if keep:
+                self.history.append((line, attrs))
+            line, attrs = self._blank_row()
+            self._lines.insert(bottom, line)
+            self._attrs.insert(bottom, attrs)
+
+    def _scroll_down(self, n: int, top: Optional[int] = None) -> None:
+        top = self._top if top is None else top
+        bottom = self._bottom
+        n = min(n, bottom - top + 1)
+        for _ in range(n):
+            del self._lines[bottom], self._attrs[bottom]
+            line, attrs = self._blank_row()
+            self._lines.insert(top, line)
+            self._attrs.insert(top, attrs)
+
+    def _erase(self, y: int, start: int, end: int) -> None:
+        n = end - start
+        if n > 0:
+            self._lines[y][start:end] = [" "] * n
+            self._attrs[y][start:end] = [self._erase_attr] * n
+
+    def _esc(self, final: str) -> None:
+        if final == "7":
+            self._saved = (self.x, self.y, self._attr)
+        elif final == "8":
+            self.x, self.y, attr = self._saved
+            self._set_attr_id(attr)
+            self._wrap_pending = False
+        elif final == "D":
+            self._linefeed()
+        elif final == "E":
+            self.x = 0
+            self._linefeed()
+        elif final == "M":
+            self._reverse_index()
+        elif final == "c":
+            self.reset()
+
+    def _osc(self, body: str) -> None:
+        code, _, text = body.partition(";")
+        if code in ("0", "2"):
+            self.title = text
+
+    def _csi(self, params: str, final: str) -> None:
+        private = params[:1] in ("?", ">", "<", "=")
+        if private:
+            if params[0] == "?" and final in "hl":
+                self._dec_modes(params[1:], final == "h")
+            return
+        if final == "m":
+            self._set_sgr(params)
+            return
+        args = [int(p) if p.isdigit() else 0 for p in params.split(";")] if params else []
+        a = args[0] if args else 0
+        n = a or 1
+        cols, rows = self.cols, self.rows
+        self._wrap_pending = False
+        if final in "Hf":
+            row = (a or 1) - 1
+            col = ((args[1] if len(args) > 1 else 0) or 1) - 1
+            self.y, self.x = min(row, rows - 1), min(col, cols - 1)
+        elif final == "A":
+            self.y = max(self._top if self.y >= self._top else 0, self.y - n)
+        elif final in "Be":
+            self.y = min(self._bottom if self.y <= self._bottom else rows - 1, self.y + n)
+        elif final in "Ca":
+            self.x = min(cols - 1, self.x + n)
+        elif final == "D":
+            self.x = max(0, self.x - n)
+        elif final == "E":
+            self.x = 0
+            self.y = min(rows - 1, self.y + n)
+        elif final == "F":
+            self.x = 0
+            self.y = max(0, self.y - n)
+        elif final in "G`":
+            self.x = min(cols - 1, n - 1)
+        elif final == "d":
+            self.y = min(rows - 1, n - 1)
+        elif final == "J":
+            if a == 0:
+                self._erase(self.y, self.x, cols)
+                for y in range(self.y + 1, rows):
+                    self._erase(y, 0, cols)
+            elif a == 1:
+                for y in range(self.y):
+                    self._erase(y, 0, cols)
+                self._erase(self.y, 0, self.x + 1)
+            elif a == 2:
+                for y in range(rows):
+                    self._erase(y, 0, cols)
+            elif a == 3:
+                self.history.clear()
+        elif final == "K":
+            if a == 0:
+                self._erase(self.y, self.x, cols)
+            elif a == 1:
+                self._erase(self.y, 0, self.x + 1)
+            elif a == 2:
+                self._erase(self.y, 0, cols)
+        elif final == "X":
+            self._erase(self.y, self.x, min(cols, self.x + n))
+        elif final == "@":
+            line, attrs = self._lines[self.y], self._attrs[self.y]
+            n = min(n, cols - self.x)
+            line[self.x : self.x] = [" "] * n
+            attrs[self.x : self.x] = [self._erase_attr] * n
+            del line[cols:], attrs[cols:]
+        elif final == "P":
+            line, attrs = self._lines[self.y], self._attrs[self.y]
+            n = min(n, cols - self.x)
+            del line[self.x : self.x + n], attrs[self.x : self.x + n]
+            line.extend([" "] * n)
+            attrs.extend([self._erase_attr] * n)
+        elif final == "L":
+            if self._top <= self.y <= self._bottom:
+                self._scroll_down(n, self.y)
+                self.x = 0
+        elif final == "M":
+            if self._top <= self.y <= self._bottom:
+                self._scroll_up_in_place(n)
+                self.x = 0
+        elif final == "S":
+            self._scroll_up(n)
+        elif final == "T":
+            self._scroll_down(n)
+        elif final == "r":
+            top = (a or 1) - 1
+            bottom = ((args[1] if len(args) > 1 else 0) or rows) - 1
+            if top < bottom < rows:
+                self._top, self._bottom = top, bottom
+                self.x = self.y = 0
+        elif final == "s":
+            self._saved = (self.x, self.y, self._attr)
+        elif final == "u":
+            self.x, self.y, attr = self._saved
+            self._set_attr_id(attr)
+
+    def _scroll_up_in_place(self, n: int) -> None:
+        """
+        Deletes n lines at the cursor (CSI M); they do not go to history.
+        """
+        bottom = self._bottom
+        n = min(n, bottom - self.y + 1)
+        for _ in range(n):
+            del self._lines[self.y], self._attrs[self.y]
+            line, attrs = self._blank_row()
+            self._lines.insert(bottom, line)
+            self._attrs.insert(bottom, attrs)
+
+    def _dec_modes(self, params: str, on: bool) -> None:
+        for p in params.split(";"):
+            if p in ("1049", "47", "1047"):
+                self._alt_screen(on, save_cursor=p == "1049")
+            elif p == "25":
+                self.cursor_visible = on
+            elif p == "7":
+                self.autowrap = on
+            elif p == "1":
+                self.app_cursor = on
+            elif p == "2004":
+                self.bracketed_paste = on
+
+    def _alt_screen(self, on: bool, save_cursor: bool) -> None:
+        if on and self._alt is None:
+            self._alt = (self._lines, self._attrs, (self.x, self.y))
+            self._lines, self._attrs = self._blank_grid()
+        elif not on and self._alt is not None:
+            self._lines, self._attrs, cursor = self._alt
+            self._alt = None
+            if save_cursor:
+                self.x, self.y = cursor
+        self._wrap_pending = False
+
+    def _set_sgr(self, params: str) -> None:
+        key = (self._attr, params)
+        cached = self._sgr_cache.get(key)
+        if cached is not None:
+            self._attr, self._erase_attr = cached
+            return
+        if len(self._attr_sgr) >= self._attr_limit:
+            self._compact_attrs()
+            key = (self._attr, params)
+        if len(self._sgr_cache) >= SCREEN_ATTRS_MAX:
+            self._sgr_cache.clear()
+        self._parse_sgr(params)
+        self._sgr_cache[key] = (self._attr, self._erase_attr)
+
+    def _compact_attrs(self) -> None:
+        """
+        Renumbers the renditions still used on screen, in history or by the
+        cursor and drops the others, along with the SGR cache, so a program
+        that cycles through many colours does not grow the tables for good.
+        """
+        grids = [self._attrs]
+        if self._alt is not None:
+            grids.append(self._alt[1])
+        used = {0, self._attr, self._erase_attr, self._saved[2]}
+        for grid in grids:
+            for row in grid:
+                used.update(row)
+        for line, attrs in self.history:
+            if isinstance(line, str):
+                used.add(attrs)
+            else:
+                used.update(attrs)
+        kept = sorted(used)
+        remap = {attr: i for i, attr in enumerate(kept)}
+        for grid in grids:
+            for row in grid:
+                row[:] = [remap[a] for a in row]
+        rows = [
+            (line, remap[attrs] if isinstance(line, str) else [remap[a] for a in attrs])
+            for line, attrs in self.history
+        ]
+        self.history.clear()
+        self.history.extend(rows)
+        self._attr_sgr = [self._attr_sgr[a] for a in kept]
+        self._attr_state = [self._attr_state[a] for a in kept]
+        self._attr_ids = {sgr: i for i, sgr in enumerate(self._attr_sgr)}
+        self._attr, self._erase_attr = remap[self._attr], remap[self._erase_attr]
+        x, y, attr = self._saved
+        self._saved = (x, y, remap[attr])
+        self._sgr_cache.clear()
+        # If most ids are still in use, let the tables grow before the next pass.
+        self._attr_limit = max(SCREEN_ATTRS_MAX, 2 * len(kept))
+
+    def _parse_sgr(self, params: str) -> None:
+        sgr = dict(self._attr_state[self._attr])
+        args = params.split(";") if params else ["0"]
+        i = 0
+        while i < len(args):
+            p = args[i] or "0"
+            if p == "0":
+                sgr.clear()
+            elif p in ("38", "48", "58"):
+                key = "fg" if p == "38" else "bg" if p == "48" else "ul"
+                if i + 1 < len(args) and args[i + 1] == "5":
+                    sgr[key] = ";".join(args[i : i + 3])
+                    i += 2
+                elif i + 1 < len(args) and args[i + 1] == "2":
+                    sgr[key] = ";".join(args[i : i + 5])
+                    i += 4
+            elif p in ("39", "49", "59"):
+                sgr.pop("fg" if p == "39" else "bg" if p == "49" else "ul", None)
+            elif len(p) == 2 and p[0] in "39" and p[1] in "01234567":
+                sgr["fg"] = p
+            elif len(p) == 2 and p[0] == "4" or len(p) == 3 and p[:2] == "10":
+                sgr["bg"] = p
+            elif p == "22":
+                sgr.pop("1", None)
+                sgr.pop("2", None)
+            elif len(p) == 2 and p[0] == "2":
+                sgr.pop(p[1], None)
+            else:
+                sgr[p] = p
+            i += 1
+        self._set_attr_id(self._attr_id(sgr))
+
+    def _attr_id(self, state: Dict[str, str]) -> int:
+        sgr = ";".join(state[k] for k in sorted(state))
+        attr = self._attr_ids.get(sgr)
+        if attr is None:
+            attr = self._attr_ids[sgr] = len(self._attr_sgr)
+            self._attr_sgr.append(sgr)
+            self._attr_state.append(state)
+        return attr
+
+    def _set_attr_id(self, attr: int) -> None:
+        self._attr = attr
+        bg = self._attr_state[attr].get("bg")
+        self._erase_attr = self._attr_id({"bg": bg}) if bg else 0
+
+    def resize(self, cols: int, rows: int) -> None:
+        """
+        Follows a terminal resize: rows are cut or padded on the right, and
+        lines leave through the top (into history) or the bottom so that the
+        cursor stays on screen.
+        """
+        cols, rows = max(1, cols), max(1, rows)
+        grids = [(self._lines, self._attrs)]
+        if self._alt is not None:
+            grids.append((self._alt[0], self._alt[1]))
+        for lines, attrs in grids:
+            for line, row_attrs in zip(lines, attrs):
+                if cols < self.cols:
+                    del line[cols:], row_attrs[cols:]
+                else:
+                    line.extend([" "] * (cols - self.cols))
+                    row_attrs.extend([0] * (cols - self.cols))
+        self.cols = cols
+        main = grids[-1][0]
+        while self.rows > rows:
+            # Lines below the cursor go first, then lines above it.
+            top = self.y >= rows
+            for lines, attrs in grids:
+                line, row_attrs = lines.pop(0 if top else -1), attrs.pop(0 if top else -1)
+                if top and lines is main:
+                    self.history.append((line, row_attrs))
+            if top:
+                self.y -= 1
+            self.rows -= 1
+        while self.rows < rows:
+            for lines, attrs in grids:
+                lines.append([" "] * cols)
+                attrs.append([0] * cols)
+            self.rows += 1
+        self._top, self._bottom = 0, rows - 1
+        self.x, self.y = min(self.x, cols - 1), min(self.y, rows - 1)
+        self._wrap_pending = False
+
+    def _render_line(self, line: Any, attrs: Any, out: List[str]) -> None:
+        if isinstance(line, str):
+            # A history line kept as (text, attr)
+            out.append(f"\x1b[0;{self._attr_sgr[attrs]}m{line}\x1b[0m" if attrs else line)
+            return
+        end = len(line)
+        while end and line[end - 1] == " " and attrs[end - 1] == 0:
+            end -= 1
+        attr = 0
+        start = 0
+        for i in range(end):
+            if attrs[i] != attr:
+                out.append("".join(line[start:i]))
+                attr = attrs[i]
+                out.append(f"\x1b[0;{self._attr_sgr[attr]}m" if attr else "\x1b[0m")
+                start = i
+        out.append("".join(line[start:end]))
+        if attr:
+            out.append("\x1b[0m")
+
+    def snapshot(self, history: bool = True) -> bytes:
+        """
+        Renders the screen, optionally preceded by the history, as output that
+        reproduces it in a terminal of the same size, including cursor, modes,
+        title and the current rendition.
+        """
+        out = ["\x1b[0m\x1b[H\x1b[2J"]
+        main = self._alt if self._alt is not None else (self._lines, self._attrs)
+        rows = list(self.history) if history else []
+        rows += zip(main[0], main[1])
+        for i, (line, attrs) in enumerate(rows):
+            if i:
+                out.append("\r\n")
+            self._render_line(line, attrs, out)
+        if self._alt is not None:
+            out.append("\x1b[?1049h\x1b[H")
+            for i, (line, attrs) in enumerate(zip(self._lines, self._attrs)):
+                out.append(f"\x1b[{i + 1}H")
+                self._render_line(line, attrs, out)
+        if (self._top, self._bottom) != (0, self.rows - 1):
+            out.append(f"\x1b[{self._top + 1};{self._bottom + 1}r")
+        if not self.autowrap:
+            out.append("\x1b[?7l")
+        if self.app_cursor:
+            out.append("\x1b[?1h")
+        if self.bracketed_paste:
+            out.append("\x1b[?2004h")
+        if self.title:
+            out.append(f"\x1b]2;{self.title}\x07")
+        out.append(f"\x1b[{self.y + 1};{self.x + 1}H")
+        if self._attr:
+            out.append(f"\x1b[0;{self._attr_sgr[self._attr]}m")
+        if self._g0_graphics:
+            out.append("\x1b(0")
+        out.append("\x1b[?25h" if self.cursor_visible else "\x1b[?25l")
+        return "".join(out).encode("utf-8")
+
+
+def server_handshake(sock: "socket.socket", authkey: bytes) -> None:
+    """
+    Runs multiprocessing.connection's mutual authkey challenge on an accepted socket,
+    exactly as Listener.accept() would. The socket is left blocking.
+    Raises if the peer fails the challenge or stalls for HANDSHAKE_TIMEOUT.
+    """
+    import socket
+    from multiprocessing.connection import Connection, answer_challenge, deliver_challenge
+
+    sock.setblocking(True)
+    # SO_RCVTIMEO keeps the fd blocking for Connection but bounds a stalled peer.
+    sock.setsockopt(
+        socket.SOL_SOCKET, socket.SO_RCVTIMEO, struct.pack("ll", HANDSHAKE_TIMEOUT, 0)
+    )
+    conn = Connection(os.dup(sock.fileno()))
+    try:
+        deliver_challenge(conn, authkey)
+        answer_challenge(conn, authkey)
+    finally:
+        conn.close()
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVTIMEO, struct.pack("ll", 0, 0))
+
+
+def accept_client(
+    reactor: "Reactor",
+    sock: "socket.socket",
+    authkey: bytes,
+    serve: Callable[["SessionClient"], None],
+    who: str,
+) -> None:
+    """
+    Wraps an accepted socket in a SessionClient and calls serve(client) on the
+    reactor's thread. With an authkey (TCP) the handshake runs on a thread of
+    its own first, so a slow or stalled peer never holds up the reactor.
+    """
+    from multiprocessing.connection import Connection
+
+    if not authkey:
+        sock.setblocking(True)
+        serve(SessionClient(Connection(sock.detach())))
+        return
+
+    def handshake() -> None:
+        try:
+            server_handshake(sock, authkey)
+        except Exception as e:
+            log(f"{who} client handshake failed ({e})", WARNING)
+            sock.close()
+            return
+        client = SessionClient(Connection(sock.detach()))
+        reactor.call_soon_threadsafe(lambda: serve(client))
+
+    threading.Thread(target=handshake, name="run_in_terminal_handshake", daemon=True).start()
+
+
+def read_frames(sock: "socket.socket", buf: bytearray) -> List[bytes]:
+    """
+    Reads what sock has without blocking into buf and returns the payloads of the
+    multiprocessing.connection frames it completed. A partial frame stays in buf
+    until the rest arrives. Raises EOFError once the peer has closed the connection.
+    """
+    import socket
+
+    try:
+        data = sock.recv(CLIENT_READ_CHUNK, socket.MSG_DONTWAIT)
+    except (BlockingIOError, InterruptedError):
+        return []
+    if not data:
+        raise EOFError("connection closed")
+    buf += data
+    frames = []
+    pos = 0
+    while len(buf) - pos >= 4:
+        (n,) = struct.unpack_from("!i", buf, pos)
+        start = pos + 4
+        if n == -1:
+            if len(buf) - pos < 12:
+                break
+            (n,) = struct.unpack_from("!Q", buf, start)
+            start += 8
+        elif n < 0:
+            raise ValueError(f"bad frame length {n}")
+        if len(buf) - start < n:
+            break
+        frames.append(bytes(buf[start : start + n]))
+        pos = start + n
+    del buf[:pos]
+    return frames
+
+
+# EVENT_READ and EVENT_WRITE, for registering with the Reactor
+# without importing selectors on the host's cold path.
+EVENT_READ, EVENT_WRITE = 1, 2
+
+
+class Reactor:
+    """
+    Single-threaded event loop on top of selectors (POSIX only).
+    Dispatches ready file descriptors and due timers to callbacks, so a daemon can
+    serve its PTY, listener and all clients without sleep-polling or a thread per connection.
+    """
+
+    running: bool = False
+
+    def __init__(self):
+        import selectors
+
+        self._sel = selectors.DefaultSelector()
+        self._timers: List[List[Any]] = []
+        self._seq = 0
+        self._calls: List[Callable[[], None]] = []
+        self._calls_lock = threading.Lock()
+        self._wake_r, self._wake_w = os.pipe()
+        os.set_blocking(self._wake_r, False)
+        os.set_blocking(self._wake_w, False)
+        self._sel.register(self._wake_r, EVENT_READ, self._on_wake)
+
+    def register(self, fd: int, events: int, callback: Callable[[int], None]) -> None:
+        """
+        Calls callback(mask) whenever fd is ready for any of events.
+        Re-registering an fd replaces its events and callback.
+        """
+        try:
+            self._sel.modify(fd, events, callback)
+        except KeyError:
+            self._sel.register(fd, events, callback)
+
+    def unregister(self, fd: int) -> None:
+        """
+        Stops watching fd. Unknown fds are ignored.
+        """
+        try:
+            self._sel.unregister(fd)
+        except (KeyError, ValueError):
+            pass
+
+    def call_later(self, delay: float, callback: Callable[[], None]) -> List[Any]:
+        """
+        Runs callback once after delay seconds. Returns a handle for cancel().
+        """
+        from heapq import heappush
+
+        self._seq += 1
+        timer = [time.monotonic() + delay, self._seq, callback]
+        heappush(self._timers, timer)
+        return timer
+
+    def cancel(self, timer: Optional[List[Any]]) -> None:
+        """
+        Cancels a pending call_later() timer.
+        """
+        if timer:
+            timer[2] = None
+
+    def call_soon_threadsafe(self, callback: Callable[[], None]) -> None:
+        """
+        Schedules callback on the loop thread from any thread.
+        """
+        with self._calls_lock:
+            self._calls.append(callback)
+        self._wake()
+
+    def _wake(self) -> None:
+        try:
+            os.write(self._wake_w, b"\0")
+        except OSError:
+            pass
+
+    def _on_wake(self, _mask: int) -> None:
+        try:
+            while os.read(self._wake_r, 4096):
+                pass
+        except OSError:
+            pass
+
+    def _next_timeout(self) -> Optional[float]:
+        from heapq import heappop
+
+        while self._timers and self._timers[0][2] is None:
+            heappop(self._timers)
+        if not self._timers:
+            return None
+        return max(0.0, self._timers[0][0] - time.monotonic())
+
+    def _run_callback(self, callback: Callable[..., None], *args: Any) -> None:
+        try:
+            callback(*args)
+        except Exception as e:
+            log(f"Reactor callback {callback} failed ({e})", ERROR)
+
+    def run(self) -> None:
+        """
+        Runs until stop() is called.
+        """
+        from heapq import heappop
+
+        self.running = True
+        while self.running:
+            for key, mask in self._sel.select(self._next_timeout()):
+                self._run_callback(key.data, mask)
+                if not self.running:
+                    return
+            now = time.monotonic()
+            while self._timers and self._timers[0][0] <= now:
+                _, _, callback = heappop(self._timers)
+                if callback:
+                    self._run_callback(callback)
+            with self._calls_lock:
+                calls, self._calls = self._calls, []
+            for callback in calls:
+                self._run_callback(callback)
+
+    def stop(self) -> None:
+        """
+        Makes run() return after the current callback. Safe to call from any thread.
+        """
+        self.running = False
+        self._wake()
+
+    def close(self) -> None:
+        """
+        Releases the selector and wakeup pipe.
+        """
+        self._sel.close()
+        for fd in (self._wake_r, self._wake_w):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+
+def frame_header(n: int) -> bytes:
+    """
+    The length prefix Connection.send_bytes() puts in front of an n byte payload.
+    """
+    if n > 0x7FFFFFFF:
+        return struct.pack("!iQ", -1, n)
+    return struct.pack("!i", n)
+
+
+def encode_control(msg: Dict[str, Any]) -> bytes:
+    """
+    Encodes a command or event as a binary control frame.
+    """
+    return bytes((FRAME_CONTROL,)) + json.dumps(msg, separators=(",", ":")).encode(
+        "utf-8"
+    )
+
+
+def encode_stdin(data: bytes) -> bytes:
+    """
+    Encodes terminal input as a binary stdin frame.
+    """
+    return bytes((FRAME_STDIN,)) + data
+
+
+def decode_frame(buf: bytes) -> Any:
+    """
+    Decodes one frame received from the daemon or a client.
+    Binary data and stdin frames carry their raw payload under "data";
+    legacy pickled messages are returned as they are.
+    """
+    kind = buf[0] if buf else None
+    if kind == FRAME_DATA:
+        return {"type": "data", "data": memoryview(buf)[1:]}
+    if kind == FRAME_STDIN:
+        return {"cmd": "stdin", "data": memoryview(buf)[1:]}
+    if kind == FRAME_CONTROL:
+        return json.loads(buf[1:])
+    import pickle
+
+    return pickle.loads(buf)
+
+
+def stdin_message(
+    data: bytes, input_id: Optional[str] = None, paste: bool = False
+) -> Dict[str, Any]:
+    """
+    A stdin command for input that needs more than a bare stdin frame carries.
+    """
+    msg: Dict[str, Any] = {
+        "cmd": "stdin",
+        "data_b64": base64.b64encode(data).decode("ascii"),
+    }
+    if input_id is not None:
+        msg["id"] = str(input_id)
+    if paste:
+        msg["paste"] = True
+    return msg
+
+
+def is_binary_frame(buf: bytes) -> bool:
+    """
+    True unless buf is a legacy pickled message.
+    """
+    return buf[:1] != b"\x80"
+
+
+class EventFrame:
+    """
+    One daemon -> client event, encoded at most once per wire format
+    no matter how many clients receive it.
+    """
+
+    __slots__ = ("msg", "data", "_binary", "_legacy")
+
+    def __init__(
+        self, msg: Optional[Dict[str, Any]] = None, data: Optional[bytes] = None
+    ):
+        self.msg = msg
+        self.data = data
+        self._binary: Optional[bytes] = None
+        self._legacy: Optional[bytes] = None
+
+    def binary(self) -> bytes:
+        if self._binary is None:
+            if self.data is not None:
+                self._binary = bytes((FRAME_DATA,)) + self.data
+            else:
+                self._binary = encode_control(self.msg or {})
+        return self._binary
+
+    def legacy(self) -> bytes:
+        if self._legacy is None:
+            msg = self.msg
+            if self.data is not None:
+                msg = {
+                    "type": "data",
+                    "data_b64": base64.b64encode(self.data).decode("ascii"),
+                }
+            import pickle
+
+            self._legacy = pickle.dumps(msg)
+        return self._legacy
+
+
+class SessionClient:
+    """
+    One client of a SessionServer: the wire format it negotiated and its own
+    bounded output queue, so a slow client never blocks the PTY or the others.
+    send_frame() queues and writes what the connection takes without blocking;
+    pump() writes the rest once the serving loop sees the connection writable.
+    on_backlog is called whenever the client starts or stops having a backlog.
+    On Windows a writer thread does blocking sends from the queue instead.
+    Beyond CLIENT_COALESCE_BYTES queued data frames are merged, beyond
+    CLIENT_QUEUE_MAX the backlog is replaced by a resync event and the client is
+    doomed: the server drops it once that event is out.
+    conn: Connection, or AsyncClientConn for the asyncio server
+    binary: client asked for binary frames in its attach message
+    probe: client attached only to ask something, like list does
+    queued: bytes waiting in the queue, i.e. the client's queue depth
+    """
+
+    conn: Any
+    binary: bool = False
+    probe: bool = False
+    queued: int = 0
+    backlogged: bool = False
+    doomed: bool = False
+    draining: bool = False
+    closed: bool = False
+    on_backlog: Optional[Callable[["SessionClient"], None]] = None
+
+    def __init__(self, conn: Any):
+        self.conn = conn
+        # [frame, payload, wire bytes written, wire length]
+        self._queue: Deque[List[Any]] = deque()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._writer: Optional[threading.Thread] = None
+        self._sock: Optional["socket.socket"] = None
+        self._inbuf = bytearray()
+
+    def send(self, msg: Dict[str, Any]) -> None:
+        self.send_frame(EventFrame(msg))
+
+    def send_frame(self, frame: EventFrame) -> None:
+        """
+        Queues frame and writes as much as possible without blocking.
+        Raises OSError if the connection is broken.
+        """
+        with self._lock:
+            if self.doomed or self.closed:
+                return
+            overflow = False
+            if not (
+                frame.data is not None
+                and self.queued > CLIENT_COALESCE_BYTES
+                and self._merge_tail(frame)
+            ):
+                payload = frame.binary() if self.binary else frame.legacy()
+                n = len(frame_header(len(payload))) + len(payload)
+                self._queue.append([frame, payload, 0, n])
+                self.queued += n
+            if self.queued > CLIENT_QUEUE_MAX:
+                self._overflow()
+                overflow = True
+            if self._writer:
+                self._wakeup.notify()
+                return
+        self.pump(notify=overflow)
+
+    def _merge_tail(self, frame: EventFrame) -> bool:
+        """
+        Appends frame's data to the last queued data frame, if that has not
+        started going out and stays within one Native Messaging message.
+        """
+        tail = self._queue[-1] if self._queue else None
+        if not tail or tail[2] or tail[0].data is None:
+            return False
+        data = tail[0].data + frame.data
+        if len(data) > MAX_DATA_FRAME:
+            return False
+        merged = EventFrame(data=data)
+        payload = merged.binary() if self.binary else merged.legacy()
+        n = len(frame_header(len(payload))) + len(payload)
+        self.queued += n - tail[3]
+        tail[:] = [merged, payload, 0, n]
+        return True
+
+    def _overflow(self) -> None:
+        """
+        Replaces the backlog with a resync event. A frame already partly
+        written is kept so the stream stays well-formed.
+        """
+        log(f"Client {self.fileno()} {self.queued} bytes behind, resyncing", WARNING)
+        head = self._queue[0] if self._queue and self._queue[0][2] else None
+        self._queue.clear()
+        self.queued = 0
+        if head:
+            self._queue.append(head)
+            self.queued = head[3] - head[2]
+        resync = EventFrame({"type": "resync", "reason": "client fell behind"})
+        payload = resync.binary() if self.binary else resync.legacy()
+        n = len(frame_header(len(payload))) + len(payload)
+        self._queue.append([resync, payload, 0, n])
+        self.queued += n
+        self.doomed = True
+
+    def pump(self, notify: bool = False) -> bool:
+        """
+        Writes queued frames until the queue is empty or the connection would block.
+        Returns True once the queue is empty. Raises OSError if the connection is broken.
+        """
+        with self._lock:
+            while self._queue:
+                try:
+                    n = self._write_some(self._segments())
+                except (BlockingIOError, InterruptedError):
+                    n = 0
+                if not n:
+                    break
+                self._consume(n)
+            was, self.backlogged = self.backlogged, bool(self._queue)
+        if (notify or was != self.backlogged) and self.on_backlog:
+            self.on_backlog(self)
+        return not self.backlogged
+
+    def _segments(self) -> List[Any]:
+        """
+        The unwritten wire bytes of the first queued frames, for one gathered write.
+        """
+        from itertools import islice
+
+        segments: List[Any] = []
+        for _, payload, done, _ in islice(self._queue, 64):
+            hdr = frame_header(len(payload))
+            if done < len(hdr):
+                segments.append(memoryview(hdr)[done:])
+                segments.append(payload)
+            else:
+                segments.append(memoryview(payload)[done - len(hdr) :])
+        return segments
+
+    def _consume(self, n: int) -> None:
+        self.queued -= n
+        while n:
+            item = self._queue[0]
+            left = item[3] - item[2]
+            if n < left:
+                item[2] += n
+                return
+            self._queue.popleft()
+            n -= left
+
+    def _write_some(self, segments: List[Any]) -> int:
+        write_some = getattr(self.conn, "write_some", None)
+        if write_some:
+            return write_some(segments)
+        import socket
+
+        return self._dup_socket().sendmsg(segments, (), socket.MSG_DONTWAIT)
+
+    def _dup_socket(self) -> "socket.socket":
+        """
+        A dup of the connection for MSG_DONTWAIT sends and reads, so the fd
+        itself stays blocking for conn.
+        """
+        import socket
+
+        if self._sock is None:
+            self._sock = socket.socket(fileno=os.dup(self.conn.fileno()))
+        return self._sock
+
+    def start_writer(self) -> None:
+        """
+        Sends from the queue on a thread of its own, for connections that
+        cannot be written without blocking (Windows).
+        """
+        self._writer = threading.Thread(
+            target=self._writer_loop, name="run_in_terminal_client_writer", daemon=True
+        )
+        self._writer.start()
+
+    def _writer_loop(self) -> None:
+        while True:
+            with self._wakeup:
+                while not self._queue and not self.closed:
+                    self._wakeup.wait()
+                if self.closed:
+                    return
+                item = self._queue.popleft()
+                self.queued -= item[3]
+                last = self.doomed and not self._queue
+            try:
+                self.conn.send_bytes(item[1])
+            except Exception:
+                last = True
+            if last:
+                # The client loop sees the closed connection and drops the client.
+                self.close()
+                return
+
+    def recv(self) -> Any:
+        return decode_frame(self.conn.recv_bytes())
+
+    def recv_ready(self) -> List[Any]:
+        """
+        Reads what the connection has without blocking and returns the messages
+        it completed. A partial frame stays buffered until the rest arrives.
+        Raises EOFError once the peer has closed the connection.
+        """
+        frames = read_frames(self._dup_socket(), self._inbuf)
+        return [decode_frame(frame) for frame in frames]
+
+    def fileno(self) -> int:
+        return self.conn.fileno()
+
+    def close(self) -> None:
+        with self._wakeup:
+            self.closed = True
+            self._queue.clear()
+            self.queued = 0
+            self._wakeup.notify()
+        if self._sock is not None:
+            self._sock.close()
+        self.conn.close()
+
+
+def open_listener(name: str) -> Tuple["socket.socket", Optional[str], str, int]:
+    """
+    Opens a non-blocking listener socket for the daemon published as name:
+    AF_UNIX under sockets_dir() where available, else TCP on 127.0.0.1, which
+    must be guarded by the authkey handshake.
+    Returns the socket, its path (None for TCP), host and port.
+    """
+    import socket
+
+    if USE_UNIX_SOCKETS:
+        path = str(socket_path(name))
+        if len(os.fsencode(path)) <= UNIX_PATH_MAX:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.bind(path)
+                sock.listen()
+            except OSError as e:
+                sock.close()
+                log(f"Listener[{name}] unix socket failed, using tcp ({e})", WARNING)
+            else:
+                sock.setblocking(False)
+                return sock, path, "", 0
+        else:
+            log(f"Listener[{name}] socket path too long, using tcp", WARNING)
+    sock = socket.create_server(("127.0.0.1", 0))
+    sock.setblocking(False)
+    host, port = sock.getsockname()[:2]
+    return sock, None, host, port
+
+
+class SessionRecorder:
+    """
+    Appends what happens in a session to an asciicast v2 file in
+    recordings_dir(): output ("o"), typed input ("i"), resizes ("r") and
+    markers ("m") for output that was not recorded. The serving thread only
+    queues timestamped chunks; the recorder's own thread decodes and writes
+    them in batches, so a slow disk never holds up the PTY reader. Output that
+    is not valid UTF-8 is recorded with replacement characters, as asciicast
+    events are text.
+    Every RECORD_INDEX_BYTES of file or RECORD_INDEX_SECONDS of session time,
+    a (seconds, offset) pair of the next event is added to an index file next
+    to the recording, which RecordingReader uses to seek by time.
+    """
+
+    INDEX_ENTRY = struct.Struct("<dQ")
+
+    def __init__(self, name: str, cols: int, rows: int, shell: Optional[str], stats: Stats):
+        import codecs
+
+        stem = recordings_dir() / f"{name}-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}"
+        self.path = Path(f"{stem}.cast")
+        self.stats = stats
+        self._start = time.monotonic()
+        self._cond = threading.Condition()
+        self._queue: List[Tuple[float, str, bytes]] = []
+        self._queued = 0
+        self._dropped = 0
+        self._closing = False
+        self._failed = False
+        self._decoders = {
+            kind: codecs.getincrementaldecoder("utf-8")(errors="replace") for kind in "oi"
+        }
+        flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, "O_BINARY", 0)
+        self._file = open(os.open(self.path, flags, 0o600), "wb")
+        try:
+            self._index = open(os.open(f"{stem}.idx", flags, 0o600), "wb")
+        except OSError:
+            self._file.close()
+            raise
+        header = {
+            "version": 2,
+            "width": cols,
+            "height": rows,
+            "timestamp": int(time.time()),
+            "title": name,
+            "env": {"SHELL": shell or os.environ.get("SHELL", ""), "TERM": "xterm-256color"},
+        }
+        self._file.write(json.dumps(header).encode("utf-8") + b"\n")
+        self._offset = self._file.tell()
+        self._next_index_offset = self._offset
+        self._next_index_time = 0.0
+        self._thread = threading.Thread(
+            target=self._run, name=f"run_in_terminal_recorder_{name}", daemon=True
+        )
+        self._thread.start()
+
+    def output(self, data: bytes) -> None:
+        self._put("o", data)
+
+    def input(self, data: bytes) -> None:
+        if RECORD_INPUT:
+            self._put("i", data)
+
+    def resize(self, cols: int, rows: int) -> None:
+        self._put("r", f"{cols}x{rows}".encode("ascii"))
+
+    def _put(self, kind: str, data: bytes) -> None:
+        with self._cond:
+            if self._closing:
+                return
+            if self._queued + len(data) > RECORD_QUEUE_MAX:
+                self._dropped += len(data)
+                return
+            t = time.monotonic() - self._start
+            if self._dropped:
+                note = f"recorder dropped {self._dropped} bytes".encode("ascii")
+                self._queue.append((t, "m", note))
+                self.stats.add("record_dropped_bytes", self._dropped)
+                self._dropped = 0
+            self._queue.append((t, kind, data))
+            self._queued += len(data)
+            if len(self._queue) == 1:
+                self._cond.notify()
+
+    def _run(self) -> None:
+        try:
+            while True:
+                with self._cond:
+                    while not self._queue and not self._closing:
+                        self._cond.wait()
+                    if not self._queue:
+                        return
+                    if not self._closing:
+                        # Batching window; only close() wakes us early.
+                        self._cond.wait(RECORD_BATCH_DELAY)
+                    batch, self._queue, self._queued = self._queue, [], 0
+                self._write(batch)
+        finally:
+            self._file.close()
+            self._index.close()
+
+    def _write(self, batch: List[Tuple[float, str, bytes]]) -> None:
+        if self._failed:
+            return
+        lines: List[bytes] = []
+        index: List[bytes] = []
+        offset = self._offset
+        for t, kind, data in batch:
+            decoder = self._decoders.get(kind)
+            text = decoder.decode(data) if decoder else data.decode("ascii")
+            if not text:
+                continue
+            if offset >= self._next_index_offset or t >= self._next_index_time:
+                index.append(self.INDEX_ENTRY.pack(t, offset))
+                self._next_index_offset = offset + RECORD_INDEX_BYTES
+                self._next_index_time = t + RECORD_INDEX_SECONDS
+            line = json.dumps([round(t, 6), kind, text], ensure_ascii=False).encode("utf-8")
+            lines.append(line + b"\n")
+            offset += len(line) + 1
+        try:
+            # The recording first, so the index never points past its end.
+            self._file.write(b"".join(lines))
+            self._file.flush()
+            self._index.write(b"".join(index))
+            self._index.flush()
+        except OSError as e:
+            self._failed = True
+            log(f"SessionRecorder[{self.path.name}] stopped recording: {e}", ERROR)
+            return
+        self.stats.add("record_bytes", offset - self._offset)
+        self._offset = offset
+
+    def close(self, wait: float = 5.0) -> None:
+        """
+        Writes out what is queued and closes the files, waiting up to `wait`
+        seconds for the writer thread.
+        """
+        with self._cond:
+            self._closing = True
+            self._cond.notify()
+        self._thread.join(wait)
+
+
+class RecordingReader:
+    """
+    Reads a recording written by SessionRecorder. The file is mapped rather
+    than read, and events from a point in time on start at the last index entry
+    before it, so jumping to the end of a long recording does not parse it from
+    the beginning. Recordings still being written can be read too; events
+    written after the reader was opened are not seen.
+    """
+
+    def __init__(self, path: Path):
+        import mmap
+
+        self.path = path
+        with open(path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        end = self._map.find(b"\n")
+        self.header: Dict[str, Any] = json.loads(self._map[:end])
+        self._data_start = end + 1
+        # The complete lines; the writer may be in the middle of the next one.
+        self._data_end = self._map.rfind(b"\n") + 1
+        self._times: List[float] = []
+        self._offsets: List[int] = []
+        try:
+            raw = path.with_suffix(".idx").read_bytes()
+        except OSError:
+            raw = b""
+        size = SessionRecorder.INDEX_ENTRY.size
+        entries = SessionRecorder.INDEX_ENTRY.iter_unpack(raw[: len(raw) // size * size])
+        for t, offset in entries:
+            if offset < self._data_end:
+                self._times.append(t)
+                self._offsets.append(offset)
+
+    def duration(self) -> float:
+        """
+        Returns the time of the last event.
+        """
+        if self._data_end <= self._data_start:
+            return 0.0
+        start = self._map.rfind(b"\n", 0, self._data_end - 1) + 1
+        return json.loads(self._map[start : self._data_end])[0]
+
+    def offset_at(self, t: float) -> int:
+        """
+        Returns the file offset of an event at or before the first event at `t`.
+        """
+        import bisect
+
+        i = bisect.bisect_right(self._times, t) - 1
+        return self._offsets[i] if i >= 0 else self._data_start
+
+    def events(
+        self, start: float = 0.0, end: Optional[float] = None
+    ) -> Iterator[Tuple[float, str, str]]:
+        """
+        Yields (seconds, kind, data) of the events from `start` to `end`.
+        """
+        m = self._map
+        pos = self.offset_at(start)
+        while pos < self._data_end:
+            nl = m.find(b"\n", pos)
+            t, kind, data = json.loads(m[pos:nl])
+            pos = nl + 1
+            if end is not None and t > end:
+                return
+            if t >= start:
+                yield t, kind, data
+
+    def close(self) -> None:
+        self._map.close()
+
+
+class SessionServer:
+    """
+    A single session daemon owning one PTY and serving multiple clients.
+    Clients connect using multiprocessing.connection, over the AF_UNIX socket in
+    WorkerInfo or, as a fallback, over TCP with its auth key.
+    A client may send attach as its first message to have the scrollback replayed
+    before live data starts and to switch to binary frames.
+    On POSIX the PTY, listener and all clients are served by one Reactor thread;
+    Windows falls back to blocking threads.
+    Incoming commands: attach, stdin, resize, ping, info, stats, snapshot, search, exec,
+    close.
+    Outgoing events: ready, data, exit, pong, info, stats, snapshot, search, exec.start,
+    exec.done.
+    stats counts PTY reads and writes (a read stall is a reader turn that hit
+    its bound with output still waiting, a write stall input the PTY had no
+    room for), published frames and bytes, client commands and stdin bytes,
+    and times each broadcast including the per-format encoding.
+    On POSIX the session also runs the governor (see GOVERNOR_INTERVAL).
+    """
+
+    name: str
+    shell: Optional[str]
+    cols: int
+    rows: int
+    stop_evt: threading.Event
+    clients: Set[SessionClient]
+    clients_lock: threading.Lock
+    pty: PTYShell
+    scrollback: ScrollbackRing
+    platform: Optional[str] = None
+    reactor: Optional[Reactor] = None
+    path: Optional[str] = None
+    supervisor: Optional["Supervisor"] = None
+    _closed: bool = False
+    # The shell came from the Supervisor's pool and no client has attached yet.
+    _pooled: bool = False
+    _bracketed_paste: bool = False
+    # The shell turned bracketed paste on at some point, so it reads pastes.
+    _shell_pastes: bool = False
+    _hibernated: bool = False
+    _rss_warned: bool = False
+    _input_blocked: bool = False
+    _pty_eof: bool = False
+
+    def __init__(self, name: str, shell: Optional[str], cols: int, rows: int):
+        self.name = name
+        self.shell = shell
+        self.cols = cols
+        self.rows = rows
+        self.stop_evt = threading.Event()
+        self.clients = set()
+        self.clients_lock = threading.Lock()
+        self.pty = PTYShell(shell=shell, cols=self.cols, rows=self.rows)
+        self.scrollback = ScrollbackRing(
+            SCROLLBACK_BYTES, scrollback_path(name) if SCROLLBACK_MMAP else None
+        )
+        self.coalescer = OutputCoalescer()
+        self._flush_timer: Optional[List[Any]] = None
+        self._pending: Dict[SessionClient, Any] = {}
+        self._started_at = time.perf_counter()
+        self._created_at = time.time()
+        self._first_output = False
+        # [data, client, id, written], written to the PTY front to back
+        self._input: Deque[List[Any]] = deque()
+        self._input_queued = 0
+        self._input_lock = threading.Lock()
+        self.screen = ScreenModel(cols, rows) if SCREEN_MODEL else None
+        # Output the screen model has not seen yet, guarded by clients_lock.
+        self._screen_pending: Deque[bytes] = deque()
+        self._screen_pending_bytes = 0
+        self._screen_timer: Optional[Any] = None
+        self.stats = Stats()
+        self.history = SearchHistory(SEARCH_HISTORY_BYTES) if SEARCH_HISTORY_BYTES else None
+        # The running search of each client; a new search replaces it.
+        self._searches: Dict[SessionClient, HistorySearch] = {}
+        # exec commands waiting to be typed, and the one the shell is running.
+        self._execs: Deque[ExecStep] = deque()
+        self._exec_running: Optional[ExecStep] = None
+        self._exec_tail = b""
+        self._exec_mark: Optional["re.Pattern[bytes]"] = None
+        self._last_activity = time.monotonic()
+        # Process groups hibernate() stopped, continued again by wake().
+        self._stopped_pgrps: List[int] = []
+        self.recorder: Optional[SessionRecorder] = None
+        if RECORD:
+            try:
+                self.recorder = SessionRecorder(name, cols, rows, shell, self.stats)
+            except OSError as e:
+                log(f"SessionSever[{name}] not recording: {e}", WARNING)
+
+    def broadcast(self, msg: Dict[str, Any]) -> None:
+        """
+        Sends a dict event to all connected clients, pruning broken connections.
+        """
+        with self.clients_lock:
+            self._broadcast_locked(EventFrame(msg))
+
+    def _broadcast_locked(self, frame: EventFrame) -> None:
+        """
+        broadcast() for callers already holding clients_lock.
+        """
+        dead = []
+        for c in list(self.clients):
+            try:
+                c.send_frame(frame)
+            except Exception:
+                dead.append(c)
+        for c in dead:
+            self.clients.discard(c)
+            self._drop_later(c)
+
+    def _drop_later(self, client: SessionClient) -> None:
+        """
+        Drops client from the serving loop, for callers that may hold clients_lock.
+        """
+        if self.reactor:
+            self._call_later(0, lambda: self._drop_client(client))
+        else:
+            # The client's thread notices the closed connection and drops it.
+            try:
+                client.close()
+            except Exception:
+                pass
+
+    def _on_client_backlog(self, client: SessionClient) -> None:
+        """
+        Watches a client for writability while it has a backlog, and drops a
+        doomed client once its resync event is out or its grace time is over.
+        """
+        if client.doomed:
+            if not client.backlogged:
+                self._drop_later(client)
+                return
+            self._call_later(RESYNC_GRACE, lambda: self._drop_client(client))
+        if self.reactor and not client.closed:
+            events = EVENT_READ
+            if client.backlogged:
+                events |= EVENT_WRITE
+            self.reactor.register(
+                client.fileno(), events, lambda mask: self._on_client_event(client, mask)
+            )
+
+    def publish(self, chunk: bytes) -> None:
+        """
+        Records PTY output in the scrollback and broadcasts it as a data event.
+        Both happen under clients_lock so an attaching client sees every byte exactly once.
+        """
+        if self._hibernated:
+            self.wake()
+        self._last_activity = time.monotonic()
+        if not self._first_output:
+            self._first_output = True
+            ms = (time.perf_counter() - self._started_at) * 1000
+            log(f"SessionSever[{self.name}] first output {ms:.1f} ms after start")
+        if b"\x1b[?2004" in chunk:
+            self._bracketed_paste = chunk.rfind(PASTE_MODE_ON) > chunk.rfind(PASTE_MODE_OFF)
+            self._shell_pastes = self._shell_pastes or PASTE_MODE_ON in chunk
+        self.stats.add("frames_out")
+        self.stats.add("bytes_out", len(chunk))
+        with self.clients_lock:
+            self.scrollback.append(chunk)
+            if self.history:
+                self.history.append(chunk)
+            t0 = time.perf_counter()
+            self._broadcast_locked(EventFrame(data=chunk))
+            self.stats.timed("broadcast", time.perf_counter() - t0)
+            if self.screen:
+                self._queue_screen(chunk)
+        if self.recorder:
+            self.recorder.output(chunk)
+        if self._exec_running:
+            self._scan_exec_marks(chunk)
+
+    def _queue_screen(self, chunk: bytes) -> None:
+        """
+        Queues output for the screen model. Caller holds clients_lock.
+        """
+        if IS_WIN:
+            # Threaded server: no event loop to defer to.
+            self.screen.feed(chunk)
+            return
+        self._screen_pending.append(chunk)
+        self._screen_pending_bytes += len(chunk)
+        if self._screen_pending_bytes > SCREEN_PENDING_MAX:
+            while self._screen_pending_bytes > SCREEN_PENDING_MAX // 2:
+                self._screen_pending_bytes -= len(self._screen_pending.popleft())
+            log(f"SessionSever[{self.name}] screen model fell behind, restarting it", WARNING)
+            self.screen.reset()
+        if self._screen_timer is None:
+            self._screen_timer = self._call_later(SCREEN_FEED_DELAY, self._feed_screen)
+
+    def _feed_screen(self) -> None:
+        """
+        Feeds the screen model a bounded slice of pending output.
+        """
+        self._screen_timer = None
+        with self.clients_lock:
+            self._catch_up_screen(SCREEN_FEED_BYTES)
+            if self._screen_pending:
+                self._screen_timer = self._call_later(0, self._feed_screen)
+
+    def _catch_up_screen(self, budget: int = -1) -> None:
+        """
+        Feeds pending output to the screen model, all of it by default.
+        Caller holds clients_lock.
+        """
+        while self._screen_pending and budget:
+            chunk = self._screen_pending.popleft()
+            self._screen_pending_bytes -= len(chunk)
+            self.screen.feed(chunk)
+            budget = max(0, budget - len(chunk)) if budget > 0 else budget
+
+    def screen_snapshot(self) -> Optional[bytes]:
+        """
+        The current screen as output that redraws it, or None without a screen model.
+        Caller holds clients_lock.
+        """
+        if not self.screen:
+            return None
+        self._catch_up_screen()
+        return self.screen.snapshot()
+
+    def _subscribe(self, client: SessionClient, replay: int, screen: bool = False) -> None:
+        """
+        Streams the last `replay` bytes of scrollback to client, then registers it for live data.
+        screen: send a snapshot of the screen model instead, if the session keeps one
+        """
+        with self.clients_lock:
+            history = self.screen_snapshot() if screen else None
+            if history is None:
+                history = self.scrollback.tail(replay) if replay else b""
+            for i in range(0, len(history), REPLAY_FRAME_BYTES):
+                client.send_frame(EventFrame(data=history[i : i + REPLAY_FRAME_BYTES]))
+            self.clients.add(client)
+
+    def _accept_loop(self, listener: "Listener") -> None:
+        """
+        Accepts clients and serves each in a thread (Windows).
+        """
+        while not self.stop_evt.is_set():
+            try:
+                conn = listener.accept()
+                if self.stop_evt.is_set():
+                    break
+
+                t = threading.Thread(
+                    target=self._client_loop,
+                    name=f"run_in_terminal_client_loop_{self.name}",
+                    args=(conn,),
+                    daemon=True,
+                )
+                t.start()
+            except Exception:
+                continue
+        log(f"SessionSever[{self.name}] accept loop ended")
+
+    def _client_loop(self, conn: "Connection") -> None:
+        """
+        Handles one client connection on its own thread (Windows).
+        """
+        client = SessionClient(conn)
+        client.start_writer()
+        first: Any = None
+        try:
+            if conn.poll(ATTACH_WAIT):
+                first = client.recv()
+        except Exception:
+            self._drop_client(client)
+            return
+        if isinstance(first, dict) and first.get("cmd") == "attach":
+            self._attach(client, first)
+            first = None
+        else:
+            self._attach(client, None)
+
+        try:
+            while not self.stop_evt.is_set():
+                if first is not None:
+                    msg, first = first, None
+                else:
+                    try:
+                        msg = client.recv()
+                    except (EOFError, OSError):
+                        break
+
+                if not self._handle_cmd(client, msg):
+                    break
+        finally:
+            self._drop_client(client)
+
+    def _handle_cmd(self, client: SessionClient, msg: Any) -> bool:
+        """
+        Executes one client command. Returns False once the client loop should end.
+        """
+        if not isinstance(msg, dict):
+            return True
+
+        cmd = msg.get("cmd")
+        self.stats.add("commands_in")
+        if self._hibernated and cmd not in ("info", "ping", "stats", "profile", "reap"):
+            self.wake()
+        if cmd == "stdin":
+            data = msg.get("data")
+            if data is None:
+                data = base64.b64decode(msg.get("data_b64", ""))
+            self.stats.add("stdin_bytes_in", len(data))
+            if data:
+                self.queue_input(
+                    client, bytes(data), msg.get("id"), bool(msg.get("paste"))
+                )
+        elif cmd == "resize":
+            self.pty.resize(msg.get("cols", self.cols), msg.get("rows", self.rows))
+            if self.recorder:
+                self.recorder.resize(self.pty.cols, self.pty.rows)
+            if self.screen:
+                with self.clients_lock:
+                    # Output so far was laid out for the old size.
+                    self._catch_up_screen()
+                    self.screen.resize(self.pty.cols, self.pty.rows)
+        elif cmd == "snapshot":
+            with self.clients_lock:
+                snapshot = self.screen_snapshot()
+            if snapshot is None:
+                reply = {"type": "snapshot", "error": "screen model disabled"}
+            else:
+                assert self.screen
+                reply = {
+                    "type": "snapshot",
+                    "cols": self.screen.cols,
+                    "rows": self.screen.rows,
+                    "cursor": [self.screen.x, self.screen.y],
+                    "title": self.screen.title,
+                    "data_b64": base64.b64encode(snapshot).decode("ascii"),
+                }
+            self._send_quietly(client, reply)
+        elif cmd == "search":
+            self._start_search(client, msg)
+        elif cmd == "exec":
+            self._queue_exec(client, msg)
+        elif cmd == "ping":
+            try:
+                client.send({"type": "pong"})
+            except Exception:
+                pass
+        elif cmd == "info":
+            with self.clients_lock:
+                others = [c for c in self.clients if c is not client]
+            try:
+                client.send(
+                    {
+                        "type": "info",
+                        "session": self.name,
+                        "platform": self.platform,
+                        "shell": self.shell,
+                        "scrollback": len(self.scrollback),
+                        "pid": os.getpid(),
+                        "uptime": time.time() - self._created_at,
+                        "idle": time.monotonic() - self._last_activity,
+                        "hibernated": self._hibernated,
+                        "clients": sum(1 for c in others if not c.probe),
+                        "queues": [c.queued for c in others],
+                    }
+                )
+            except Exception:
+                pass
+        elif cmd == "stats":
+            self._send_quietly(client, self.stats_message(client))
+        elif cmd == "profile":
+            self._send_quietly(client, profile_reply(msg))
+        elif cmd == "reap":
+            closing = not self.client_count(client)
+            reply = {"type": "reaped", "session": self.name, "closed": closing}
+            self._send_quietly(client, reply)
+            if closing:
+                self.reap(str(msg.get("reason") or "asked to"))
+                return False
+        elif cmd == "close":
+            log(f"SessionSever[{self.name}] client loop closing")
+            self.close()
+            return False
+        return True
+
+    def stats_message(self, asking: Optional[SessionClient] = None) -> Dict[str, Any]:
+        """
+        The stats event: counters, rates and timers plus the current client
+        queues (without the asking client's), input queue, scrollback and
+        search history.
+        """
+        snap = self.stats.snapshot()
+        counters = snap["counters"]
+        with self.clients_lock:
+            clients = [
+                {"queued": c.queued, "backlogged": c.backlogged, "binary": c.binary}
+                for c in self.clients
+                if c is not asking
+            ]
+        snap.update(
+            type="stats",
+            session=self.name,
+            pid=os.getpid(),
+            avg_frame_bytes=average(counters.get("bytes_out", 0), counters.get("frames_out", 0)),
+            clients=clients,
+            client_count=len(clients),
+            input_queued=self._input_queued,
+            scrollback=len(self.scrollback),
+            search_history=len(self.history.buf) if self.history else 0,
+        )
+        return snap
+
+    def _schedule_governor(self) -> None:
+        """
+        Has the event loop run the governor every GOVERNOR_INTERVAL seconds
+        while any of its policies is on.
+        """
+        if not IS_WIN and not self._closed and (HIBERNATE_IDLE or RSS_MAX):
+            self._call_later(GOVERNOR_INTERVAL, self._govern)
+
+    def _govern(self) -> None:
+        """
+        Applies the memory cap, then hibernates the session if it has been
+        idle long enough.
+        """
+        if self._closed:
+            return
+        idle = time.monotonic() - self._last_activity
+        attached = bool(self.client_count() or self._pending)
+        rss = self._rss() if RSS_MAX else None
+        if rss is not None and rss > RSS_MAX:
+            reason = f"using {rss / 2**20:.1f} MB, more than RIT_RSS_MAX_MB={RSS_MAX >> 20}"
+            if not attached:
+                self.reap(reason)
+                return
+            if not self._rss_warned:
+                log(f"SessionSever[{self.name}] {reason}; closing once detached", WARNING)
+                self._rss_warned = True
+        if (
+            HIBERNATE_IDLE
+            and idle >= HIBERNATE_IDLE
+            and not attached
+            and not self._hibernated
+            and not (self._exec_running or self._execs)
+        ):
+            self.hibernate()
+        self._schedule_governor()
+
+    def _rss(self) -> Optional[int]:
+        """
+        Memory used by the shell and, unless it is shared with other sessions
+        in a supervisor, the daemon. None where the platform does not tell.
+        """
+        pids = [] if self.supervisor else [os.getpid()]
+        if self.pty.proc:
+            pids.append(self.pty.proc.pid)
+        sizes = [process_rss(pid) for pid in pids]
+        return None if None in sizes else sum(s or 0 for s in sizes)
+
+    def client_count(self, asking: Optional[SessionClient] = None) -> int:
+        """
+        Clients attached to use the session, not counting probes and the asking client.
+        """
+        with self.clients_lock:
+            return sum(1 for c in self.clients if c is not asking and not c.probe)
+
+    def reap(self, reason: str) -> None:
+        """
+        Closes the session for a governor policy, logging why.
+        """
+        log(f"SessionSever[{self.name}] reaped: {reason}", WARNING)
+        self.close()
+
+    def hibernate(self) -> None:
+        """
+        Releases what a session needs only while someone is attached: the
+        scrollback (unless it is in a file) and the search history are written
+        to hibernate_dir() and freed, the recorder and its thread are closed,
+        and with RIT_HIBERNATE_STOP=1 the shell and its foreground job are
+        stopped. wake() brings all of it back when a client attaches or the
+        shell prints something.
+        """
+        with self.clients_lock:
+            if self.screen:
+                self._catch_up_screen()
+            # A JSON header line, then the scrollback and the history's text.
+            scrollback = self.scrollback.tail(-1) if self.scrollback.path is None else b""
+            header: Dict[str, Any] = {
+                "total": self.scrollback.total,
+                "scrollback": len(scrollback),
+            }
+            parts = [scrollback]
+            if self.history:
+                header["history"], text = self.history.saved()
+                parts += text
+            try:
+                flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+                with open(os.open(spill_path(self.name), flags, 0o600), "wb") as f:
+                    f.write(json.dumps(header).encode("ascii") + b"\n")
+                    f.writelines(parts)
+            except OSError as e:
+                log(f"SessionSever[{self.name}] not hibernating: {e}", WARNING)
+                return
+            self.scrollback.release()
+            self.history = None
+        del scrollback, parts
+        self._hibernated = True
+        if self.recorder:
+            self.recorder.close(wait=0 if self.supervisor else 5.0)
+            self.recorder = None
+        if HIBERNATE_STOP:
+            self._stop_shell()
+        release_memory()
+        idle = time.monotonic() - self._last_activity
+        log(f"SessionSever[{self.name}] hibernated after {idle:.0f}s idle")
+
+    def wake(self) -> None:
+        """
+        Undoes hibernate().
+        """
+        if not self._hibernated:
+            return
+        self._hibernated = False
+        self._last_activity = time.monotonic()
+        self._continue_shell()
+        path = spill_path(self.name)
+        scrollback = b""
+        history = None
+        try:
+            with open(path, "rb") as f:
+                header = json.loads(f.readline())
+                scrollback = f.read(header["scrollback"])
+                if len(scrollback) != header["scrollback"]:
+                    raise ValueError("scrollback cut short")
+                if SEARCH_HISTORY_BYTES and header.get("history"):
+                    history = SearchHistory.restore(
+                        SEARCH_HISTORY_BYTES, header["history"], f.read()
+                    )
+        except (OSError, ValueError, KeyError) as e:
+            log(f"SessionSever[{self.name}] lost its scrollback hibernating: {e}", WARNING)
+            header, scrollback = {"total": self.scrollback.total}, b""
+        if SEARCH_HISTORY_BYTES and history is None:
+            history = SearchHistory(SEARCH_HISTORY_BYTES)
+        with self.clients_lock:
+            if self.scrollback.path is None:
+                self.scrollback.restore(scrollback, header["total"])
+            self.history = history
+        try:
+            path.unlink()
+        except OSError:
+            pass
+        if RECORD:
+            try:
+                self.recorder = SessionRecorder(
+                    self.name, self.pty.cols, self.pty.rows, self.shell, self.stats
+                )
+            except OSError as e:
+                log(f"SessionSever[{self.name}] not recording: {e}", WARNING)
+        log(f"SessionSever[{self.name}] woke up")
+
+    def _stop_shell(self) -> None:
+        """
+        Stops the shell's process group and, if another one is in the
+        foreground of the terminal, that one after it.
+        """
+        import signal
+
+        if not self.pty.proc or self.pty.master_fd is None:
+            return
+        try:
+            pgrps = [os.getpgid(self.pty.proc.pid)]
+            foreground = os.tcgetpgrp(self.pty.master_fd)
+            if foreground not in pgrps:
+                pgrps.append(foreground)
+        except OSError as e:
+            log(f"SessionSever[{self.name}] not stopping the shell: {e}", WARNING)
+            return
+        # The shell first, so it does not see its job stop and take the terminal.
+        for pgrp in pgrps:
+            try:
+                os.killpg(pgrp, signal.SIGSTOP)
+                self._stopped_pgrps.append(pgrp)
+            except OSError:
+                pass
+
+    def _continue_shell(self) -> None:
+        """
+        Continues what _stop_shell() stopped, in reverse order.
+        """
+        import signal
+
+        while self._stopped_pgrps:
+            try:
+                os.killpg(self._stopped_pgrps.pop(), signal.SIGCONT)
+            except OSError:
+                pass
+
+    def _schedule_stats(self) -> None:
+        """
+        Has the event loop write a stats snapshot file every STATS_INTERVAL seconds.
+        """
+        if STATS_INTERVAL > 0 and not self._closed:
+            self._call_later(STATS_INTERVAL, self._on_stats_timer)
+
+    def _on_stats_timer(self) -> None:
+        if not self._closed:
+            self._write_stats()
+            self._schedule_stats()
+
+    def _stats_loop(self) -> None:
+        """
+        Writes stats snapshot files for the threaded server, which has no timers.
+        """
+        while not self.stop_evt.wait(STATS_INTERVAL):
+            self._write_stats()
+
+    def _write_stats(self) -> None:
+        try:
+            write_stats(self.name, self.stats_message())
+        except Exception as e:
+            log(f"SessionSever[{self.name}] writing stats failed ({e})", WARNING)
+
+    def queue_input(
+        self,
+        client: SessionClient,
+        data: bytes,
+        input_id: Optional[str] = None,
+        paste: bool = False,
+    ) -> None:
+        """
+        Queues client input for the PTY behind all earlier input, so input
+        from different clients is never interleaved.
+        input_id: send stdin_progress events and a final stdin_ack to client
+        paste: wrap data in bracketed paste markers if the application asked for them
+        """
+        if paste and self._bracketed_paste:
+            # An end marker inside the paste would end it early.
+            data = PASTE_START + data.replace(PASTE_END, b"") + PASTE_END
+        self._last_activity = time.monotonic()
+        with self._input_lock:
+            if self._pty_eof:
+                return
+            full = self._input_queued + len(data) > INPUT_QUEUE_MAX
+            if not full:
+                self._input.append([memoryview(data), client, input_id, 0])
+                self._input_queued += len(data)
+        if full:
+            log(f"SessionSever[{self.name}] input queue full, dropping {len(data)} bytes", WARNING)
+            if input_id is not None:
+                self._send_quietly(
+                    client, {"type": "stdin_ack", "id": input_id, "error": "input queue full"}
+                )
+            return
+        if self.recorder:
+            self.recorder.input(data)
+        self._write_input()
+
+    def _write_input(self) -> None:
+        """
+        Writes queued input until the PTY would block, then has the event
+        loop call again once the PTY is writable.
+        """
+        events = []
+        with self._input_lock:
+            while self._input:
+                item = self._input[0]
+                data, client, input_id, done = item
+                # Windows writes block anyway, and chunks could split UTF-8 for winpty.
+                end = len(data) if IS_WIN else done + INPUT_CHUNK
+                try:
+                    n = self.pty.write_some(data[done:end])
+                except OSError as e:
+                    log(f"SessionSever[{self.name}] writing input failed ({e})", WARNING)
+                    self._input.clear()
+                    self._input_queued = 0
+                    break
+                if not n:
+                    self.stats.add("pty_write_stalls")
+                    break
+                self.stats.add("pty_write_bytes", n)
+                item[3] = done + n
+                self._input_queued -= n
+                if input_id is None:
+                    pass
+                elif item[3] == len(data):
+                    events.append((client, {"type": "stdin_ack", "id": input_id, "bytes": len(data)}))
+                elif item[3] // INPUT_PROGRESS_BYTES > done // INPUT_PROGRESS_BYTES:
+                    events.append(
+                        (
+                            client,
+                            {
+                                "type": "stdin_progress",
+                                "id": input_id,
+                                "written": item[3],
+                                "total": len(data),
+                            },
+                        )
+                    )
+                if item[3] == len(data):
+                    self._input.popleft()
+            blocked = bool(self._input)
+        if blocked != self._input_blocked:
+            self._input_blocked = blocked
+            self._watch_pty_writable(blocked)
+        for client, msg in events:
+            self._send_quietly(client, msg)
+
+    def _send_quietly(self, client: SessionClient, msg: Dict[str, Any]) -> None:
+        try:
+            client.send(msg)
+        except Exception:
+            pass
+
+    def _watch_pty_writable(self, on: bool) -> None:
+        """
+        Has the event loop call _write_input() while the PTY is writable.
+        """
+        if self.reactor and self.pty.master_fd is not None and not self._pty_eof:
+            if on:
+                self.reactor.register(
+                    self.pty.master_fd,
+                    EVENT_READ | EVENT_WRITE,
+                    self._on_pty_event,
+                )
+            else:
+                self.reactor.register(
+                    self.pty.master_fd, EVENT_READ, self._on_pty_readable
+                )
+
+    def _on_pty_event(self, mask: int) -> None:
+        if mask & EVENT_WRITE:
+            self._write_input()
+        if mask & EVENT_READ:
+            self._on_pty_readable(mask)
+
+    def _pty_reader(self) -> None:
+        """
+        Reads from the PTY and broadcasts data events until the PTY closes (Windows).
+        Reads block here, so there is no flush deadline to coalesce against.
+        """
+        while not self.stop_evt.is_set():
+            chunk = self.pty.read_chunk(COALESCE_MAX_BYTES)
+            if not chunk:
+                break
+            self.stats.add("pty_reads")
+            self.stats.add("pty_read_bytes", len(chunk))
+            self.publish(chunk)
+        self.broadcast({"type": "exit", "code": self.pty.poll_exit_code()})
+        log(f"SessionSever[{self.name}] pty reader ended")
+
+    def _start_search(self, client: SessionClient, msg: Dict[str, Any]) -> None:
+        """
+        Starts a search of the output history for the "search" command:
+        query, literal unless regex is true, ignore_case, context lines around
+        each hit, max_hits, and from_line to skip older lines. Hits are sent as
+        "search" events with the request's id, the last one with done set.
+        """
+        import re
+
+        search_id = msg.get("id")
+
+        def fail(error: str) -> None:
+            self._send_quietly(
+                client, {"type": "search", "id": search_id, "done": True, "error": error}
+            )
+
+        query = msg.get("query")
+        if self.history is None:
+            return fail("search disabled")
+        if not isinstance(query, str) or not query:
+            return fail("empty query")
+        flags = re.MULTILINE | (re.IGNORECASE if msg.get("ignore_case") else 0)
+        raw = query.encode("utf-8")
+        try:
+            pattern = re.compile(raw if msg.get("regex") else re.escape(raw), flags)
+            context = min(max(0, int(msg.get("context", 0))), SEARCH_CONTEXT_MAX)
+            max_hits = int(msg.get("max_hits", SEARCH_MAX_HITS))
+            max_hits = min(max(1, max_hits), SEARCH_HITS_LIMIT)
+            from_line = int(msg.get("from_line", 0))
+        except re.error as e:
+            return fail(f"bad regex: {e}")
+        except (TypeError, ValueError) as e:
+            return fail(f"bad option: {e}")
+        with self.clients_lock:
+            search = HistorySearch(
+                client,
+                search_id,
+                pattern,
+                context,
+                max_hits,
+                self.history.line_offset(from_line),
+                self.history.end,
+            )
+        self._searches[client] = search
+        self.stats.add("searches")
+        if IS_WIN:
+            # Threaded server: this is the client's own thread.
+            while self._searches.get(client) is search:
+                self._search_step(search)
+        else:
+            self._call_later(0, lambda: self._search_step(search))
+
+    def _search_step(self, search: HistorySearch) -> None:
+        """
+        Scans the next slice for a search and sends its full pages, then
+        yields to the event loop until the search is done.
+        """
+        if self._closed or self._searches.get(search.client) is not search:
+            return
+        assert self.history
+        t0 = time.perf_counter()
+        with self.clients_lock:
+            search.step(self.history)
+            first, last = self.history.base_line, self.history.lines
+        self.stats.timed("search_step", time.perf_counter() - t0)
+        pages = search.take_pages()
+        for i, page in enumerate(pages, 1):
+            msg: Dict[str, Any] = {"type": "search", "id": search.id, "hits": page}
+            if search.done and i == len(pages):
+                msg.update(
+                    done=True,
+                    total=search.hits,
+                    truncated=search.truncated,
+                    skipped=search.skipped,
+                    lines=[first, last],
+                )
+            self._send_quietly(search.client, msg)
+        if search.done:
+            del self._searches[search.client]
+        elif not IS_WIN:
+            self._call_later(0, lambda: self._search_step(search))
+
+    def _queue_exec(self, client: SessionClient, msg: Dict[str, Any]) -> None:
+        """
+        Queues the commands of an "exec" command to run one after another:
+        commands, stop_on_error to skip the rest of the batch after a command
+        fails, and capture to have each exec.done carry the command's output.
+        exec.start is sent when a command starts and exec.done with its exit
+        code, duration and [start, end) offsets in the session's output when
+        it is done, both with the request's id and the command's index.
+        cancel instead drops the commands of the batch with this id that have
+        not finished. A command interrupted with Ctrl-C never reports done, as
+        the shell abandons the rest of its line; cancel the batch after it.
+        A batch with a command the shell cannot parse is refused as a whole.
+        """
+        batch_id = msg.get("id")
+        if msg.get("cancel"):
+            self._cancel_execs(
+                "cancelled", lambda s: s.client is client and s.batch_id == batch_id
+            )
+            self._next_exec()
+            return
+        commands = msg.get("commands")
+        shell = Path(self.pty.shell or "").name
+        if IS_WIN:
+            error = "exec is not supported on Windows"
+        elif shell not in EXEC_SHELLS:
+            error = f"exec does not support {shell or 'this'} shell"
+        elif (
+            not isinstance(commands, list)
+            or not commands
+            or not all(isinstance(c, str) and c.strip() for c in commands)
+        ):
+            error = "commands must be a list of commands"
+        else:
+            error = None
+        if error:
+            self._send_quietly(client, {"type": "exec.done", "id": batch_id, "error": error})
+            return
+        steps = [
+            ExecStep(
+                client,
+                batch_id,
+                i,
+                command,
+                bool(msg.get("stop_on_error")),
+                bool(msg.get("capture")),
+            )
+            for i, command in enumerate(commands)
+        ]
+        for step in steps:
+            error = step.syntax_error(self.pty.shell or "sh")
+            if error:
+                self._send_quietly(
+                    client, step.event("done", error=f"command does not parse: {error}")
+                )
+                return
+        self._execs.extend(steps)
+        self.stats.add("exec_commands", len(commands))
+        self._next_exec()
+
+    def _next_exec(self) -> None:
+        """
+        Types the next queued exec command unless one is running.
+        """
+        if self._exec_running or not self._execs or self._closed:
+            return
+        step = self._exec_running = self._execs.popleft()
+        self._exec_tail = b""
+        data = step.wrapped()
+        if self._shell_pastes:
+            # As a paste, so readline neither completes at tabs nor runs lines
+            # early. The shell only turns paste mode back on at its next
+            # prompt, but reads the markers whenever it reads input.
+            data = PASTE_START + data.replace(PASTE_END, b"") + PASTE_END
+        self.queue_input(step.client, data + b"\r")
+
+    def _scan_exec_marks(self, chunk: bytes) -> None:
+        """
+        Looks for the marks of the running exec command in published output.
+        """
+        if self._exec_mark is None:
+            import re
+
+            self._exec_mark = re.compile(_EXEC_MARK)
+        data = self._exec_tail + chunk
+        seen = len(self._exec_tail)
+        base = self.scrollback.total - len(data)
+        self._exec_tail = data[-EXEC_MARK_TAIL:]
+        for m in self._exec_mark.finditer(data):
+            step = self._exec_running
+            if m.end() <= seen or step is None or m.group(3).decode() != step.token:
+                continue
+            if m.group(1) == b"C":
+                step.start, step.started_at = base + m.end(), time.monotonic()
+                self._send_quietly(
+                    step.client, step.event("start", command=step.command, offset=step.start)
+                )
+            elif step.start is not None:
+                self._exec_done(step, int(m.group(2) or -1), base + m.start())
+
+    def _exec_done(self, step: ExecStep, code: int, end: int) -> None:
+        assert step.start is not None
+        msg = step.event(
+            "done",
+            code=code,
+            duration=round(time.monotonic() - step.started_at, 6),
+            output=[step.start, end],
+        )
+        if step.capture:
+            # Only what the scrollback still holds, and at most EXEC_CAPTURE_MAX.
+            total = self.scrollback.total
+            start = max(step.start, end - EXEC_CAPTURE_MAX, total - len(self.scrollback))
+            data = self.scrollback.tail(total - start)[: end - start] if start < end else b""
+            msg["data_b64"] = base64.b64encode(data).decode("ascii")
+            msg["truncated"] = start > step.start
+        self._send_quietly(step.client, msg)
+        self._exec_running = None
+        if code != 0 and step.stop_on_error:
+            for skipped in [
+                s for s in self._execs if s.client is step.client and s.batch_id == step.batch_id
+            ]:
+                self._execs.remove(skipped)
+                self._send_quietly(skipped.client, skipped.event("done", skipped=True))
+        self._next_exec()
+
+    def _cancel_execs(
+        self, error: str, which: Optional[Callable[[ExecStep], bool]] = None
+    ) -> None:
+        """
+        Reports the running and queued exec commands, or those `which` picks,
+        as failed and forgets them.
+        """
+        steps = [self._exec_running] if self._exec_running else []
+        steps = [s for s in steps + list(self._execs) if which is None or which(s)]
+        if self._exec_running in steps:
+            self._exec_running = None
+        for step in steps:
+            if step in self._execs:
+                self._execs.remove(step)
+            self._send_quietly(step.client, step.event("done", error=error))
+
+    def _call_later(self, delay: float, callback: Callable[[], None]) -> Any:
+        """
+        Schedules callback on the event loop serving this session.
+        """
+        assert self.reactor
+        return self.reactor.call_later(delay, callback)
+
+    def _cancel(self, handle: Any) -> None:
+        """
+        Cancels a _call_later() handle, if any.
+        """
+        if self.reactor:
+            self.reactor.cancel(handle)
+
+    def _unwatch(self, fd: int) -> None:
+        """
+        Stops the event loop from watching fd.
+        """
+        if self.reactor:
+            self.reactor.unregister(fd)
+
+    def _unwatch_client(self, client: SessionClient) -> None:
+        """
+        Stops the event loop from watching a client connection.
+        """
+        if self.reactor:
+            try:
+                self.reactor.unregister(client.fileno())
+            except OSError:
+                pass
+
+    def _on_accept(self, _mask: int) -> None:
+        """
+        Accepts one client on the listener socket; accept_client() runs the
+        authkey handshake off the reactor.
+        """
+        try:
+            sock, _ = self.sock.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        assert self.reactor
+        accept_client(
+            self.reactor, sock, self.authkey, self.add_client, f"SessionSever[{self.name}]"
+        )
+
+    def add_client(self, client: SessionClient) -> None:
+        """
+        Starts serving an authenticated connection on the reactor.
+        The client gets ATTACH_WAIT seconds to send its attach options.
+        """
+        assert self.reactor
+        if self._closed:
+            client.close()
+            return
+        client.on_backlog = self._on_client_backlog
+        self._pending[client] = self._call_later(
+            ATTACH_WAIT, lambda: self._attach(client, None)
+        )
+        self.reactor.register(
+            client.fileno(),
+            EVENT_READ,
+            lambda mask: self._on_client_event(client, mask),
+        )
+
+    def _on_client_event(self, client: SessionClient, mask: int) -> None:
+        """
+        Continues a client's backlog when writable and serves it when readable.
+        """
+        if mask & EVENT_WRITE:
+            try:
+                client.pump()
+            except OSError:
+                self._drop_client(client)
+                return
+        if mask & EVENT_READ and not client.closed:
+            self._on_client_readable(client)
+
+    def _attach(self, client: SessionClient, hello: Optional[Dict[str, Any]]) -> None:
+        """
+        Applies the attach options in hello, sends ready, replays scrollback
+        and subscribes the client.
+        """
+        self._cancel(self._pending.pop(client, None))
+        hello = hello or {}
+        client.probe = bool(hello.get("probe"))
+        if not client.probe:
+            self.wake()
+            self._last_activity = time.monotonic()
+        client.binary = bool(hello.get("binary"))
+        replay = int(hello.get("replay", 0) or 0)
+        ready = {
+            "type": "ready",
+            "session": self.name,
+            "platform": self.platform,
+            "shell": self.shell,
+        }
+        if self._pooled and not client.probe:
+            # A pooled shell printed its prompt before it was adopted; the client
+            # that opened the session sees it even without asking for a replay.
+            self._pooled = False
+            ready["pooled"] = True
+            if replay >= 0:
+                replay = max(replay, self.scrollback.total)
+        try:
+            client.send(ready)
+            self._subscribe(client, replay, bool(hello.get("screen")))
+        except Exception:
+            self._drop_client(client)
+
+    def _on_client_readable(self, client: SessionClient) -> None:
+        """
+        Reads what a client sent and executes the messages it completed.
+        """
+        try:
+            msgs = client.recv_ready()
+        except Exception:
+            self._drop_client(client)
+            return
+        self._serve_messages(client, msgs)
+
+    def _serve_messages(self, client: SessionClient, msgs: List[Any]) -> None:
+        """
+        Executes a client's messages in order; a pending client's first one
+        may be its attach message.
+        """
+        for msg in msgs:
+            if client.closed:
+                return
+            if client in self._pending:
+                if isinstance(msg, dict) and msg.get("cmd") == "attach":
+                    self._attach(client, msg)
+                    continue
+                self._attach(client, None)
+            if not self._handle_cmd(client, msg):
+                self._drop_client(client)
+                return
+
+    def _drop_client(self, client: SessionClient) -> None:
+        """
+        Stops serving a client and closes its connection.
+        """
+        self._cancel(self._pending.pop(client, None))
+        self._searches.pop(client, None)
+        self._unwatch_client(client)
+        with self.clients_lock:
+            if client in self.clients:
+                # Idle time starts when the last client leaves.
+                self._last_activity = time.monotonic()
+            self.clients.discard(client)
+        try:
+            client.close()
+        except Exception:
+            pass
+
+    def _on_pty_readable(self, _mask: int) -> None:
+        """
+        Drains the non-blocking PTY master into the coalescer.
+        """
+        # Bounded so a flood of output cannot starve client input.
+        for _ in range(16):
+            try:
+                chunk = self.pty.read_chunk(COALESCE_MAX_BYTES)
+            except BlockingIOError:
+                break
+            if not chunk:
+                self._on_pty_eof()
+                return
+            self.stats.add("pty_reads")
+            self.stats.add("pty_read_bytes", len(chunk))
+            for frame in self.coalescer.push(chunk, time.monotonic()):
+                self.publish(frame)
+        else:
+            self.stats.add("pty_read_stalls")
+        if len(self.coalescer) and not self._flush_timer:
+            self._flush_timer = self._call_later(
+                self.coalescer.timeout(time.monotonic()) or 0, self._flush_output
+            )
+
+    def _flush_output(self) -> None:
+        """
+        Publishes coalesced output once its latency budget is used up.
+        """
+        self._flush_timer = None
+        if len(self.coalescer):
+            self.publish(self.coalescer.take())
+
+    def _on_pty_eof(self, waited: float = 0.0) -> None:
+        """
+        Flushes remaining output, waits briefly for the shell's exit code,
+        announces it to all clients and closes the session.
+        """
+        if self.pty.master_fd is not None:
+            self._unwatch(self.pty.master_fd)
+        with self._input_lock:
+            self._pty_eof = True
+            self._input.clear()
+            self._input_queued = 0
+        self._cancel(self._flush_timer)
+        self._flush_output()
+        code = self.pty.poll_exit_code()
+        if code is None and waited < 2.0:
+            self._call_later(0.05, lambda: self._on_pty_eof(waited + 0.05))
+            return
+        self.broadcast({"type": "exit", "code": code})
+        log(f"SessionSever[{self.name}] pty closed with {code}")
+        self.close()
+
+    def _publish_info(self) -> None:
+        info = WorkerInfo(
+            name=self.name,
+            pid=os.getpid(),
+            host=str(self.host),
+            port=int(self.port),
+            authkey_b64=base64.urlsafe_b64encode(self.authkey).decode("ascii"),
+            started_at=time.time(),
+            path=self.path,
+        )
+        write_info(info)
+        notify_ready(info)
+
+    def _open_listener(self) -> None:
+        """
+        Opens this session's own listener socket.
+        """
+        self.sock, self.path, self.host, self.port = open_listener(self.name)
+        if self.path:
+            self.authkey = b""
+
+    def run(self) -> None:
+        """
+        Starts the PTY, publishes WorkerInfo, and serves until stopped or PTY exit.
+        """
+        self.authkey = os.urandom(32)
+        if IS_WIN:
+            self._run_threaded()
+            return
+
+        reactor = Reactor()
+        self._open_listener()
+        try:
+            self.start(reactor)
+            reactor.register(self.sock.fileno(), EVENT_READ, self._on_accept)
+            reactor.run()
+        finally:
+            self.close()
+            reactor.close()
+
+    def start(self, reactor: Reactor, warm: Optional["WarmShell"] = None) -> None:
+        """
+        Spawns the PTY, publishes WorkerInfo and serves the PTY on reactor.
+        warm: an already running shell to adopt instead of spawning one; its
+        output so far becomes the start of the scrollback and is replayed to
+        the first client.
+        The listener is the caller's business.
+        """
+        self.reactor = reactor
+        if warm:
+            self.pty, self.platform = warm.pty, warm.platform
+            self._pooled = self._first_output = bool(warm.output)
+            self.pty.resize(self.cols, self.rows)
+            self.scrollback.append(bytes(warm.output))
+            if self.screen:
+                self.screen.feed(bytes(warm.output))
+            if self.history:
+                self.history.append(bytes(warm.output))
+            if self.recorder:
+                self.recorder.output(bytes(warm.output))
+        else:
+            self.platform = self.pty.spawn()
+        self._publish_info()
+        assert self.pty.master_fd is not None
+        os.set_blocking(self.pty.master_fd, False)
+        reactor.register(self.pty.master_fd, EVENT_READ, self._on_pty_readable)
+        self._schedule_stats()
+        self._schedule_governor()
+        profiler.attach(self.name, reactor.call_soon_threadsafe)
+
+    def _run_threaded(self) -> None:
+        """
+        Serves with one thread for the PTY and one per client, for platforms
+        where the PTY cannot be multiplexed with select.
+        """
+        from multiprocessing.connection import Listener
+
+        self.listener = Listener(("127.0.0.1", 0), authkey=self.authkey)
+        self.host, self.port = self.listener.address
+        self.platform = self.pty.spawn()
+        self._publish_info()
+        profiler.attach(self.name, lambda callback: callback())
+        try:
+            t = threading.Thread(
+                target=self._pty_reader,
+                name=f"run_in_terminal_pty_reader_{self.name}",
+                daemon=True,
+            )
+            t.start()
+            if STATS_INTERVAL > 0:
+                threading.Thread(
+                    target=self._stats_loop,
+                    name=f"run_in_terminal_stats_{self.name}",
+                    daemon=True,
+                ).start()
+            self._accept_loop(self.listener)
+        finally:
+            self.close()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        log(f"SessionSever[{self.name}] closing")
+        self.stop_evt.set()
+        self._cancel_execs("session closed")
+        for conn in list(self._pending):
+            self._drop_client(conn)
+        self._close_listener()
+
+        with self.clients_lock:
+            clients, self.clients = list(self.clients), set()
+        for conn in clients:
+            try:
+                conn.send({"cmd": "close"})
+            except Exception as e:
+                log(f"SessionSever[{self.name}] failed to close conn: {e}", WARNING)
+            self._drop_client(conn)
+
+        if self._hibernated:
+            self._continue_shell()
+            try:
+                spill_path(self.name).unlink()
+            except OSError:
+                pass
+        try:
+            # A supervisor must not block its other sessions; it reaps the shell later.
+            self.pty.close(wait=0 if self.supervisor else 2.0)
+        except Exception:
+            log(f"SessionSever[{self.name}] couldn't close pty", WARNING)
+
+        self.scrollback.close()
+        if self.recorder:
+            self.recorder.close(wait=0 if self.supervisor else 5.0)
+        remove_info(self.name)
+        if STATS_INTERVAL > 0:
+            remove_stats(self.name)
+        if profiler.running and not self.supervisor:
+            profiler.stop()
+        log(f"SessionSever[{self.name}] closed")
+
+    def _close_listener(self) -> None:
+        """
+        Stops accepting clients and ends the serving loop.
+        """
+        if self.supervisor:
+            # The listener and loop are shared with the other sessions.
+            self.supervisor.session_closed(self)
+            return
+        if self.reactor:
+            self.reactor.stop()
+            try:
+                self.reactor.unregister(self.sock.fileno())
+                self.sock.close()
+            except Exception:
+                log(f"SessionSever[{self.name}] couldn't close listener", WARNING)
+            self._unlink_socket()
+            return
+
+        # Because Listener.accept has no timeout we connect so it can see the stop event
+        from multiprocessing.connection import Client
+
+        try:
+            with Client((self.host, int(self.port)), authkey=self.authkey) as c:
+                c.send({})
+        except Exception:
+            pass
+        try:
+            self.listener.close()
+        except Exception:
+            log(f"SessionSever[{self.name}] couldn't close listener", WARNING)
+
+    def _unlink_socket(self) -> None:
+        """
+        Removes the AF_UNIX socket file, if this session has one.
+        """
+        if self.path:
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+
+def frame_bytes(payload: bytes) -> bytes:
+    """
+    Wraps payload in the length-prefixed framing of Connection.send_bytes(),
+    so asyncio streams and Connection objects can talk to each other.
+    """
+    return frame_header(len(payload)) + payload
+
+
+async def read_frame(reader: "asyncio.StreamReader") -> bytes:
+    """
+    Reads one frame as written by Connection.send_bytes().
+    """
+    (n,) = struct.unpack("!i", await reader.readexactly(4))
+    if n == -1:
+        (n,) = struct.unpack("!Q", await reader.readexactly(8))
+    return await reader.readexactly(n)
+
+
+async def read_message(reader: "asyncio.StreamReader") -> Any:
+    """
+    Reads and decodes one binary or legacy pickled frame.
+    """
+    return decode_frame(await read_frame(reader))
+
+
+class AsyncClientConn:
+    """
+    Connection-like handle for one asyncio stream client, so SessionServer's
+    fanout and command handling can serve it unchanged.
+    write_some() hands frames to the transport only while its buffer is below
+    ASYNC_WRITE_BUFFER; the rest waits in the SessionClient's queue.
+    """
+
+    writer: "asyncio.StreamWriter"
+
+    def __init__(self, writer: "asyncio.StreamWriter"):
+        self.writer = writer
+        writer.transport.set_write_buffer_limits(high=ASYNC_WRITE_BUFFER)
+
+    def write_some(self, segments: List[Any]) -> int:
+        if self.writer.is_closing():
+            raise OSError("client connection closed")
+        if self.writer.transport.get_write_buffer_size() > ASYNC_WRITE_BUFFER:
+            return 0
+        # write() rather than writelines(), which skips the high-water check
+        for segment in segments:
+            self.writer.write(segment)
+        return sum(len(s) for s in segments)
+
+    def close(self) -> None:
+        self.writer.close()
+
+    def fileno(self) -> int:
+        sock = self.writer.get_extra_info("socket")
+        return sock.fileno() if sock else -1
+
+
+class AsyncSessionServer(SessionServer):
+    """
+    asyncio flavour of SessionServer (POSIX only), selected with --asyncio / RIT_ASYNCIO=1.
+    The PTY is watched with loop.add_reader and clients are served over asyncio streams.
+    Scrollback, coalescing, fanout and command handling are shared with SessionServer.
+    """
+
+    _loop: "asyncio.AbstractEventLoop"
+    _stopped: "asyncio.Event"
+
+    def run(self) -> None:
+        """
+        Starts the PTY, publishes WorkerInfo, and serves until stopped or PTY exit.
+        """
+        import asyncio
+
+        asyncio.run(self.serve())
+
+    async def serve(self) -> None:
+        import asyncio
+
+        self._loop = asyncio.get_running_loop()
+        self._stopped = asyncio.Event()
+        self.authkey = os.urandom(32)
+        self._open_listener()
+        self.platform = self.pty.spawn()
+        self._publish_info()
+        assert self.pty.master_fd is not None
+        os.set_blocking(self.pty.master_fd, False)
+        self._loop.add_reader(
+            self.pty.master_fd, self._on_pty_readable, EVENT_READ
+        )
+        self._schedule_stats()
+        self._schedule_governor()
+        profiler.attach(self.name, self._loop.call_soon_threadsafe)
+        self._accept_task = asyncio.ensure_future(self._accept_forever())
+        self._client_tasks: Set["asyncio.Task[None]"] = set()
+        try:
+            await self._stopped.wait()
+        finally:
+            self.close()
+
+    def _call_later(self, delay: float, callback: Callable[[], None]) -> Any:
+        return self._loop.call_later(delay, callback)
+
+    def _cancel(self, handle: Any) -> None:
+        if handle:
+            handle.cancel()
+
+    def _unwatch(self, fd: int) -> None:
+        self._loop.remove_reader(fd)
+        self._loop.remove_writer(fd)
+
+    def _unwatch_client(self, client: SessionClient) -> None:
+        # Stream transports stop reading on their own once closed.
+        pass
+
+    def _watch_pty_writable(self, on: bool) -> None:
+        if self.pty.master_fd is None:
+            return
+        if on and not self._pty_eof:
+            self._loop.add_writer(self.pty.master_fd, self._write_input)
+        else:
+            self._loop.remove_writer(self.pty.master_fd)
+
+    def _drop_later(self, client: SessionClient) -> None:
+        self._loop.call_soon(self._drop_client, client)
+
+    def _on_client_backlog(self, client: SessionClient) -> None:
         """
-        Receives events fromthe daemon and forwards them to the extension.
+        Drains a backlogged client's queue into its transport as it empties.
         """
+        import asyncio
+
+        if client.backlogged and not client.draining:
+            client.draining = True
+            task = asyncio.ensure_future(self._drain(client))
+            self._client_tasks.add(task)
+            task.add_done_callback(self._client_tasks.discard)
+        elif client.doomed and not client.backlogged:
+            self._drop_later(client)
+
+    async def _drain(self, client: SessionClient) -> None:
+        import asyncio
+
+        writer = client.conn.writer
+        deadline = self._loop.time() + RESYNC_GRACE
         try:
-            log(f"Reader thread {self.session_name} started")
-            while not self._close_event.is_set() and self.conn:
-                try:
-                    msg = self.conn.recv()
-                    if isinstance(msg, dict):
-                        t = msg.get("type")
-                        if t == "data":
-                            b64 = msg.get("data_b64", "")
-                            forward_chunk_to_ext(b64)
-                        else:
-                            send_to_ext(msg)
-
-                except EOFError:
-                    break
+            while client.backlogged and not client.closed:
+                if client.doomed:
+                    await asyncio.wait_for(
+                        writer.drain(), max(0, deadline - self._loop.time())
+                    )
+                else:
+                    await writer.drain()
+                client.pump()
+        except (OSError, asyncio.TimeoutError):
+            self._drop_client(client)
         finally:
-            try:
-                log(f"Reader thread {self.session_name} terminated")
-                if self.conn:
-                    self.conn.close()
-            except Exception:
-                pass
+            client.draining = False
 
-    def stdin(self, data: bytes) -> None:
+    async def _accept_forever(self) -> None:
         """
-        Send stdin data to the daemon
+        Accepts clients and serves each in its own task.
         """
+        import asyncio
 
-        if self.conn:
-            self.conn.send(
-                {"cmd": "stdin", "data_b64": base64.b64encode(data).decode("ascii")}
-            )
+        while True:
+            sock, _ = await self._loop.sock_accept(self.sock)
+            task = asyncio.ensure_future(self._serve_client(sock))
+            self._client_tasks.add(task)
+            task.add_done_callback(self._client_tasks.discard)
 
-    def resize(self, cols: int, rows: int) -> None:
+    async def _serve_client(self, sock: "socket.socket") -> None:
         """
-        Request a terminal resize in the daemon.
+        Authenticates one client, attaches it and executes its commands.
         """
-        if self.conn:
-            self.conn.send({"cmd": "resize", "cols": int(cols), "rows": int(rows)})
+        import asyncio
+        import pickle
 
-    def ping(self) -> None:
-        """
-        Pings the daemon
-        """
-        if self.conn:
-            self.conn.send({"cmd": "ping"})
+        try:
+            if not self.path:
+                # The challenge is multiprocessing's own; it runs blocking, bounded by SO_RCVTIMEO.
+                await asyncio.to_thread(server_handshake, sock, self.authkey)
+            reader, writer = await asyncio.open_connection(sock=sock)
+        except Exception as e:
+            log(f"SessionSever[{self.name}] client handshake failed ({e})", WARNING)
+            sock.close()
+            return
 
-    def close(self) -> None:
-        """ """
-        self._close_event.set()
-        log(f"DaemonClient {self.session_name} closed")
+        client = SessionClient(AsyncClientConn(writer))
+        client.on_backlog = self._on_client_backlog
+        pending: Optional["asyncio.Future[Any]"] = asyncio.ensure_future(
+            read_message(reader)
+        )
+        assert pending
+        done, _ = await asyncio.wait({pending}, timeout=ATTACH_WAIT)
+        hello = None
+        if done and not pending.exception():
+            msg = pending.result()
+            if isinstance(msg, dict) and msg.get("cmd") == "attach":
+                hello, pending = msg, None
+        self._attach(client, hello)
         try:
-            if self.conn:
-                self.conn.send({"cmd": "close"})
-                self.conn.close()
-        except Exception:
+            while not self._closed:
+                if pending:
+                    msg, pending = await pending, None
+                else:
+                    msg = await read_message(reader)
+                if not self._handle_cmd(client, msg):
+                    break
+        except (asyncio.IncompleteReadError, OSError, ValueError, pickle.UnpicklingError):
             pass
+        finally:
+            self._drop_client(client)
 
-
-class PTYShell:
-    shell: Optional[str]
-    cols: int
-    rows: int
-    proc: Optional[subprocess.Popen[bytes]] = None
-    master_fd: Optional[int] = None
-    slave_fd: Optional[int] = None
-    _close_event: threading.Event = threading.Event()
-
-    def __init__(self, shell: Optional[str] = None, cols: int = 80, rows: int = 24):
-        self.shell = shell
-        self.cols = cols
-        self.rows = rows
-
-    def spawn(self) -> str:
-        """
-        Spawns the shell at user home dir.
-        Returns platform identifier.
-        """
-
+    def _close_listener(self) -> None:
+        self._stopped.set()
+        self._accept_task.cancel()
+        if self.pty.master_fd is not None:
+            self._loop.remove_reader(self.pty.master_fd)
+            self._loop.remove_writer(self.pty.master_fd)
         try:
-            os.chdir(home_dir())
+            self.sock.close()
         except Exception:
-            pass
-
-        if not self.shell:
-            if IS_WIN:
-                self.shell = (
-                    os.environ.get("COMSPEC")
-                    or r"C:\Windows\System32\WindowsPowerShell\v1.0\powershell.exe"
-                )
-            else:
-                self.shell = os.environ.get("SHELL") or "/bin/bash"
+            log(f"SessionSever[{self.name}] couldn't close listener", WARNING)
+        self._unlink_socket()
 
-        if IS_WIN:
-            try:
-                import pywinpty
 
-                self.winpty = pywinpty.PTY(cols=self.cols, rows=self.rows)
-                self.winproc = pywinpty.Process(self.winpty, self.shell)
-                return "win-pty"
-            except Exception:
-                self.proc = subprocess.Popen(
-                    [self.shell],
-                    stdin=subprocess.PIPE,
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.STDOUT,
-                    cwd=home_dir(),
-                )
-                return "win-pipe"
+class WarmShell:
+    """
+    A shell spawned ahead of time and parked in the Supervisor's pool until a
+    new session adopts it.
+    key: the shell it was spawned for ("" for the default shell)
+    output: what the shell printed while parked, usually its first prompt
+    """
 
-        import pty, fcntl, termios, struct as st
+    key: str
+    pty: PTYShell
+    platform: str
+    output: bytearray
+    timer: Optional[List[Any]] = None
 
-        self.master_fd, self.slave_fd = pty.openpty()
-        fcntl.ioctl(
-            self.master_fd,
-            termios.TIOCSWINSZ,
-            st.pack("HHHH", self.rows, self.cols, 0, 0),
-        )
-        
-        def preexec():
-            if self.slave_fd is None:
-                log("Got no slave fd from openpty().")
-                return
-            os.setsid()
-            fcntl.ioctl(self.slave_fd, termios.TIOCSCTTY, 0)
+    def __init__(self, key: str):
+        self.key = key
+        self.pty = PTYShell(shell=key or None)
+        self.platform = self.pty.spawn()
+        self.output = bytearray()
 
-        env = os.environ.copy()
-        env.setdefault("TERM", "xterm-256color")
-        env.setdefault("COLORTERM", "truecolor")
 
-        self.proc = subprocess.Popen(
-            [self.shell, "-l"],
-            stdin=self.slave_fd,
-            stdout=self.slave_fd,
-            stderr=self.slave_fd,
-            preexec_fn=preexec,
-            cwd=home_dir(),
-            env=env,
-        )
-        os.close(self.slave_fd)
-        return "posix-pty"
+class Supervisor:
+    """
+    One daemon serving many sessions (POSIX only), selected with RIT_SUPERVISOR=1.
+    Every session is a SessionServer sharing the supervisor's Reactor and listener.
+    A client's attach message names its session, which is created in-process on
+    first use; from then on the client is served by that session directly.
+    Per-session WorkerInfo files are still written and point at the supervisor.
+    New sessions adopt a pre-spawned shell from the pool when one is ready.
+    """
 
-    def read_chunk(self, n: int = 8192) -> bytes:
-        """
-        Read up to n bytes from the terminal
-        """
-        if IS_WIN:
-            if self.winpty:
-                s = self.winpty.read(n)
-                return (s or "").encode("utf-8", "ignore")
-            if self.proc and self.proc.stdout:
-                return self.proc.stdout.read(n) or b""
-            return b""
+    sessions: Dict[str, SessionServer]
+    pool: Dict[str, List[WarmShell]]
+    reactor: Reactor
+    sock: "socket.socket"
+    path: Optional[str] = None
+    host: str = ""
+    port: int = 0
+    authkey: bytes = b""
 
-        try:
-            return os.read(self.master_fd, n) if self.master_fd else b""
-        except Exception:
-            return b""
+    def __init__(self):
+        self.sessions = {}
+        self.pool = {}
+        self.reactor = Reactor()
+        self._pending: Dict[SessionClient, Any] = {}
+        self._idle_timer: Optional[List[Any]] = None
 
-    def write(self, data: bytes) -> None:
+    def run(self) -> None:
         """
-        Write bytes to terminal
+        Publishes the supervisor and serves until it has been idle for SUPERVISOR_IDLE_EXIT.
         """
-        if IS_WIN:
-            if self.winpty:
-                self.winpty.write(data.decode("utf-8", "ignore"))
-                return
-            if self.proc and self.proc.stdin:
-                self.proc.stdin.write(data)
-                self.proc.stdin.flush()
-                return
-        if self.master_fd:
-            os.write(self.master_fd, data)
+        info = read_info(SUPERVISOR_NAME)
+        conn = try_connect(info) if info else None
+        if conn:
+            conn.close()
+            log("Supervisor already running")
+            return
+        self.sock, self.path, self.host, self.port = open_listener(SUPERVISOR_NAME)
+        if not self.path:
+            self.authkey = os.urandom(32)
+        info = WorkerInfo(
+            name=SUPERVISOR_NAME,
+            pid=os.getpid(),
+            host=str(self.host),
+            port=int(self.port),
+            authkey_b64=base64.urlsafe_b64encode(self.authkey).decode("ascii"),
+            started_at=time.time(),
+            path=self.path,
+        )
+        write_info(info)
+        notify_ready(info)
+        log(f"Supervisor {os.getpid()} serving on {self.path or self.port}")
+        profiler.attach("supervisor", self.reactor.call_soon_threadsafe)
+        try:
+            self.reactor.register(
+                self.sock.fileno(), EVENT_READ, self._on_accept
+            )
+            self._schedule_idle_exit()
+            for key in dict.fromkeys(["", *map(self.pool_key, POOL_SHELLS)]):
+                self._fill_pool(key)
+            self.reactor.run()
+        finally:
+            self.close()
+            self.reactor.close()
 
-    def resize(self, cols: int, rows: int) -> None:
+    def _on_accept(self, _mask: int) -> None:
         """
-        Resize the terminal window
+        Accepts one client and waits for the attach message naming its session.
         """
-        self.cols = cols
-        self.rows = rows
-
-        if IS_WIN and self.winpty:
-            self.winpty.set_size(self.cols, self.rows)
+        try:
+            sock, _ = self.sock.accept()
+        except (BlockingIOError, InterruptedError):
             return
-        if self.master_fd:
-            import fcntl, termios, struct as st
+        accept_client(self.reactor, sock, self.authkey, self._await_hello, "Supervisor")
 
-            fcntl.ioctl(
-                self.master_fd,
-                termios.TIOCSWINSZ,
-                st.pack("HHHH", self.rows, self.cols, 0, 0),
-            )
-
-    def poll_exit_code(self) -> Optional[int]:
+    def _await_hello(self, client: SessionClient) -> None:
         """
-        Returns process exit code if exited, otherwise None
+        Gives an authenticated client ATTACH_WAIT seconds to name its session.
         """
-        if IS_WIN and self.winpty:
-            return None
-        if self.proc:
-            return self.proc.poll()
-        return None
+        self._pending[client] = self.reactor.call_later(
+            ATTACH_WAIT, lambda: self._drop(client, "sent no attach message")
+        )
+        self.reactor.register(
+            client.fileno(), EVENT_READ, lambda _m: self._on_hello(client)
+        )
 
-    def close(self) -> None:
+    def _on_hello(self, client: SessionClient) -> None:
         """
-        Terminates the child process and closes file descriptors.
+        Routes a client to the session named in its attach message.
         """
-        if self._close_event.is_set():
-            return
-        self._close_event.set()
         try:
-            if IS_WIN:
-                try:
-                    if self.winproc:
-                        self.winproc.kill()
-                except Exception:
-                    pass
-                try:
-                    if self.proc:
-                        self.proc.terminate()
-                except Exception:
-                    pass
-                try:
-                    if self.winpty:
-                        self.winpty.close()
-                except Exception:
-                    pass
-            else:
-                import signal
-
-                if self.proc:
-                    try:
-                        os.killpg(self.proc.pid, signal.SIGTERM)
-                    except Exception:
-                        try:
-                            self.proc.terminate()
-                        except Exception:
-                            pass
-                    deadline = time.time() + 2.0
-                    while time.time() < deadline and self.proc.poll() is None:
-                        time.sleep(0.05)
-                    if self.proc.poll() is None:
-                        try:
-                            os.killpg(self.proc.pid, signal.SIGKILL)
-                        except Exception:
-                            pass
-                if self.master_fd:
-                    try:
-                        os.close(self.master_fd)
-                    except Exception:
-                        pass
+            msgs = client.recv_ready()
         except Exception:
-            pass
-
-
-class SessionServer:
-    """
-    A single session daemon owning one PTY and serving multiple clients.
-    Clients connect using multiprocessing.connection with an auth key from WorkerInfo.
-    Incoming commands: stdin, resize, ping, info, close.
-    Outgoing events: ready, data, exit, pong, info.
-    """
-
-    name: str
-    shell: Optional[str]
-    cols: int
-    rows: int
-    stop_evt: threading.Event = threading.Event()
-    clients: Set[Connection] = set()
-    clients_lock: threading.Lock = threading.Lock()
-    pty: PTYShell
-    platform: Optional[str] = None
+            self._drop(client, "disconnected")
+            return
+        if not msgs:
+            return
+        hello = msgs.pop(0)
+        name = hello.get("session") if isinstance(hello, dict) else None
+        if not name or hello.get("cmd") != "attach":
+            self._drop(client, "sent no session to attach to")
+            return
+        if hello.get("probe") and name not in self.sessions:
+            self._drop(client, f"probed unknown session {name}")
+            return
+        self.reactor.cancel(self._pending.pop(client))
+        try:
+            server = self.sessions.get(name) or self.open_session(
+                name, hello.get("shell"), hello.get("cols"), hello.get("rows")
+            )
+        except Exception as e:
+            log(f"Supervisor failed to start session {name} ({e})", WARNING)
+            self._drop(client, "could not be served")
+            return
+        server.add_client(client)
+        server._attach(client, hello)
+        # Messages that arrived along with the attach message.
+        server._serve_messages(client, msgs)
 
-    def __init__(self, name: str, shell: Optional[str], cols: int, rows: int):
-        self.name = name
-        self.shell = shell
-        self.cols = cols
-        self.rows = rows
-        self.pty = PTYShell(shell=shell, cols=self.cols, rows=self.rows)
+    def open_session(
+        self, name: str, shell: Optional[str], cols: Any, rows: Any
+    ) -> SessionServer:
+        """
+        Starts a new session on this supervisor.
+        """
+        if MAX_SESSIONS:
+            self._make_room()
+        key = self.pool_key(shell)
+        warm = self._take_warm(key)
+        log(f"Supervisor starting session {name}{' (warm)' if warm else ''}")
+        server = SessionServer(name, shell, int(cols or 80), int(rows or 24))
+        server.supervisor = self
+        server.path, server.host, server.port = self.path, self.host, self.port
+        server.authkey = self.authkey
+        self.sessions[name] = server
+        try:
+            server.start(self.reactor, warm)
+        except Exception:
+            self.sessions.pop(name, None)
+            server.close()
+            raise
+        self._refill_after(server, key)
+        if self._idle_timer:
+            self.reactor.cancel(self._idle_timer)
+            self._idle_timer = None
+        return server
 
-    def broadcast(self, msg: Dict[str, Any]) -> None:
+    def _make_room(self) -> None:
         """
-        Sends a dict event to all connected clients, pruning broken connections.
+        Closes the least recently active sessions without clients until one
+        more fits under MAX_SESSIONS.
         """
-        dead = []
-        with self.clients_lock:
-            for c in list(self.clients):
-                try:
-                    c.send(msg)
-                except Exception:
-                    dead.append(c)
-            for c in dead:
-                try:
-                    c.close()
-                except Exception:
-                    pass
-                self.clients.discard(c)
+        excess = len(self.sessions) + 1 - MAX_SESSIONS
+        if excess <= 0:
+            return
+        idle = [s for s in self.sessions.values() if not s.client_count() and not s._pending]
+        idle.sort(key=lambda s: s._last_activity)
+        limit = f"RIT_MAX_SESSIONS={MAX_SESSIONS}"
+        reason = f"least recently active of {len(self.sessions)} sessions, {limit}"
+        for server in idle[:excess]:
+            server.reap(reason)
+        if len(idle) < excess:
+            log(f"{len(self.sessions)} sessions with clients exceed {limit}", WARNING)
 
-    def _accept_loop(self, listener: Listener) -> None:
+    def session_closed(self, server: SessionServer) -> None:
         """
-        Accepts clients and serves each in a thread.
+        Called by a session once it has shut down.
         """
-        while not self.stop_evt.is_set():
+        if self.sessions.get(server.name) is server:
+            del self.sessions[server.name]
+        if server.pty.master_fd is not None:
             try:
-                conn = listener.accept()
-                if self.stop_evt.is_set():
-                    break
-
-                t = threading.Thread(
-                    target=self._client_loop,
-                    name=f"run_in_terminal_client_loop_{self.name}",
-                    args=(conn,),
-                    daemon=True,
-                )
-                t.start()
-            except Exception:
-                continue
-        log(f"SessionSever[{self.name}] accept loop ended")
+                self.reactor.unregister(server.pty.master_fd)
+            except (OSError, KeyError):
+                pass
+        if server.pty.proc:
+            self._reap(server.pty.proc)
+        self._schedule_idle_exit()
 
-    def _client_loop(self, conn: Connection) -> None:
+    def _reap(self, proc: "subprocess.Popen[bytes]", waited: float = 0.0) -> None:
         """
-        Handles one client connection.
+        Collects the exit status of a closed session's shell, killing it if it
+        ignores SIGTERM and the hangup for more than 2 seconds.
         """
-        try:
-            conn.send(
-                {
-                    "type": "ready",
-                    "session": self.name,
-                    "platform": self.platform,
-                    "shell": self.shell,
-                }
-            )
-        except Exception:
-            try:
-                conn.close()
-            except Exception:
-                pass
+        if proc.poll() is not None:
             return
+        if waited >= 2.0:
+            import signal
 
-        with self.clients_lock:
-            self.clients.add(conn)
-        try:
-            while not self.stop_evt.is_set():
-                try:
-                    msg = conn.recv()
-                except EOFError:
-                    continue
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except OSError:
+                proc.kill()
+            proc.wait()
+            return
+        self.reactor.call_later(0.1, lambda: self._reap(proc, waited + 0.1))
 
-                if not isinstance(msg, dict):
-                    continue
+    @staticmethod
+    def pool_key(shell: Optional[str]) -> str:
+        """
+        The pool a shell is taken from: "" for the default shell, however the
+        attach message names it.
+        """
+        default = os.environ.get("SHELL") or "/bin/bash"
+        return "" if not shell or shell == default else shell
 
-                cmd = msg.get("cmd")
-                if cmd == "stdin":
-                    b64 = msg.get("data_b64", "")
-                    if b64:
-                        try:
-                            self.pty.write(base64.b64decode(b64))
-                        except Exception:
-                            pass
-                elif cmd == "resize":
-                    self.pty.resize(
-                        msg.get("cols", self.cols), msg.get("rows", self.rows)
-                    )
-                elif cmd == "ping":
-                    try:
-                        conn.send({"type": "pong"})
-                    except Exception:
-                        pass
-                elif cmd == "info":
-                    try:
-                        conn.send(
-                            {
-                                "type": "info",
-                                "session": self.name,
-                                "platform": self.platform,
-                                "shell": self.shell,
-                            }
-                        )
-                    except Exception:
-                        pass
-                elif cmd == "close":
-                    log(f"SessionSever[{self.name}] client loop closing")
-                    self.close()
-                    break
-        finally:
-            self.stop_evt.set()
-            with self.clients_lock:
-                if conn in self.clients:
-                    self.clients.remove(conn)
-            try:
-                conn.close()
-            except Exception:
-                pass
+    def _refill_after(self, server: SessionServer, key: str, waited: float = 0.0) -> None:
+        """
+        Refills the pool for key once server has printed something and been
+        quiet for POOL_REFILL_IDLE seconds, has closed, or POOL_REFILL_MAX passed.
+        """
+        quiet = time.monotonic() - server._last_activity
+        if (
+            server._closed
+            or waited >= POOL_REFILL_MAX
+            or (server._first_output and quiet >= POOL_REFILL_IDLE)
+        ):
+            self._fill_pool(key)
+            return
+        step = POOL_REFILL_IDLE / 4
+        self.reactor.call_later(step, lambda: self._refill_after(server, key, waited + step))
 
-    def _pty_reader(self) -> None:
+    def _fill_pool(self, key: str) -> None:
         """
-        Reads from the PTY and broadcasts data events until the PTY closes.
+        Spawns shells for key until the pool holds POOL_SIZE of them.
         """
-        while not self.stop_evt.is_set():
-            chunk = self.pty.read_chunk()
-            if not chunk:
-                code = self.pty.poll_exit_code()
-                if code is not None or IS_WIN:
-                    break
-                time.sleep(0.02)
-                continue
-            self.broadcast(
-                {"type": "data", "data_b64": base64.b64encode(chunk).decode("ascii")}
+        shells = self.pool.setdefault(key, [])
+        while len(shells) < POOL_SIZE:
+            try:
+                warm = WarmShell(key)
+            except Exception as e:
+                log(f"Supervisor failed to pre-spawn {key or 'default'} ({e})", WARNING)
+                return
+            assert warm.pty.master_fd is not None
+            os.set_blocking(warm.pty.master_fd, False)
+            self.reactor.register(
+                warm.pty.master_fd,
+                EVENT_READ,
+                lambda _m, w=warm: self._on_warm_readable(w),
             )
-        self.broadcast({"type": "exit", "code": self.pty.poll_exit_code()})
-        log(f"SessionSever[{self.name}] pty reader ended")
+            warm.timer = self.reactor.call_later(
+                POOL_TTL, lambda w=warm: self._evict(w, "expired")
+            )
+            shells.append(warm)
 
-    def run(self) -> None:
+    def _on_warm_readable(self, warm: WarmShell) -> None:
         """
-        Starts the PTY, publishes WorkerInfo, and serves until stopped or PTY exit.
+        Keeps what a parked shell prints, so its prompt can be replayed later.
         """
-        self.authkey = secrets.token_bytes(32)
-        self.listener = Listener(("127.0.0.1", 0), authkey=self.authkey)
-        self.host, self.port = self.listener.address
-        self.platform = self.pty.spawn()
-        info = WorkerInfo(
-            name=self.name,
-            pid=os.getpid(),
-            host=str(self.host),
-            port=int(self.port),
-            authkey_b64=base64.urlsafe_b64encode(self.authkey).decode("ascii"),
-            started_at=time.time(),
-        )
-        write_info(info)
         try:
-            t = threading.Thread(
-                target=self._pty_reader,
-                name=f"run_in_terminal_pty_reader_{self.name}",
-                daemon=True,
-            )
-            t.start()
-            self._accept_loop(self.listener)
-        finally:
-            self.close()
+            chunk = warm.pty.read_chunk()
+        except BlockingIOError:
+            return
+        if not chunk:
+            self._evict(warm, "exited")
+            return
+        if len(warm.output) + len(chunk) > POOL_OUTPUT_MAX:
+            self._evict(warm, "is too chatty")
+            return
+        warm.output += chunk
 
-    def close(self):
-        log(f"SessionSever[{self.name}] closing")
-        self.stop_evt.set()
+    def _take_warm(self, key: str) -> Optional[WarmShell]:
+        """
+        Removes a parked shell for key from the pool, if there is one.
+        """
+        shells = self.pool.get(key)
+        if not shells:
+            return None
+        warm = shells.pop(0)
+        self.reactor.cancel(warm.timer)
+        assert warm.pty.master_fd is not None
+        self.reactor.unregister(warm.pty.master_fd)
+        return warm
 
-        # Because Listener.accept has no timeout we connect so it can see the stop event
-        with Client((self.host, int(self.port)), authkey=self.authkey) as c:
-            c.send({})
+    def _evict(self, warm: WarmShell, reason: str) -> None:
+        """
+        Drops a parked shell from the pool and terminates it.
+        """
+        shells = self.pool.get(warm.key, [])
+        if warm not in shells:
+            return
+        log(f"Supervisor evicting pooled shell {warm.key or 'default'} that {reason}")
+        shells.remove(warm)
+        self.reactor.cancel(warm.timer)
+        if warm.pty.master_fd is not None:
+            self.reactor.unregister(warm.pty.master_fd)
+        warm.pty.close(wait=0)
+        if warm.pty.proc:
+            self._reap(warm.pty.proc)
 
-        for conn in self.clients:
-            try:
-                conn.send({"cmd": "close"})
-                conn.close()
-            except Exception as e:
-                log(f"SessionSever[{self.name}] failed to close conn: {e}")
+    def _schedule_idle_exit(self) -> None:
+        if self.sessions or self._idle_timer:
+            return
 
+        def expire() -> None:
+            self._idle_timer = None
+            if self._pending:
+                self._schedule_idle_exit()
+            elif not self.sessions:
+                log("Supervisor idle, exiting")
+                self.reactor.stop()
+
+        self._idle_timer = self.reactor.call_later(SUPERVISOR_IDLE_EXIT, expire)
+
+    def _drop(self, client: SessionClient, reason: str) -> None:
+        log(f"Supervisor dropping client that {reason}")
+        self.reactor.cancel(self._pending.pop(client, None))
         try:
-            self.listener.close()
+            self.reactor.unregister(client.fileno())
+        except (OSError, KeyError, ValueError):
+            pass
+        try:
+            client.close()
         except Exception:
-            log(f"SessionSever[{self.name}] couldn't close listener")
+            pass
+
+    def close(self) -> None:
+        """
+        Closes every session, the listener and the supervisor's WorkerInfo.
+        """
+        import subprocess
 
+        ptys = [warm.pty for shells in self.pool.values() for warm in shells]
+        self.pool = {}
+        servers = list(self.sessions.values())
+        for server in servers:
+            server.close()
+            ptys.append(server.pty)
+        for pty in ptys:
+            pty.close(wait=0)
+            if pty.proc:
+                try:
+                    pty.proc.wait(timeout=2.0)
+                except subprocess.TimeoutExpired:
+                    pty.proc.kill()
+        for server in servers:
+            if server.recorder:
+                # Sessions left their recordings to finish in the background.
+                server.recorder.close()
+        for client in list(self._pending):
+            self._drop(client, "was pending at shutdown")
         try:
-            self.pty.close()
-        except Exception:
-            log(f"SessionSever[{self.name}] couldn't close pty")
+            self.reactor.unregister(self.sock.fileno())
+        except (OSError, KeyError, ValueError):
+            pass
+        self.sock.close()
+        if self.path:
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+        info = read_info(SUPERVISOR_NAME)
+        if info and info.pid == os.getpid():
+            remove_info(SUPERVISOR_NAME)
+        if profiler.running:
+            profiler.stop()
 
-        remove_info(self.name)
-        log(f"SessionSever[{self.name}] closed")
+
+def supervisor_main() -> None:
+    """
+    Entry point for supervisor mode.
+    """
+    log("Supervisor started.")
+    take_ready_fd()
+    daemon_detach_posix()
+    Supervisor().run()
 
 
 def daemon_detach_posix() -> None:
@@ -791,6 +6208,12 @@ def daemon_detach_posix() -> None:
         sys.stderr.close()
     except Exception:
         pass
+    # sys.std* don't own fds 0-2; the host's Native Messaging pipes must not
+    # stay open for as long as the daemon lives.
+    devnull = os.open(os.devnull, os.O_RDWR)
+    for fd in (0, 1, 2):
+        os.dup2(devnull, fd)
+    os.close(devnull)
 
 
 def session_main(name: str, shell_token: str, cols: str, rows: str) -> None:
@@ -798,83 +6221,489 @@ def session_main(name: str, shell_token: str, cols: str, rows: str) -> None:
     Entry point for session daemon mode. shell_token is "_" for default shell.
     """
     log(f"Session {name} started.")
+    take_ready_fd()
     if not IS_WIN:
         daemon_detach_posix()
     shell = None if shell_token == "_" else shell_token
-    srv = SessionServer(name=name, shell=shell, cols=int(cols), rows=int(rows))
+    server_cls = AsyncSessionServer if USE_ASYNCIO else SessionServer
+    srv = server_cls(name=name, shell=shell, cols=int(cols), rows=int(rows))
     srv.run()
 
 
-def host_main() -> None:
+def send_session_list(ch: Any) -> None:
+    """
+    Answers a "list" on channel ch. list_sessions() probes every session, so the
+    sync host runs this on a thread of its own; send_to_ext() serializes the reply
+    with the other channels' output.
+    """
+    try:
+        reply = {"type": "list", "sessions": list_sessions()}
+    except Exception as e:
+        reply = {"type": "error", "message": str(e)}
+    send_to_ext(on_channel(reply, ch))
+
+
+def host_main(first: Optional[Dict[str, Any]] = None) -> None:
     """
     Entry point for host mode. Reads messages from the extension, attaches to a session daemon,
     and bridges messages in both directions. The session continues to live after host exit.
+    Each channel ("ch" in the messages, see on_channel) has a daemon connection of its own,
+    so one host can serve every terminal of the extension. A channel connects off this
+    loop (DaemonClient.open), as does "list", and re-opening it detaches its old
+    connection. Closing a channel leaves the others running; closing the None channel,
+    or EOF, closes them all and ends the host.
+    first: a message already read from the extension, handled before reading more
     """
     log("Started native host")
     session = None
-    client = None
-    shell = None
+    clients: Dict[Any, DaemonClient] = {}
+    # One stream per channel, the extension keeps inflating across opens.
+    deflates: Dict[Any, Optional[ExtDeflate]] = {}
     cols = 100
     rows = 30
     received_close = False
     try:
         while not received_close:
-            msg = read_from_ext()
-            log(f"EXT: {msg}")
+            msg, first = (first, None) if first else (read_from_ext(), None)
+            if msg and msg.get("type") == "stdin":
+                if LOG_LEVEL <= DEBUG:
+                    log_payload("EXT", msg)
+            else:
+                log_message("EXT", msg)
             if msg is None:
-                if client:
+                for client in clients.values():
                     try:
                         client.close()
                     except Exception:
                         pass
                 return
+            ch = msg.get("ch")
+            client = clients.get(ch)
             try:
                 t = msg.get("type")
                 if t == "open":
                     session = msg.get("session") or "default"
-                    shell = msg.get("shell")
                     cols = int(msg.get("cols", cols))
                     rows = int(msg.get("rows", rows))
-                    client = DaemonClient(session)
-                    client.connect_or_spawn(shell=shell, cols=cols, rows=rows)
-                elif t == "stdin":
-                    if not client:
-                        send_to_ext({"type": "error", "message": "stdin before open"})
-                    else:
-                        data = base64.b64decode(msg.get("data_b64", ""))
-                        client.stdin(data)
-                elif t == "resize":
-                    if client:
-                        client.resize(msg.get("cols", cols), msg.get("rows", rows))
-                elif t == "ping":
-                    if client:
-                        client.ping()
-                    else:
-                        send_to_ext({"type": "pong"})
+                    deflate = deflates.get(ch) or ExtDeflate.negotiate(msg)
+                    deflates[ch] = deflate
+                    previous = clients.pop(ch, None)
+                    if previous:
+                        previous.detach()
+                    client = clients[ch] = DaemonClient(session, deflate, ch)
+                    client.open(
+                        shell=msg.get("shell"),
+                        cols=cols,
+                        rows=rows,
+                        replay=int(msg.get("replay", 0)),
+                        screen=bool(msg.get("screen")),
+                    )
+                elif t == "list":
+                    threading.Thread(
+                        target=send_session_list,
+                        args=(ch,),
+                        name="run_in_terminal_list",
+                        daemon=True,
+                    ).start()
                 elif t == "close":
-                    received_close = True
-                    if client:
-                        client.close()
-                        client = None
-                        send_to_ext({"type": "exit", "code": 0})
+                    received_close = ch is None
+                    closing = list(clients) if received_close else [ch]
+                    for c in closing:
+                        closed = clients.pop(c, None)
+                        deflates.pop(c, None)
+                        if closed:
+                            closed.close()
+                            send_to_ext(on_channel({"type": "exit", "code": 0}, c))
+                else:
+                    reply = channel_message(client, msg)
+                    if reply:
+                        send_to_ext(on_channel(reply, ch))
+            except Exception as e:
+                send_to_ext(on_channel({"type": "error", "message": str(e)}, ch))
+    finally:
+        log(f"Stopped native host {session}")
+
+
+class ExtStream:
+    """
+    asyncio Native Messaging endpoint on the host's stdin/stdout pipes.
+    send() awaits the pipe's drain, so a slow extension pushes back on the daemon readers.
+    """
+
+    reader: "asyncio.StreamReader"
+    writer: "asyncio.StreamWriter"
+
+    @classmethod
+    async def open(cls) -> "ExtStream":
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        self = cls()
+        self.reader = asyncio.StreamReader(limit=NATIVE_MESSAGE_MAX)
+        await loop.connect_read_pipe(
+            lambda: asyncio.StreamReaderProtocol(self.reader), sys.stdin.buffer
+        )
+        transport, protocol = await loop.connect_write_pipe(
+            asyncio.streams.FlowControlMixin, sys.stdout.buffer
+        )
+        self.writer = asyncio.StreamWriter(transport, protocol, None, loop)
+        return self
+
+    async def read(self) -> Optional[Dict[str, Any]]:
+        """
+        Reads one message from the extension. Returns None on EOF.
+        """
+        import asyncio
+
+        try:
+            hdr = await self.reader.readexactly(4)
+            data = await self.reader.readexactly(int.from_bytes(hdr, "little"))
+        except asyncio.IncompleteReadError:
+            return None
+        host_stats.add("ext_messages_in")
+        host_stats.add("ext_bytes_in", 4 + len(data))
+        return decode_ext_message(data)
+
+    async def send(self, obj: Dict[str, Any]) -> None:
+        """
+        Sends one message to the extension.
+        """
+        self.writer.write(encode_ext_message(obj))
+        await self.writer.drain()
+
+
+async def send_session_list_async(ext: ExtStream, ch: Any) -> None:
+    """
+    send_session_list for host_main_async, which runs it as a task of its own.
+    """
+    import asyncio
+
+    try:
+        reply = {"type": "list", "sessions": await asyncio.to_thread(list_sessions)}
+    except Exception as e:
+        reply = {"type": "error", "message": str(e)}
+    await ext.send(on_channel(reply, ch))
+
+
+class AsyncDaemonClient(DaemonClient):
+    """
+    asyncio flavour of DaemonClient. The daemon connection is an asyncio stream
+    and one task forwards its events to the extension. Commands, input batching
+    and event bookkeeping are shared with DaemonClient; batched input is
+    flushed by a timer on the loop instead of a thread.
+    """
+
+    ext: ExtStream
+    writer: Optional["asyncio.StreamWriter"] = None
+    _flush_handle: Optional["asyncio.TimerHandle"] = None
+    _open_task: Optional["asyncio.Future[None]"] = None
+
+    def __init__(
+        self,
+        session_name: str,
+        ext: ExtStream,
+        deflate: Optional[ExtDeflate] = None,
+        channel: Any = None,
+    ):
+        super().__init__(session_name, deflate, channel)
+        self.ext = ext
+
+    async def connect_or_spawn(
+        self,
+        shell: Optional[str],
+        cols: int,
+        rows: int,
+        replay: int = 0,
+        screen: bool = False,
+    ) -> None:
+        """
+        Connect to an existing session or spawn and connect.
+        replay: bytes of scrollback to receive before live data (-1 for all of it)
+        screen: receive a snapshot of the screen instead, if the session keeps a screen model
+        """
+        import asyncio
+        import pickle
+        import socket
+
+        self._shell, self._size = shell, (cols, rows)
+        self._opened_at = time.perf_counter()
+        self.binary = False
+        conn = await asyncio.to_thread(
+            ensure_session, self.session_name, shell, cols, rows
+        )
+        sock = socket.socket(fileno=os.dup(conn.fileno()))
+        conn.close()
+        reader, self.writer = await asyncio.open_connection(sock=sock)
+        self.writer.write(
+            frame_bytes(
+                pickle.dumps(
+                    attach_message(self.session_name, shell, cols, rows, replay, screen)
+                )
+            )
+        )
+        self._reader_task = asyncio.ensure_future(self._reader_loop(reader))
+
+    def open(
+        self,
+        shell: Optional[str],
+        cols: int,
+        rows: int,
+        replay: int = 0,
+        screen: bool = False,
+    ) -> None:
+        """
+        Runs connect_or_spawn() as a task of its own, so the host keeps
+        serving its other channels while a session starts.
+        """
+        import asyncio
+
+        self._held = []
+        self._open_task = asyncio.ensure_future(
+            self._open_async(shell, cols, rows, replay, screen)
+        )
+
+    async def _open_async(self, *args: Any) -> None:
+        try:
+            await self.connect_or_spawn(*args)
+        except Exception as e:
+            log(f"AsyncDaemonClient {self.session_name} failed to open ({e})", WARNING)
+            await self.ext.send(on_channel({"type": "error", "message": str(e)}, self.channel))
+        if self._close_event.is_set() and self.writer:
+            # Detached while connecting.
+            self.writer.close()
+        self._release_held()
+
+    async def _reader_loop(self, reader: "asyncio.StreamReader") -> None:
+        """
+        Receives events from the daemon and forwards them to the extension.
+        """
+        import asyncio
+        import pickle
+
+        log(f"Reader task {self.session_name} started")
+        self._resync = False
+        try:
+            while True:
+                msg = self._on_event(await read_frame(reader))
+                if msg is None:
+                    continue
+                if msg.get("type") == "data" and "data" in msg:
+                    msg = (
+                        self.deflate.message(msg["data"])
+                        if self.deflate
+                        else ext_data_message(msg["data"])
+                    )
+                await self.ext.send(on_channel(msg, self.channel))
+        except (asyncio.IncompleteReadError, OSError, ValueError, pickle.UnpicklingError):
+            pass
+        finally:
+            log(f"Reader task {self.session_name} terminated")
+            if self.writer:
+                self.writer.close()
+        if self._resync and not self._close_event.is_set():
+            log(f"Reader task {self.session_name} resyncing", WARNING)
+            try:
+                await self.connect_or_spawn(
+                    self._shell, *self._size, replay=-1, screen=True
+                )
+            except Exception as e:
+                log(f"Reader task {self.session_name} resync failed ({e})", ERROR)
+                await self.ext.send(
+                    on_channel({"type": "error", "message": f"resync failed: {e}"}, self.channel)
+                )
+
+    def _write(self, buf: bytes) -> None:
+        if self.writer and not self.writer.is_closing():
+            self.writer.write(frame_bytes(buf))
+
+    def _flush_input(self, force: bool = False) -> None:
+        self._flush_handle = None
+        super()._flush_input(force)
+        self._wake_flusher()
+
+    def _wake_flusher(self) -> None:
+        """
+        Sets a timer for the end of the input's batching window.
+        """
+        import asyncio
+
+        timeout = self._input.timeout(time.monotonic())
+        if self._flush_handle:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if timeout is not None:
+            self._flush_handle = asyncio.get_running_loop().call_later(
+                timeout, self._flush_input
+            )
+
+    def _disconnect(self, wake_reader: bool) -> None:
+        self._close_event.set()
+        if self._flush_handle:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        log(f"AsyncDaemonClient {self.session_name} closed")
+        if self.writer:
+            self.writer.close()
+
+
+async def host_main_async(first: Optional[Dict[str, Any]] = None) -> None:
+    """
+    asyncio flavour of host_main, selected with --asyncio / RIT_ASYNCIO=1.
+    One event loop serves the extension pipe and the daemon connections of all channels.
+    """
+    import asyncio
+
+    log("Started native host (asyncio)")
+    ext = await ExtStream.open()
+    session = None
+    clients: Dict[Any, AsyncDaemonClient] = {}
+    deflates: Dict[Any, Optional[ExtDeflate]] = {}
+    # "list" replies in progress, kept so they are not collected mid-way.
+    tasks: Set["asyncio.Task[None]"] = set()
+    cols = 100
+    rows = 30
+    try:
+        while True:
+            msg, first = (first, None) if first else (await ext.read(), None)
+            if msg and msg.get("type") == "stdin":
+                if LOG_LEVEL <= DEBUG:
+                    log_payload("EXT", msg)
+            else:
+                log_message("EXT", msg)
+            if msg is None:
+                for client in clients.values():
+                    client.close()
+                return
+            ch = msg.get("ch")
+            client = clients.get(ch)
+            try:
+                t = msg.get("type")
+                if t == "open":
+                    session = msg.get("session") or "default"
+                    cols = int(msg.get("cols", cols))
+                    rows = int(msg.get("rows", rows))
+                    deflate = deflates.get(ch) or ExtDeflate.negotiate(msg)
+                    deflates[ch] = deflate
+                    previous = clients.pop(ch, None)
+                    if previous:
+                        previous.detach()
+                    client = clients[ch] = AsyncDaemonClient(session, ext, deflate, ch)
+                    client.open(
+                        shell=msg.get("shell"),
+                        cols=cols,
+                        rows=rows,
+                        replay=int(msg.get("replay", 0)),
+                        screen=bool(msg.get("screen")),
+                    )
+                elif t == "list":
+                    task = asyncio.ensure_future(send_session_list_async(ext, ch))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+                elif t == "close":
+                    closing = list(clients) if ch is None else [ch]
+                    for c in closing:
+                        closed = clients.pop(c, None)
+                        deflates.pop(c, None)
+                        if closed:
+                            closed.close()
+                            await ext.send(on_channel({"type": "exit", "code": 0}, c))
+                    if ch is None:
+                        return
                 else:
-                    send_to_ext({"type": "error", "message": "unknown"})
+                    reply = channel_message(client, msg)
+                    if reply:
+                        await ext.send(on_channel(reply, ch))
             except Exception as e:
-                send_to_ext({"type": "error", "message": str(e)})
+                await ext.send(on_channel({"type": "error", "message": str(e)}, ch))
     finally:
         log(f"Stopped native host {session}")
 
 
+def profile_main(name: str, action: str = "status", modes: str = "") -> None:
+    """
+    Entry point for --profile: sends a profile command to a running session
+    and prints the reply, e.g. --profile tab12 start cpu,mem
+    """
+    info = read_live_info(name)
+    if not info:
+        print(f"no session {name}", file=sys.stderr)
+        raise SystemExit(1)
+    query = {"cmd": "profile", "action": action, "modes": [m for m in modes.split(",") if m]}
+    reply = query_session(info, query, "profile", timeout=30.0)
+    if reply is None:
+        print(f"session {name} did not answer", file=sys.stderr)
+        raise SystemExit(1)
+    print(json.dumps(reply, indent=2))
+    if reply.get("error"):
+        raise SystemExit(1)
+
+
+def replay_main(target: str, start: str = "0", end: str = "") -> None:
+    """
+    Entry point for --replay: writes the output of a recording from `start` to
+    `end` seconds to stdout. target is a .cast file or a session name, which
+    means its newest recording. A negative time counts from the end, e.g.
+    --replay tab12 -600 for the last ten minutes.
+    """
+    path = Path(target)
+    if not path.is_file():
+        found = sorted(
+            recordings_dir().glob(f"{target}-????????-??????-*.cast"),
+            key=lambda p: p.stat().st_mtime,
+        )
+        if not found:
+            print(f"no recording of {target}", file=sys.stderr)
+            raise SystemExit(1)
+        path = found[-1]
+    reader = RecordingReader(path)
+    try:
+        times = [float(t) if t else None for t in (start, end)]
+        duration = reader.duration()
+        t0, t1 = (t if t is None or t >= 0 else max(0.0, duration + t) for t in times)
+        out = sys.stdout.buffer
+        for _, kind, data in reader.events(t0 or 0.0, t1):
+            if kind == "o":
+                out.write(data.encode("utf-8"))
+        out.flush()
+    finally:
+        reader.close()
+
+
 def main() -> None:
     """
     Dispatches to host or daemon mode based on argv.
+    --asyncio selects the asyncio implementation; spawned daemons inherit it via RIT_ASYNCIO.
+    --profile SESSION [start|stop|dump|status] [MODES] controls a running session's profiler.
+    --replay FILE|SESSION [FROM_S] [TO_S] prints the output of a recording.
     """
+    global USE_ASYNCIO
+    if "--asyncio" in sys.argv:
+        sys.argv.remove("--asyncio")
+        os.environ["RIT_ASYNCIO"] = "1"
+        USE_ASYNCIO = not IS_WIN
     if len(sys.argv) >= 2 and sys.argv[1] == "--session-daemon":
         if len(sys.argv) < 6:
             raise SystemExit(2)
         session_main(sys.argv[2], sys.argv[3], sys.argv[4], sys.argv[5])
         return
-    host_main()
+    if len(sys.argv) >= 2 and sys.argv[1] == "--supervisor":
+        supervisor_main()
+        return
+    if len(sys.argv) >= 3 and sys.argv[1] == "--profile":
+        profile_main(*sys.argv[2:5])
+        return
+    if len(sys.argv) >= 3 and sys.argv[1] == "--replay":
+        replay_main(*sys.argv[2:5])
+        return
+    first = answer_pings()
+    if first is None:
+        return
+    if USE_ASYNCIO:
+        import asyncio
+
+        asyncio.run(host_main_async(first))
+        return
+    host_main(first)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,14 @@
+"""
+Shared setup for the native host's unit tests.
+
+    python -m pytest native-host/tests
+"""
+
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+# The host logs and keeps its state under XDG_STATE_HOME; keep the tests' out of ~.
+os.environ["XDG_STATE_HOME"] = tempfile.mkdtemp(prefix="run_in_terminal_tests_")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
@@ -0,0 +1,74 @@
+import pytest
+
+import run_in_terminal as rit
+
+
+def test_echo_passes_straight_through():
+    c = rit.OutputCoalescer(delay=0.01, max_bytes=1024, echo_bytes=4)
+    assert c.push(b"a", 0.0) == [b"a"]
+    assert len(c) == 0
+    assert c.timeout(0.0) is None
+
+
+def test_output_is_held_until_delay():
+    c = rit.OutputCoalescer(delay=0.01, max_bytes=1024, echo_bytes=4)
+    assert c.push(b"hello", 0.0) == []
+    # A small chunk no longer passes once something is pending.
+    assert c.push(b"!", 0.004) == []
+    assert c.timeout(0.004) == pytest.approx(0.006)
+    assert c.push(b" world", 0.02) == [b"hello! world"]
+    assert len(c) == 0
+    assert c.timeout(0.02) is None
+
+
+def test_output_is_split_at_max_bytes():
+    c = rit.OutputCoalescer(delay=0.01, max_bytes=4, echo_bytes=0)
+    assert c.push(b"0123456789", 0.0) == [b"0123", b"4567"]
+    assert len(c) == 2
+    assert c.take() == b"89"
+    assert c.timeout(0.0) is None
+    assert c.push(b"abcd", 0.0) == [b"abcd"]
+    assert c.timeout(0.0) is None
+
+
+def test_keystroke_after_quiet_period_passes_straight_through():
+    c = rit.InputCoalescer(delay=0.005, resize_delay=0.05, max_bytes=16)
+    assert c.push_stdin(b"l", 1.0)
+    assert c.take(1.0) == (None, b"l")
+    # The next ones within the window are batched.
+    assert not c.push_stdin(b"s", 1.001)
+    assert not c.push_stdin(b"\r", 1.002)
+    assert c.timeout(1.002) == pytest.approx(0.004)
+    assert c.take(1.003) == (None, b"")
+    assert c.take(1.006) == (None, b"s\r")
+    assert c.timeout(1.006) is None
+
+
+def test_keystrokes_are_due_at_max_bytes():
+    c = rit.InputCoalescer(delay=0.005, resize_delay=0.05, max_bytes=4)
+    c.push_stdin(b"a", 0.0)
+    c.take(0.0)
+    assert not c.push_stdin(b"bc", 0.001)
+    assert c.push_stdin(b"defg", 0.002)
+    assert c.take(0.002) == (None, b"bcdefg")
+
+
+def test_resize_burst_collapses_to_last_size():
+    c = rit.InputCoalescer(delay=0.005, resize_delay=0.05, max_bytes=16)
+    assert not c.push_resize(100, 30, 0.0)
+    assert not c.push_resize(110, 31, 0.02)
+    assert not c.push_resize(120, 32, 0.04)
+    assert c.timeout(0.04) == pytest.approx(0.01)
+    assert c.take(0.04) == (None, b"")
+    assert c.take(0.05) == ((120, 32), b"")
+    assert c.timeout(0.05) is None
+
+
+def test_force_takes_everything():
+    c = rit.InputCoalescer(delay=0.005, resize_delay=0.05, max_bytes=16)
+    c.push_stdin(b"x", 0.0)
+    c.take(0.0)
+    c.push_resize(90, 20, 0.001)
+    c.push_stdin(b"yz", 0.001)
+    assert c.take(0.001, force=True) == ((90, 20), b"yz")
+    assert c.timeout(0.001) is None
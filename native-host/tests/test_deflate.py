@@ -0,0 +1,51 @@
+import base64
+import os
+import zlib
+
+import run_in_terminal as rit
+
+
+def unpack(inflater, msg):
+    if "z_b64" in msg:
+        data = inflater.decompress(base64.b64decode(msg["z_b64"]))
+        assert len(data) == msg["n"]
+        return data
+    return base64.b64decode(msg["data_b64"])
+
+
+def test_frames_inflate_one_by_one_across_the_stream():
+    deflate = rit.ExtDeflate(level=6, min_bytes=16)
+    inflater = zlib.decompressobj(-zlib.MAX_WBITS)
+    chunks = [b"row %d of some very repetitive output\r\n" % i * 20 for i in range(10)]
+    msgs = [deflate.message(chunk) for chunk in chunks]
+    assert all("z_b64" in msg for msg in msgs)
+    # Each frame inflates on arrival, without waiting for the next one.
+    assert [unpack(inflater, msg) for msg in msgs] == chunks
+    # The window carries over: a repeat costs far less than the first time.
+    assert len(msgs[1]["z_b64"]) < len(msgs[0]["z_b64"])
+
+
+def test_small_frames_stay_plain():
+    deflate = rit.ExtDeflate(level=6, min_bytes=16)
+    assert deflate.message(b"x") == rit.ext_data_message(b"x")
+
+
+def test_incompressible_output_skips_frames():
+    deflate = rit.ExtDeflate(level=6, min_bytes=16)
+    inflater = zlib.decompressobj(-zlib.MAX_WBITS)
+    noise = os.urandom(4096)
+    assert unpack(inflater, deflate.message(noise)) == noise
+    skipped = [deflate.message(b"a" * 100) for _ in range(rit.ExtDeflate.SKIP_FRAMES)]
+    assert all("data_b64" in msg for msg in skipped)
+    text = b"compressible again " * 20
+    msg = deflate.message(text)
+    assert "z_b64" in msg
+    # Plain frames never entered the stream, so it still inflates.
+    assert unpack(inflater, msg) == text
+
+
+def test_negotiate_needs_the_mode():
+    assert rit.ExtDeflate.negotiate({"type": "open"}) is None
+    if rit.EXT_COMPRESS:
+        deflate = rit.ExtDeflate.negotiate({"compress": "deflate-raw"})
+        assert isinstance(deflate, rit.ExtDeflate)
@@ -0,0 +1,91 @@
+import base64
+import subprocess
+
+import pytest
+
+import run_in_terminal as rit
+
+
+class Client:
+    def __init__(self):
+        self.sent = []
+
+    def send(self, msg):
+        self.sent.append(msg)
+
+
+@pytest.fixture
+def server():
+    server = rit.SessionServer("exec-marks", None, 80, 24)
+    yield server
+    server.scrollback.close()
+
+
+def run(server, client, command, capture=True):
+    step = rit.ExecStep(client, "b1", 0, command, stop_on_error=False, capture=capture)
+    server._exec_running = step
+    return step
+
+
+def shell_output(step):
+    # What the PTY shows: the echoed command line, then what sh prints running it.
+    out = subprocess.run(["sh", "-c", step.wrapped().decode()], capture_output=True).stdout
+    return step.wrapped() + b"\r\n" + out + b"$ "
+
+
+def publish(server, data, size):
+    for i in range(0, len(data), size):
+        server.publish(data[i : i + size])
+
+
+@pytest.mark.parametrize("size", [1, 5, 4096])
+def test_marks_report_start_code_and_output(server, size):
+    client = Client()
+    step = run(server, client, "echo hi; (exit 3)")
+    data = shell_output(step)
+    publish(server, b"prompt$ " + data, size)
+    start, done = client.sent
+    assert start["type"] == "exec.start"
+    assert start["command"] == "echo hi; (exit 3)"
+    assert done["type"] == "exec.done"
+    assert (done["id"], done["index"], done["code"]) == ("b1", 0, 3)
+    first, end = done["output"]
+    assert first == start["offset"]
+    assert server.scrollback.tail(-1)[first:end] == b"hi\n"
+    assert base64.b64decode(done["data_b64"]) == b"hi\n"
+    assert server._exec_running is None
+
+
+def test_marks_of_other_commands_are_ignored(server):
+    client = Client()
+    run(server, client, "true")
+    other = rit.ExecStep(client, "b0", 0, "true", False, False)
+    publish(server, shell_output(other), 7)
+    assert client.sent == []
+
+
+def test_end_mark_without_start_is_ignored(server):
+    client = Client()
+    step = run(server, client, "true", capture=False)
+    publish(server, b"\x1b]133;D;0;rit=%s\x07" % step.token.encode(), 4096)
+    assert client.sent == []
+    assert server._exec_running is step
+
+
+@pytest.mark.parametrize(
+    "command", ["cat <<EOF", "echo 'open", 'echo "open', "echo trailing \\", "echo )"]
+)
+def test_commands_that_would_swallow_their_mark_are_refused(server, command):
+    client = Client()
+    server.pty.shell = "/bin/sh"
+    server._queue_exec(client, {"id": "b2", "commands": ["true", command]})
+    (done,) = client.sent
+    assert (done["type"], done["id"], done["index"]) == ("exec.done", "b2", 1)
+    assert done["error"].startswith("command does not parse")
+    assert not server._execs and server._exec_running is None
+
+
+@pytest.mark.parametrize("command", ["cd /tmp", "echo hi # note", "cat <<EOF\nx\nEOF"])
+def test_complete_commands_parse(command):
+    step = rit.ExecStep(Client(), "b", 0, command, False, False)
+    assert step.syntax_error("/bin/sh") is None
@@ -0,0 +1,45 @@
+import pickle
+
+import run_in_terminal as rit
+
+
+def test_control_round_trip():
+    msg = {"cmd": "resize", "cols": 120, "rows": 40, "name": "ünïcode"}
+    buf = rit.encode_control(msg)
+    assert buf[0] == rit.FRAME_CONTROL
+    assert rit.is_binary_frame(buf)
+    assert rit.decode_frame(buf) == msg
+
+
+def test_stdin_frame_carries_raw_bytes():
+    buf = rit.encode_stdin(b"\x00\x1b[A\xff")
+    assert buf[0] == rit.FRAME_STDIN
+    msg = rit.decode_frame(buf)
+    assert msg["cmd"] == "stdin"
+    assert bytes(msg["data"]) == b"\x00\x1b[A\xff"
+
+
+def test_data_event_frame():
+    frame = rit.EventFrame(data=b"\x1b[31mred\x1b[0m")
+    buf = frame.binary()
+    assert buf[0] == rit.FRAME_DATA
+    msg = rit.decode_frame(buf)
+    assert msg["type"] == "data"
+    assert bytes(msg["data"]) == b"\x1b[31mred\x1b[0m"
+    # Encoded once, whatever the number of clients.
+    assert frame.binary() is buf
+
+
+def test_legacy_pickle_fallback():
+    msg = {"cmd": "attach", "session": "s", "replay": -1}
+    buf = pickle.dumps(msg)
+    assert not rit.is_binary_frame(buf)
+    assert rit.decode_frame(buf) == msg
+
+
+def test_event_frame_legacy_encodings():
+    data = rit.EventFrame(data=b"hi")
+    assert pickle.loads(data.legacy()) == {"type": "data", "data_b64": "aGk="}
+    event = rit.EventFrame({"type": "exit", "code": 3})
+    assert pickle.loads(event.legacy()) == {"type": "exit", "code": 3}
+    assert rit.decode_frame(event.binary()) == {"type": "exit", "code": 3}
@@ -0,0 +1,74 @@
+import pytest
+
+import run_in_terminal as rit
+
+
+class Client:
+    probe = False
+
+    def __init__(self, probe=False):
+        self.probe = probe
+        self.sent = []
+
+    def send(self, msg):
+        self.sent.append(msg)
+
+
+@pytest.fixture
+def server():
+    server = rit.SessionServer("hibernate", None, 80, 24)
+    yield server
+    server.scrollback.close()
+
+
+def test_hibernate_spills_and_wake_restores(server):
+    for i in range(200):
+        server.publish(b"\x1b[1mline %d\x1b[0m\r\n" % i)
+    scrollback = server.scrollback.tail(-1)
+    total = server.scrollback.total
+    text = bytes(server.history.buf)
+    server.hibernate()
+    assert server._hibernated
+    assert rit.spill_path("hibernate").exists()
+    assert server.scrollback.tail(-1) == b"" and server.history is None
+    server.wake()
+    assert not server._hibernated
+    assert not rit.spill_path("hibernate").exists()
+    assert server.scrollback.tail(-1) == scrollback
+    assert server.scrollback.total == total
+    assert bytes(server.history.buf) == text
+    assert server.history.lines == 200
+
+
+def test_output_wakes_a_hibernated_session(server):
+    server.publish(b"before\r\n")
+    server.hibernate()
+    server.publish(b"after\r\n")
+    assert not server._hibernated
+    assert server.scrollback.tail(-1) == b"before\r\nafter\r\n"
+    assert bytes(server.history.buf) == b"before\nafter\n"
+
+
+def test_wake_without_spill_file_starts_empty(server):
+    server.publish(b"lost\r\n")
+    server.hibernate()
+    rit.spill_path("hibernate").unlink()
+    server.wake()
+    assert server.scrollback.tail(-1) == b""
+    assert server.scrollback.total == len(b"lost\r\n")
+    server.publish(b"new\r\n")
+    assert server.scrollback.tail(-1) == b"new\r\n"
+
+
+def test_reap_is_declined_while_a_client_is_attached(server):
+    reaped = []
+    server.reap = reaped.append
+    asking, user = Client(probe=True), Client()
+    server.clients.update((asking, user))
+    assert server._handle_cmd(asking, {"cmd": "reap", "reason": "too many"})
+    assert asking.sent == [{"type": "reaped", "session": "hibernate", "closed": False}]
+    assert reaped == []
+    server.clients.discard(user)
+    assert not server._handle_cmd(asking, {"cmd": "reap", "reason": "too many"})
+    assert asking.sent[-1] == {"type": "reaped", "session": "hibernate", "closed": True}
+    assert reaped == ["too many"]
@@ -0,0 +1,187 @@
+import base64
+import socket
+import threading
+from multiprocessing.connection import Connection
+
+import pytest
+
+import run_in_terminal as rit
+
+
+class Daemons:
+    """
+    Stands in for the session daemons: every ensure_session() gets a socket
+    pair, whose other end the test reads and writes as the daemon would.
+    """
+
+    def __init__(self):
+        self.peers = []
+        self.to_ext = []
+        self.cond = threading.Condition()
+
+    def ensure_session(self, name, shell, cols, rows, timeout=5.0):
+        a, b = socket.socketpair()
+        with self.cond:
+            self.peers.append(Connection(b.detach()))
+            self.cond.notify_all()
+        return Connection(a.detach())
+
+    def send_to_ext(self, msg):
+        with self.cond:
+            self.to_ext.append(msg)
+            self.cond.notify_all()
+
+    def wait(self, predicate, timeout=5.0):
+        with self.cond:
+            assert self.cond.wait_for(predicate, timeout)
+
+    def peer(self, i):
+        self.wait(lambda: len(self.peers) > i)
+        return self.peers[i]
+
+
+def recv(conn, timeout=5.0):
+    assert conn.poll(timeout)
+    return conn.recv()
+
+
+@pytest.fixture
+def daemons(monkeypatch):
+    daemons = Daemons()
+    monkeypatch.setattr(rit, "ensure_session", daemons.ensure_session)
+    monkeypatch.setattr(rit, "send_to_ext", daemons.send_to_ext)
+    yield daemons
+    for peer in daemons.peers:
+        peer.close()
+
+
+def test_channel_messages_before_open():
+    assert rit.channel_message(None, {"type": "ping"}) == {"type": "pong"}
+    assert rit.channel_message(None, {"type": "stdin", "data_b64": ""}) == {
+        "type": "error",
+        "message": "stdin before open",
+    }
+    assert rit.channel_message(None, {"type": "resize", "cols": 90, "rows": 30}) is None
+    assert rit.channel_message(None, {"type": "rewind"}) == {
+        "type": "error",
+        "message": "unknown",
+    }
+
+
+def test_channel_messages_go_to_the_daemon(daemons):
+    client = rit.DaemonClient("s")
+    client.connect_or_spawn(None, 80, 24)
+    peer = daemons.peer(0)
+    assert recv(peer)["cmd"] == "attach"
+    data = base64.b64encode(b"ls\r").decode()
+    for msg in (
+        {"type": "ping"},
+        {"type": "stdin", "data_b64": data, "id": "i1"},
+        {"type": "resize", "cols": 100, "rows": 40},
+    ):
+        assert rit.channel_message(client, msg) is None
+    assert recv(peer) == {"cmd": "ping"}
+    assert recv(peer) == {"cmd": "stdin", "data_b64": data, "id": "i1"}
+    # Resizes are debounced, and go out once their window ends.
+    assert recv(peer) == {"cmd": "resize", "cols": 100, "rows": 40}
+    peer.send({"type": "pong"})
+    daemons.wait(lambda: daemons.to_ext)
+    assert daemons.to_ext == [{"type": "pong"}]
+    client.close()
+    assert recv(peer) == {"cmd": "close"}
+
+
+def test_resync_reattaches_for_a_full_replay(daemons):
+    client = rit.DaemonClient("s")
+    client.connect_or_spawn(None, 80, 24)
+    first = daemons.peer(0)
+    assert recv(first)["replay"] == 0
+    # The daemon drops a client that fell behind after telling it so.
+    first.send({"type": "resync", "reason": "client fell behind"})
+    first.close()
+    second = daemons.peer(1)
+    attach = recv(second)
+    assert (attach["cmd"], attach["replay"]) == ("attach", -1)
+    second.send({"type": "data", "data_b64": base64.b64encode(b"prompt$ ").decode()})
+    daemons.wait(lambda: len(daemons.to_ext) == 2)
+    resync, data = daemons.to_ext
+    assert resync["type"] == "resync"
+    assert (data["type"], base64.b64decode(data["data_b64"])) == ("data", b"prompt$ ")
+    client.close()
+    assert recv(second) == {"cmd": "close"}
+
+
+def test_commands_wait_for_the_connection(daemons, monkeypatch):
+    gate = threading.Event()
+    connect = rit.DaemonClient.connect_or_spawn
+
+    def slow_connect(self, *args):
+        assert gate.wait(5)
+        connect(self, *args)
+
+    monkeypatch.setattr(rit.DaemonClient, "connect_or_spawn", slow_connect)
+    client = rit.DaemonClient("s", channel=7)
+    client.open(None, 80, 24)
+    data = base64.b64encode(b"held").decode()
+    assert rit.channel_message(client, {"type": "ping"}) is None
+    assert rit.channel_message(client, {"type": "stdin", "data_b64": data, "id": "h"}) is None
+    client.close()
+    gate.set()
+    peer = daemons.peer(0)
+    assert recv(peer)["cmd"] == "attach"
+    assert recv(peer) == {"cmd": "ping"}
+    assert recv(peer) == {"cmd": "stdin", "data_b64": data, "id": "h"}
+    assert recv(peer) == {"cmd": "close"}
+
+
+def run_host(monkeypatch, messages):
+    """
+    Runs host_main() on messages, each a message or a callable run when the
+    host reads at that point, returning the message to hand it.
+    """
+    it = iter(messages)
+
+    def read_from_ext():
+        msg = next(it, None)
+        return msg() if callable(msg) else msg
+
+    monkeypatch.setattr(rit, "read_from_ext", read_from_ext)
+    host = threading.Thread(target=rit.host_main)
+    host.start()
+    host.join(10)
+    assert not host.is_alive()
+
+
+def test_reopening_a_channel_detaches_its_old_connection(daemons, monkeypatch):
+    opened = []
+
+    def reopen():
+        opened.append(recv(daemons.peer(0)))
+        return {"type": "open", "ch": "a", "session": "s2"}
+
+    def done():
+        opened.append(recv(daemons.peer(1)))
+        return None
+
+    run_host(monkeypatch, [{"type": "open", "ch": "a", "session": "s1"}, reopen, done])
+    assert [m["session"] for m in opened] == ["s1", "s2"]
+    # The first session is left running, the second is closed with the host.
+    with pytest.raises(EOFError):
+        recv(daemons.peer(0))
+    assert recv(daemons.peer(1)) == {"cmd": "close"}
+
+
+def test_list_does_not_hold_up_other_channels(daemons, monkeypatch):
+    read_on = threading.Event()
+    monkeypatch.setattr(
+        rit, "list_sessions", lambda: [{"name": "s", "on_time": read_on.wait(5)}]
+    )
+
+    def next_message():
+        read_on.set()
+        return None
+
+    run_host(monkeypatch, [{"type": "list", "ch": 3}, next_message])
+    daemons.wait(lambda: daemons.to_ext)
+    (reply,) = daemons.to_ext
+    assert reply == {"type": "list", "sessions": [{"name": "s", "on_time": True}], "ch": 3}
@@ -0,0 +1,83 @@
+import pytest
+
+import run_in_terminal as rit
+
+
+class Client:
+    def __init__(self):
+        self.sent = []
+
+    def send(self, msg):
+        self.sent.append(msg)
+
+
+class PTY:
+    """
+    A PTY master that takes `room` bytes, then reports EAGAIN (0 written).
+    """
+
+    cols, rows = 80, 24
+    master_fd = None
+
+    def __init__(self, room):
+        self.room = room
+        self.written = b""
+
+    def write_some(self, data):
+        n = min(len(data), self.room)
+        self.room -= n
+        self.written += bytes(data[:n])
+        return n
+
+
+@pytest.fixture
+def server():
+    server = rit.SessionServer("input", None, 80, 24)
+    yield server
+    server.scrollback.close()
+
+
+def test_input_is_written_in_order_with_progress_and_ack(server):
+    a, b = Client(), Client()
+    server.pty = PTY(100_000)
+    paste = bytes(range(256)) * 2400
+    server.queue_input(a, paste, "p1")
+    server.queue_input(b, b"typed")
+    assert server._input_blocked
+    assert server._input_queued == len(paste) + 5 - 100_000
+    assert a.sent == []
+    # The reactor calls again each time the PTY is writable.
+    for room in (200_000, 50_000, 1 << 20):
+        server.pty.room += room
+        server._write_input()
+    assert server.pty.written == paste + b"typed"
+    assert not server._input_blocked and server._input_queued == 0
+    *progress, ack = a.sent
+    assert ack == {"type": "stdin_ack", "id": "p1", "bytes": len(paste)}
+    # One progress event for each INPUT_PROGRESS_BYTES written.
+    assert [(m["type"], m["id"], m["total"]) for m in progress] == [
+        ("stdin_progress", "p1", len(paste))
+    ] * 2
+    assert [m["written"] // rit.INPUT_PROGRESS_BYTES for m in progress] == [1, 2]
+    assert b.sent == []
+
+
+def test_full_queue_refuses_input(monkeypatch, server):
+    monkeypatch.setattr(rit, "INPUT_QUEUE_MAX", 1000)
+    client = Client()
+    server.pty = PTY(0)
+    server.queue_input(client, b"x" * 600)
+    server.queue_input(client, b"y" * 600, "big")
+    assert client.sent == [{"type": "stdin_ack", "id": "big", "error": "input queue full"}]
+    server.pty.room = 1000
+    server._write_input()
+    assert server.pty.written == b"x" * 600
+
+
+def test_paste_is_bracketed_once_the_application_asks(server):
+    client = Client()
+    server.pty = PTY(1 << 20)
+    server.queue_input(client, b"a\x1b[201~b", paste=True)
+    server._bracketed_paste = True
+    server.queue_input(client, b"a\x1b[201~b", paste=True)
+    assert server.pty.written == b"a\x1b[201~b" + b"\x1b[200~ab\x1b[201~"
@@ -0,0 +1,36 @@
+import run_in_terminal as rit
+
+
+def test_log_rotates_by_size_and_keeps_backups(monkeypatch):
+    monkeypatch.setattr(rit, "LOG_MAX_BYTES", 1000)
+    path = rit.log_path()
+    for p in [path] + [path.with_name(f"{path.name}.{i}") for i in (1, 2, 3)]:
+        p.unlink(missing_ok=True)
+    writer = rit.LogWriter()
+    for i in range(40):
+        writer.put(rit.INFO, f"line {i:02d} " + "x" * 80)
+        if i % 5 == 4:
+            writer.flush()
+    writer.put(rit.INFO, "line 40")
+    writer.flush()
+    rotated = [path.with_name(f"{path.name}.{i}") for i in (1, 2)]
+    assert all(p.exists() for p in rotated)
+    assert not path.with_name(f"{path.name}.3").exists()
+    # The newest lines are in rit.log, the ones before it in rit.log.1.
+    lines = rotated[0].read_text().splitlines() + path.read_text().splitlines()
+    assert lines[-1].endswith("> line 40")
+    assert [line.split()[3] for line in lines] == [
+        f"{i:02d}" for i in range(41 - len(lines), 41)
+    ]
+
+
+def test_levels_other_than_info_are_tagged():
+    writer = rit.LogWriter()
+    path = rit.log_path()
+    path.unlink(missing_ok=True)
+    writer.put(rit.WARNING, "careful")
+    writer.put(rit.INFO, "plain")
+    writer.flush()
+    warn, info = path.read_text().splitlines()
+    assert warn.endswith("> [warning] careful")
+    assert info.endswith("> plain")
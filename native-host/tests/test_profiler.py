@@ -0,0 +1,45 @@
+import pstats
+import time
+from pathlib import Path
+
+import pytest
+
+import run_in_terminal as rit
+
+
+def busy(seconds):
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        sum(range(1000))
+
+
+def test_modes_dump_their_files_and_stop():
+    profiler = rit.Profiler()
+    profiler.name = "test"
+    profiler.start(["cpu", "sample", "mem"])
+    assert profiler.running == ["cpu", "sample", "mem"]
+    busy(0.1)
+    files = profiler.stop(["cpu", "sample"])
+    assert profiler.running == ["mem"]
+    ends = [".pstats", "-cpu.txt", ".folded", ".tracemalloc", "-mem.txt"]
+    assert [next(e for e in ends if f.endswith(e)) for f in files] == ends
+    assert all(Path(f).stat().st_size for f in files)
+    # Python 3.12+ profiles the sampler thread too, which can push busy out
+    # of the text summary's top entries, so look for it in the full stats.
+    assert "busy" in [func for _, _, func in pstats.Stats(files[0]).stats]
+    assert "busy (test_profiler.py" in Path(files[2]).read_text()
+    # Stopping the rest dumps what mem collected since.
+    files = profiler.stop()
+    assert [next(e for e in ends if f.endswith(e)) for f in files] == ends[3:]
+    assert profiler.running == []
+
+
+def test_unknown_mode_is_refused():
+    with pytest.raises(ValueError):
+        rit.Profiler().start(["gpu"])
+
+
+def test_profile_reply():
+    assert rit.profile_reply({}) == {"type": "profile", "running": [], "files": []}
+    reply = rit.profile_reply({"action": "rewind"})
+    assert reply["error"] == "unknown action rewind"
@@ -0,0 +1,57 @@
+import pickle
+import socket
+import struct
+
+import pytest
+
+import run_in_terminal as rit
+
+
+@pytest.fixture
+def pair():
+    a, b = socket.socketpair()
+    yield a, b
+    a.close()
+    b.close()
+
+
+def framed(msg):
+    payload = pickle.dumps(msg)
+    return struct.pack("!i", len(payload)) + payload
+
+
+def read(sock, buf):
+    return [pickle.loads(frame) for frame in rit.read_frames(sock, buf)]
+
+
+def test_read_frames_buffers_partial_frames(pair):
+    sock, peer = pair
+    buf = bytearray()
+    assert read(sock, buf) == []
+    first, second = framed({"cmd": "ping"}), framed({"cmd": "info", "n": 2})
+    peer.sendall(first[:2])
+    assert read(sock, buf) == []
+    peer.sendall(first[2:] + second[:7])
+    assert read(sock, buf) == [{"cmd": "ping"}]
+    assert buf == second[:7]
+    peer.sendall(second[7:])
+    assert read(sock, buf) == [{"cmd": "info", "n": 2}]
+    assert buf == b""
+
+
+def test_read_frames_reads_several_frames_and_long_headers(pair):
+    sock, peer = pair
+    payload = pickle.dumps({"cmd": "resize"})
+    # The 8 byte length form Connection uses for payloads beyond 2 GiB.
+    peer.sendall(framed("a") + struct.pack("!iQ", -1, len(payload)) + payload + framed("b"))
+    assert read(sock, bytearray()) == ["a", {"cmd": "resize"}, "b"]
+
+
+def test_read_frames_raises_on_eof_and_bad_lengths(pair):
+    sock, peer = pair
+    peer.sendall(struct.pack("!i", -5))
+    with pytest.raises(ValueError):
+        read(sock, bytearray())
+    peer.close()
+    with pytest.raises(EOFError):
+        read(sock, bytearray())
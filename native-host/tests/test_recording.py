@@ -0,0 +1,84 @@
+import json
+
+import pytest
+
+import run_in_terminal as rit
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(rit.time, "monotonic", lambda: now[0])
+    return now
+
+
+def record(name, events, clock):
+    """
+    Records (seconds, kind, payload) events and returns the .cast path.
+    """
+    recorder = rit.SessionRecorder(name, 80, 24, "/bin/sh", rit.Stats())
+    for t, kind, payload in events:
+        clock[0] = 1000.0 + t
+        if kind == "r":
+            recorder.resize(*payload)
+        else:
+            getattr(recorder, {"o": "output", "i": "input"}[kind])(payload)
+    recorder.close()
+    return recorder.path
+
+
+def test_recording_is_asciicast_v2(clock, monkeypatch):
+    monkeypatch.setattr(rit, "RECORD_INPUT", True)
+    path = record(
+        "cast",
+        [(0.5, "o", b"$ "), (1.0, "i", b"ls\r"), (1.25, "r", (100, 30)), (1.5, "o", b"\xff!")],
+        clock,
+    )
+    header, *lines = path.read_text(encoding="utf-8").splitlines()
+    header = json.loads(header)
+    assert (header["version"], header["width"], header["height"]) == (2, 80, 24)
+    assert header["env"]["SHELL"] == "/bin/sh"
+    events = [json.loads(line) for line in lines]
+    assert events == [
+        [0.5, "o", "$ "],
+        [1.0, "i", "ls\r"],
+        [1.25, "r", "100x30"],
+        [1.5, "o", "\ufffd!"],
+    ]
+
+
+def test_utf8_split_across_chunks_is_kept_whole(clock):
+    data = "é€".encode()
+    chunks = [(0.1, "o", data[:1]), (0.2, "o", data[1:3]), (0.3, "o", data[3:])]
+    path = record("utf8", chunks, clock)
+    reader = rit.RecordingReader(path)
+    assert "".join(text for _t, _kind, text in reader.events()) == "é€"
+    reader.close()
+
+
+def test_reader_seeks_by_time_through_the_index(clock, monkeypatch):
+    monkeypatch.setattr(rit, "RECORD_INDEX_SECONDS", 1.0)
+    lines = [(i * 0.25, "o", f"line {i}\r\n".encode()) for i in range(200)]
+    path = record("seek", lines, clock)
+    assert path.with_suffix(".idx").stat().st_size > 40 * rit.SessionRecorder.INDEX_ENTRY.size
+    reader = rit.RecordingReader(path)
+    assert reader.duration() == 199 * 0.25
+    # The seek lands at an index entry at or before the time asked for.
+    offset = reader.offset_at(30.1)
+    assert reader._data_start < offset
+    line = reader._map[offset : reader._map.find(b"\n", offset)]
+    assert 29.0 <= json.loads(line)[0] <= 30.1
+    events = list(reader.events(30.0, 31.0))
+    assert [t for t, _kind, _text in events] == [30.0, 30.25, 30.5, 30.75, 31.0]
+    assert events[0][2] == "line 120\r\n"
+    assert list(reader.events(0.0, 0.0)) == [(0.0, "o", "line 0\r\n")]
+    reader.close()
+
+
+def test_reader_without_index_reads_from_the_start(clock):
+    path = record("noidx", [(i * 0.5, "o", b"x%d" % i) for i in range(10)], clock)
+    path.with_suffix(".idx").unlink()
+    reader = rit.RecordingReader(path)
+    assert reader.offset_at(3.0) == reader._data_start
+    assert [text for _t, _kind, text in reader.events(3.0)] == ["x6", "x7", "x8", "x9"]
+    reader.close()
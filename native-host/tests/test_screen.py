@@ -0,0 +1,102 @@
+import run_in_terminal as rit
+
+
+def rows(screen):
+    return ["".join(line).rstrip() for line in screen._lines]
+
+
+def history(screen):
+    return ["".join(line).rstrip() for line, _attrs in screen.history]
+
+
+def feed(screen, *chunks):
+    for chunk in chunks:
+        screen.feed(chunk)
+    return screen
+
+
+def test_print_wrap_and_scroll_into_history():
+    s = feed(rit.ScreenModel(5, 3, history_lines=10), b"abcdefg\r\n1\r\n2\r\n3")
+    assert rows(s) == ["1", "2", "3"]
+    assert history(s) == ["abcde", "fg"]
+    assert (s.x, s.y) == (1, 2)
+
+
+def test_history_is_bounded():
+    s = feed(rit.ScreenModel(10, 2, history_lines=3), *[b"%d\r\n" % i for i in range(10)])
+    assert history(s) == ["6", "7", "8"]
+    assert rows(s) == ["9", ""]
+
+
+def test_cursor_movement_and_erase():
+    s = feed(rit.ScreenModel(10, 3), b"hello\r\nworld", b"\x1b[1;3H\x1b[K", b"\x1b[2;2HX")
+    assert rows(s) == ["he", "wXrld", ""]
+    feed(s, b"\x1b[2J")
+    assert rows(s) == ["", "", ""]
+
+
+def test_utf8_split_across_chunks():
+    data = "grüße €".encode()
+    s = feed(rit.ScreenModel(10, 1), data[:3], data[3:8], data[8:])
+    assert rows(s) == ["grüße €"]
+
+
+def test_escape_split_across_chunks():
+    s = feed(rit.ScreenModel(10, 2), b"ab\x1b[", b"2", b";4Hc")
+    assert rows(s) == ["ab", "   c"]
+
+
+def test_alternate_screen_restores_main():
+    s = feed(rit.ScreenModel(10, 2), b"shell$ ", b"\x1b[?1049h\x1b[Hvim", b"\x1b[?1049l")
+    assert rows(s) == ["shell$", ""]
+    assert (s.x, s.y) == (7, 0)
+
+
+def test_scroll_region():
+    s = feed(rit.ScreenModel(4, 4), b"a\r\nb\r\nc\r\nd", b"\x1b[2;3r\x1b[3H\n")
+    assert rows(s) == ["a", "c", "", "d"]
+    assert history(s) == []
+
+
+def test_resize_keeps_cursor_on_screen():
+    s = feed(rit.ScreenModel(6, 3), b"one\r\ntwo\r\nthree")
+    s.resize(4, 2)
+    assert rows(s) == ["two", "thre"]
+    assert history(s) == ["one"]
+    assert s.y == 1
+
+
+def test_snapshot_reproduces_the_screen():
+    out = (
+        b"plain \x1b[1;31mbold red\x1b[0m \x1b[4munder\x1b[0m\r\n"
+        b"\x1b(0lqk\x1b(B box\r\n"
+        b"\x1b]2;my title\x07\x1b[?2004h\x1b[7mrev"
+    )
+    src = feed(rit.ScreenModel(20, 4), out)
+    dst = feed(rit.ScreenModel(20, 4), src.snapshot())
+    assert rows(dst) == rows(src)
+    sgr = [[src._attr_sgr[a] for a in line] for line in src._attrs]
+    assert [[dst._attr_sgr[a] for a in line] for line in dst._attrs] == sgr
+    assert (dst.x, dst.y) == (src.x, src.y)
+    assert dst.title == "my title"
+    assert dst.bracketed_paste
+    assert dst._attr_sgr[dst._attr] == src._attr_sgr[src._attr]
+
+
+def test_many_distinct_renditions_stay_bounded(monkeypatch):
+    monkeypatch.setattr(rit, "SCREEN_ATTRS_MAX", 64)
+    s = rit.ScreenModel(20, 4, history_lines=5)
+    for i in range(5000):
+        r, g, b = i % 256, i // 256, 7
+        s.feed(b"\x1b[38;2;%d;%d;%dm%d\x1b[48;5;%dm \x1b[m\r\n" % (r, g, b, i, b))
+    assert len(s._attr_sgr) <= 2 * 64
+    assert len(s._attr_ids) == len(s._attr_sgr) == len(s._attr_state)
+    assert len(s._sgr_cache) <= 64
+    assert history(s)[-1] == "4996"
+    assert rows(s)[:3] == ["4997", "4998", "4999"]
+    # Cells on screen and in history still carry their own colours.
+    line, attrs = s.history[-1]
+    assert s._attr_sgr[attrs[0]] == "38;2;132;19;7"
+    assert s._attr_sgr[s._attrs[2][0]] == "38;2;135;19;7"
+    assert s._attr_sgr[s._attrs[2][4]] == "48;5;7;38;2;135;19;7"
+    assert s._attr == 0
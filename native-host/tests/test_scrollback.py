@@ -0,0 +1,84 @@
+import pytest
+
+import run_in_terminal as rit
+
+
+@pytest.fixture(params=["heap", "mmap"])
+def ring_factory(request, tmp_path):
+    rings = []
+
+    def make(capacity):
+        path = tmp_path / f"ring{len(rings)}" if request.param == "mmap" else None
+        ring = rit.ScrollbackRing(capacity, path)
+        rings.append(ring)
+        return ring
+
+    yield make
+    for ring in rings:
+        ring.close()
+
+
+def test_tail_before_full(ring_factory):
+    ring = ring_factory(16)
+    ring.append(b"hello ")
+    ring.append(b"world")
+    assert len(ring) == 11
+    assert ring.total == 11
+    assert ring.tail(-1) == b"hello world"
+    assert ring.tail(5) == b"world"
+    assert ring.tail(100) == b"hello world"
+    assert ring.tail(0) == b""
+
+
+def test_wraparound_keeps_newest_bytes(ring_factory):
+    ring = ring_factory(8)
+    stream = b""
+    for i in range(20):
+        chunk = bytes([65 + i]) * (i % 5 + 1)
+        ring.append(chunk)
+        stream += chunk
+        assert ring.tail(-1) == stream[-8:]
+        assert ring.tail(3) == stream[-3:]
+    assert ring.total == len(stream)
+    assert len(ring) == 8
+
+
+def test_append_larger_than_capacity(ring_factory):
+    ring = ring_factory(8)
+    ring.append(b"abc")
+    ring.append(b"0123456789xyz")
+    assert ring.total == 16
+    assert ring.tail(-1) == b"56789xyz"
+    ring.append(b"!")
+    assert ring.tail(-1) == b"6789xyz!"
+
+
+def test_empty_append_is_ignored(ring_factory):
+    ring = ring_factory(4)
+    ring.append(b"")
+    assert len(ring) == 0
+    assert ring.tail(-1) == b""
+
+
+def test_release_and_restore():
+    ring = rit.ScrollbackRing(8)
+    ring.append(b"0123456789")
+    saved, total = ring.tail(-1), ring.total
+    ring.release()
+    ring.restore(saved, total)
+    assert ring.total == 10
+    assert ring.tail(-1) == b"23456789"
+    ring.append(b"ab")
+    assert ring.tail(-1) == b"456789ab"
+
+
+def test_mmap_ring_lives_in_its_file(tmp_path):
+    path = tmp_path / "ring"
+    ring = rit.ScrollbackRing(8, path)
+    ring.append(b"0123456789")
+    assert path.stat().st_size == 8
+    # release() leaves a file-backed ring alone.
+    ring.release()
+    assert ring.tail(-1) == b"23456789"
+    ring.close()
+    assert not path.exists()
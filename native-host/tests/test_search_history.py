@@ -0,0 +1,92 @@
+import pytest
+
+import run_in_terminal as rit
+
+
+@pytest.fixture
+def stride(monkeypatch):
+    # A small stride and capacity exercise checkpoints and trimming.
+    monkeypatch.setattr(rit, "SEARCH_INDEX_STRIDE", 16)
+    return 16
+
+
+def line_start(text, line):
+    pos = 0
+    for _ in range(line):
+        pos = text.index(b"\n", pos) + 1
+    return pos
+
+
+def test_escapes_and_controls_are_stripped():
+    h = rit.SearchHistory(1 << 20)
+    h.append(b"\x1b[1;31mred\x1b[0m\r\n\x1b]0;title\x07ok\tx\x08\x7f\n\x1b(Bz")
+    assert bytes(h.buf) == b"red\nok\tx\nz"
+    assert h.lines == 2
+
+
+def test_escape_split_across_chunks():
+    h = rit.SearchHistory(1 << 20)
+    h.append(b"a\x1b[3")
+    h.append(b"1mb\x1b]2;ti")
+    h.append(b"tle\x07c\n")
+    assert bytes(h.buf) == b"abc\n"
+
+
+def test_line_index_matches_the_text(stride):
+    h = rit.SearchHistory(1 << 20)
+    text = b"".join(b"line %d %s\n" % (i, b"x" * (i % 7)) for i in range(100))
+    for i in range(0, len(text), 13):
+        h.append(text[i : i + 13])
+    assert bytes(h.buf) == text
+    assert h.lines == 100
+    for offset in range(0, len(text), 5):
+        assert h.line_at(offset) == text.count(b"\n", 0, offset)
+    for line in (0, 1, 17, 50, 99, 100):
+        assert h.line_offset(line) == line_start(text, line)
+    assert h.line_offset(500) == h.end
+
+
+def test_trim_keeps_numbering(stride):
+    h = rit.SearchHistory(256)
+    text = b"".join(b"row %03d\n" % i for i in range(200))
+    for i in range(0, len(text), 40):
+        h.append(text[i : i + 40])
+    assert len(h.buf) <= 256
+    assert h.base > 0
+    assert bytes(h.buf) == text[h.base :]
+    # Trimming cuts at a line break.
+    assert text[h.base - 1 : h.base] == b"\n"
+    assert h.base_line == text.count(b"\n", 0, h.base)
+    for offset in range(h.base, h.end, 3):
+        assert h.line_at(offset) == text.count(b"\n", 0, offset)
+    assert h.line_offset(0) == h.base
+    assert h.line_offset(h.base_line + 2) == line_start(text, h.base_line + 2)
+
+
+def test_large_append_is_trimmed_to_capacity(stride):
+    h = rit.SearchHistory(256)
+    text = b"".join(b"row %03d\n" % i for i in range(100))
+    h.append(text)
+    assert len(h.buf) <= 256
+    assert bytes(h.buf) == text[h.base :]
+    assert h.base_line == text.count(b"\n", 0, h.base)
+
+
+def test_saved_and_restored(stride):
+    h = rit.SearchHistory(256)
+    text = b"".join(b"row %03d\n" % i for i in range(100))
+    h.append(text)
+    h.append(b"tail\x1b[3")
+    header, buffers = h.saved()
+    restored = rit.SearchHistory.restore(256, header, b"".join(buffers))
+    assert len(h.buf) <= 256
+    assert (restored.base, restored.base_line) == (h.base, h.base_line)
+    assert restored.lines == h.lines
+    assert restored.buf == h.buf
+    for offset in range(h.base, h.end, 7):
+        assert restored.line_at(offset) == h.line_at(offset)
+    # The cut off escape is finished by the next output.
+    restored.append(b"1mend\n")
+    assert bytes(restored.buf).endswith(b"tailend\n")
+    with pytest.raises(ValueError):
+        rit.SearchHistory.restore(256, header, b"".join(buffers)[:-1])
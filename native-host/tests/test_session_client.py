@@ -0,0 +1,72 @@
+import base64
+import socket
+import struct
+import threading
+import time
+from multiprocessing.connection import Connection
+
+import pytest
+
+import run_in_terminal as rit
+
+
+@pytest.fixture
+def pair():
+    a, b = socket.socketpair()
+    client = rit.SessionClient(Connection(a.detach()))
+    yield client, b
+    client.close()
+    b.close()
+
+
+def collect(sock, out):
+    """
+    Reads until EOF and appends the decoded frames to out.
+    """
+    buf = b""
+    while True:
+        chunk = sock.recv(1 << 20)
+        if not chunk:
+            break
+        buf += chunk
+    pos = 0
+    while pos < len(buf):
+        (n,) = struct.unpack_from("!i", buf, pos)
+        out.append(rit.decode_frame(buf[pos + 4 : pos + 4 + n]))
+        pos += 4 + n
+
+
+@pytest.mark.parametrize("binary", [True, False])
+def test_overflow_replaces_the_backlog_with_resync(monkeypatch, pair, binary):
+    monkeypatch.setattr(rit, "CLIENT_COALESCE_BYTES", 64 * 1024)
+    monkeypatch.setattr(rit, "CLIENT_QUEUE_MAX", 512 * 1024)
+    client, peer = pair
+    client.binary = binary
+    notified = []
+    client.on_backlog = lambda c: notified.append((c.backlogged, c.doomed))
+    sent = b""
+    while not client.doomed:
+        chunk = b"%07d" % len(sent) * 1000
+        client.send_frame(rit.EventFrame(data=chunk))
+        sent += chunk
+    assert notified[-1] == (True, True)
+    assert client.queued < 512 * 1024
+    # A doomed client takes nothing more.
+    client.send_frame(rit.EventFrame(data=b"late"))
+    client.send({"type": "exit"})
+    frames = []
+    reader = threading.Thread(target=collect, args=(peer, frames))
+    reader.start()
+    deadline = time.monotonic() + 5
+    while not client.pump() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    client.close()
+    reader.join(5)
+    *data, last = frames
+    assert last == {"type": "resync", "reason": "client fell behind"}
+    got = b"".join(
+        bytes(f["data"]) if binary else base64.b64decode(f["data_b64"]) for f in data
+    )
+    # Whatever went out is an intact prefix of the output, nothing after it.
+    assert 0 < len(got) < len(sent)
+    assert sent.startswith(got)
@@ -0,0 +1,34 @@
+import run_in_terminal as rit
+
+
+def test_rates_are_per_second_since_the_last_snapshot(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(rit.time, "monotonic", lambda: now[0])
+    stats = rit.Stats()
+    stats.add("frames", 10)
+    stats.add("bytes", 4000)
+    now[0] += 2
+    first = stats.snapshot()
+    assert first["counters"] == {"frames": 10, "bytes": 4000}
+    assert first["rates"] == {"frames": 5.0, "bytes": 2000.0}
+    assert (first["uptime"], first["interval"]) == (2.0, 2.0)
+    stats.add("frames", 2)
+    now[0] += 0.5
+    second = stats.snapshot()
+    assert second["counters"] == {"frames": 12, "bytes": 4000}
+    assert second["rates"] == {"frames": 4.0, "bytes": 0.0}
+    assert (second["uptime"], second["interval"]) == (2.5, 0.5)
+
+
+def test_timers_keep_count_total_and_max():
+    stats = rit.Stats()
+    for seconds in (0.001, 0.004, 0.002):
+        stats.timed("broadcast", seconds)
+    assert stats.snapshot()["timers"] == {
+        "broadcast": {"count": 3, "total_ms": 7.0, "avg_ms": 2.3333, "max_ms": 4.0}
+    }
+
+
+def test_average():
+    assert rit.average(10, 4) == 2
+    assert rit.average(10, 0) == 0
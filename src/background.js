@@ -3,8 +3,9 @@
 // 1) terminal tab (owns the PTY and forwards output)
 // 2) popup mirror (renders the same output and sends keystrokes back)
 // 3) confirm page flow for dangerous snippets
+// 4) the native host, shared by all terminal tabs
 
-import { DEFAULTS } from "./defaults.js";
+import { DEFAULTS, HOST_NAME } from "./defaults.js";
 import { MENU_ID_DEFAULT, SESSION_KEY, TERM_URL, MENU_ID_PICK_PARENT, MENU_ID_PICK_PREFIX } from "./constants.js"
 import { storedSet, storedMap } from "./util.js"
 import { openInlineMirror } from "./inline_overlay.js"
@@ -17,6 +18,11 @@ const mirrorSelection = new Map();
 const termWaiters = new Map();
 const viewWaiters = new Map();
 const snapshotWaiters = new Map();
+// One native host port for all terminal tabs: each tab's "rit-pty" port is a
+// channel ("ch") on it, and the host serves every channel with a session.
+let nativePort = null;
+let nextChannel = 0;
+const ptyChannels = new Map();
 
 // Persistent:
 const termReady = await storedSet("rit.termReady");
@@ -136,6 +142,29 @@ async function forwardToTerminalTab(message, preferredTabId = null) {
   return true;
 }
 
+function nativeHost() {
+  if (nativePort) return nativePort;
+  const port = chrome.runtime.connectNative(HOST_NAME);
+  port.onMessage.addListener((msg) => {
+    const tab = ptyChannels.get(msg?.ch);
+    if (!tab) return;
+    delete msg.ch;
+    try { tab.postMessage(msg); } catch { }
+  });
+  port.onDisconnect.addListener(() => {
+    if (nativePort === port) nativePort = null;
+    // the tabs see the host go away like their own native port would
+    const message = chrome.runtime.lastError?.message || "native host disconnected";
+    for (const tab of ptyChannels.values()) {
+      try { tab.postMessage({ type: "error", message }); } catch { }
+      try { tab.disconnect(); } catch { }
+    }
+    ptyChannels.clear();
+  });
+  nativePort = port;
+  return port;
+}
+
 // list sessions -> include saved names
 async function listSessions() {
   const tabs = await chrome.tabs.query({ url: TERM_URL });
@@ -225,7 +254,7 @@ chrome.runtime.onConnect.addListener((port) => {
         return;
       }
 
-      if (msg.type === "mirror.data" || msg.type === "mirror.state") {
+      if (msg.type === "mirror.data" || msg.type === "mirror.state" || msg.type === "mirror.reset") {
         for (const m of mirrorPorts) {
           if (mirrorSelection.get(m) === tabId) {
             try { m.postMessage(msg); } catch { }
@@ -252,6 +281,24 @@ chrome.runtime.onConnect.addListener((port) => {
     return;
   }
 
+  if (port.name === "rit-pty") {
+    const ch = ++nextChannel;
+    ptyChannels.set(ch, port);
+
+    port.onMessage.addListener((msg) => {
+      if (!msg) return;
+      try { nativeHost().postMessage({ ...msg, ch }); } catch { }
+    });
+
+    port.onDisconnect.addListener(() => {
+      if (!ptyChannels.delete(ch)) return;
+      // what the host does when a tab's own native port closes
+      try { nativePort?.postMessage({ type: "close", ch }); } catch { }
+    });
+
+    return;
+  }
+
   if (port.name === "rit-mirror") {
     mirrorPorts.add(port);
 
@@ -1,5 +1,5 @@
 // Terminal page script
-// Normal mode -> owns a PTY via native host and forwards output to background
+// Normal mode -> owns a PTY via the native host (a channel on the background's port) and forwards output to background
 // Mirror mode (?mirror=1) -> mirrors a selected terminal tab and sends keystrokes back
 
 import "@xterm/xterm/css/xterm.css";
@@ -8,8 +8,8 @@ import { FitAddon } from "@xterm/addon-fit";
 import { SerializeAddon } from "@xterm/addon-serialize";
 import { Unicode11Addon } from "@xterm/addon-unicode11";
 import { UnicodeGraphemesAddon } from "@xterm/addon-unicode-graphemes";
-import { HOST_NAME, DEFAULTS } from "./defaults.js";
-import { b64ToUtf8, utf8ToB64 } from "./util.js";
+import { DEFAULTS } from "./defaults.js";
+import { b64ToUtf8, utf8ToB64, b64ToBytes, bytesToB64, createInflater } from "./util.js";
 
 const term = new Terminal({
   fontSize: 13,
@@ -144,15 +144,11 @@ if (isMirror) {
   function attachBgPortOnMessage(port) {
     port.onMessage.addListener((msg) => {
       if (msg?.type === "rit.inject" && typeof msg.text === "string") {
-        openPty();
-        if (ptyReady) ptyCon.postMessage({ type: "stdin", data_b64: btoa(msg.text) });
-        else pendingInput.push(msg.text);
+        injectText(msg.text);
         return;
       }
       if (msg?.type === "mirror.stdin" && typeof msg.text === "string") {
-        openPty();
-        if (ptyReady) ptyCon.postMessage({ type: "stdin", data_b64: btoa(msg.text) });
-        else pendingInput.push(msg.text);
+        injectText(msg.text, false);
         return;
       }
       if (msg?.type === "rit.host.close") {
@@ -208,7 +204,10 @@ if (isMirror) {
   connectBg()
 
 
-  let ptyCon = chrome.runtime.connectNative(HOST_NAME);
+  // a channel on the background's native host port, with the same API as a port of our own
+  let ptyCon = chrome.runtime.connect({ name: "rit-pty" });
+  // one deflate stream per channel, kept across re-opens like the host's
+  const inflate = createInflater();
   let ptyOpened = false;
   let ptyReady = false;
   const pendingInput = [];
@@ -233,6 +232,9 @@ if (isMirror) {
         cols: term.cols,
         rows: term.rows,
         session: ptySessionName,
+        replay: -1, // also deliver output the daemon produced before we attached
+        screen: true, // as a redrawn screen if the daemon keeps a screen model
+        ...(inflate && { compress: "deflate-raw" }),
         ...(sh && { shell: sh })
       });
     });
@@ -250,11 +252,22 @@ if (isMirror) {
 
   function flushPending() {
     while (pendingInput.length) {
-      const text = pendingInput.shift();
-      ptyCon.postMessage({ type: "stdin", data_b64: btoa(text) });
+      sendInput(...pendingInput.shift());
     }
   }
 
+  // injected text can be large, with an id the host acks it once the shell has it all
+  let inputSeq = 0;
+  function sendInput(text, track = true) {
+    ptyCon.postMessage({ type: "stdin", data_b64: utf8ToB64(text), ...(track && { id: `in${++inputSeq}` }) });
+  }
+
+  function injectText(text, track = true) {
+    openPty();
+    if (ptyReady) sendInput(text, track);
+    else pendingInput.push([text, track]);
+  }
+
   function updateCloseProtection() {
     chrome.storage.sync.get(DEFAULTS, (cfgRaw) => {
       const cfg = { ...DEFAULTS, ...cfgRaw };
@@ -266,7 +279,28 @@ if (isMirror) {
     console.log(msg)
   })
 
+  // compressed frames inflate asynchronously, messages after them wait so order is kept
+  let outputQueue = null;
+  function queueOutput(msg) {
+    const p = (outputQueue || Promise.resolve())
+      .then(() => handlePtyMessage(msg))
+      .catch((e) => term.writeln("\r\n[decode error] " + String(e)));
+    outputQueue = p;
+    p.then(() => { if (outputQueue === p) outputQueue = null; });
+  }
+
   ptyCon.onMessage.addListener((msg) => {
+    if (outputQueue || (msg?.type === "data" && msg.z_b64)) queueOutput(msg);
+    else handlePtyMessage(msg);
+  });
+
+  async function handlePtyMessage(msg) {
+    if (msg?.type === "data" && msg.z_b64) {
+      const bytes = await inflate(b64ToBytes(msg.z_b64), msg.n);
+      term.write(bytes);
+      bgPort.postMessage({ type: "mirror.data", data_b64: bytesToB64(bytes) });
+      return;
+    }
     if (msg?.type === "data" && msg.data_b64) {
       term.write(b64ToUtf8(msg.data_b64));
       bgPort.postMessage({ type: "mirror.data", data_b64: msg.data_b64 });
@@ -281,6 +315,22 @@ if (isMirror) {
       bgPort.postMessage({ type: "mirror.state", state: "ready" });
       return;
     }
+    if (msg?.type === "stdin_progress") {
+      console.debug(`input ${msg.id}: ${msg.written}/${msg.total} bytes delivered`);
+      return;
+    }
+    if (msg?.type === "stdin_ack") {
+      if (msg.error) term.writeln("\r\n[input dropped] " + String(msg.error));
+      else console.debug(`input ${msg.id}: ${msg.bytes} bytes delivered`);
+      return;
+    }
+    if (msg?.type === "resync") {
+      // we fell behind, the host reattaches and replays the scrollback (or the screen)
+      term.reset();
+      fit.fit();
+      bgPort.postMessage({ type: "mirror.reset" });
+      return;
+    }
     if (msg?.type === "exit") {
       ptyReady = false;
       ptyOpened = false;
@@ -294,7 +344,7 @@ if (isMirror) {
       bgPort.postMessage({ type: "mirror.state", state: "error", message: msg.message || "unknown" });
       return;
     }
-  });
+  }
 
   ptyCon.onDisconnect.addListener(() => {
     const err = chrome.runtime.lastError?.message || "";
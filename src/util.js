@@ -101,3 +101,53 @@ export function utf8ToB64(str) {
   for (const b of bytes) bin += String.fromCharCode(b);
   return btoa(bin);
 }
+
+export function b64ToBytes(b64) {
+  const bin = atob(b64);
+  const bytes = new Uint8Array(bin.length);
+  for (let i = 0; i < bin.length; i++) bytes[i] = bin.charCodeAt(i);
+  return bytes;
+}
+
+export function bytesToB64(bytes) {
+  let bin = "";
+  for (let i = 0; i < bytes.length; i += 0x8000) {
+    bin += String.fromCharCode.apply(null, bytes.subarray(i, i + 0x8000));
+  }
+  return btoa(bin);
+}
+
+// Inflates the native host's compressed data frames (compress: "deflate-raw").
+// The host keeps one deflate stream per connection and ends every frame with a
+// sync flush, so each frame inflates to exactly its `n` bytes on its own.
+// Returns null if the browser has no raw deflate support; frames must be passed
+// in order and one at a time.
+export function createInflater() {
+  let stream;
+  try {
+    stream = new DecompressionStream("deflate-raw");
+  } catch {
+    return null;
+  }
+  const writer = stream.writable.getWriter();
+  const reader = stream.readable.getReader();
+  return async function inflate(bytes, n) {
+    writer.write(bytes).catch(() => { });
+    const parts = [];
+    let got = 0;
+    while (got < n) {
+      const { value, done } = await reader.read();
+      if (done) throw new Error("inflate stream ended");
+      parts.push(value);
+      got += value.length;
+    }
+    if (parts.length === 1) return parts[0];
+    const out = new Uint8Array(got);
+    let at = 0;
+    for (const p of parts) {
+      out.set(p, at);
+      at += p.length;
+    }
+    return out;
+  };
+}